@@ -3,81 +3,1161 @@ import argparse
 import sys
 import shutil
 import hashlib # <-- Добавляем hashlib для хеш-сумм
+import math
+import numpy as np
 from pydub import AudioSegment
-from pydub.silence import detect_silence
-from pydub.exceptions import CouldntDecodeError # Import specific exception
-from pydub.effects import normalize # <--- Импортируем normalize
+from pydub.exceptions import CouldntDecodeError, CouldntEncodeError # Import specific exception
+from pydub.utils import mediainfo, ratio_to_db, db_to_float
 import pyttsx3
 from tempfile import NamedTemporaryFile
 import platform
 import subprocess
 import builtins
+import bisect
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, Future, wait
+import collections
+import json
+import csv
+import sqlite3
+import re
+import contextlib
+import zlib
+import io
+import time
+import select
+import ctypes
+import ctypes.util
+import signal
+import struct
 
-# Добавим функцию для нормализации
-def normalize_audio(audio_segment, target_dbfs=-1.0):
-    """Нормализует громкость аудиосегмента до target_dbfs по пиковому уровню."""
-    if audio_segment.dBFS == float('-inf'): # Если тишина, то не нормализуем
-        print(f"    Нормализация (пиковая): Сегмент представляет собой тишину (уровень: {audio_segment.dBFS:.2f} dBFS). Нормализация не применяется.")
-        return audio_segment
-    
-    # pydub.effects.normalize устанавливает самый громкий пик на (0 - headroom) dBFS.
-    # Если target_dbfs = -0.1, то headroom = 0.1
-    # Если target_dbfs = 0.0, то headroom = 0.0
-    # headroom не может быть отрицательным.
-    headroom = abs(target_dbfs) 
-    if target_dbfs > 0: # Убедимся, что target_dbfs не положительный, т.к. это пиковый уровень
-        print(f"    Предупреждение: Целевой пиковый уровень {target_dbfs} dBFS > 0. Установлен на 0 dBFS (headroom 0.0).")
-        headroom = 0.0
-
-    print(f"    Нормализация (пиковая): Начальный RMS: {audio_segment.dBFS:.2f} dBFS, Начальный пик: {audio_segment.max_dBFS:.2f} dBFS. Целевой пик: {target_dbfs:.2f} dBFS (headroom: {headroom:.2f} dB)")
-    normalized_segment = normalize(audio_segment, headroom=headroom)
-    print(f"    Нормализация (пиковая): RMS после: {normalized_segment.dBFS:.2f} dBFS, Пик после: {normalized_segment.max_dBFS:.2f} dBFS")
-    return normalized_segment
+def peak_normalization_gain(peak_dbfs, target_dbfs):
+    """Усиление в dB, которое поднимает пик peak_dbfs до target_dbfs (не выше 0 dBFS). Для тишины — 0."""
+    if peak_dbfs == float('-inf'):
+        return 0.0
+    return min(target_dbfs, 0.0) - peak_dbfs
+
+def rms_normalization_gain(rms_dbfs, peak_dbfs, target_rms_dbfs, peak_limit_dbfs):
+    """
+    Усиление в dB, которое приводит RMS к target_rms_dbfs, но не поднимает пик peak_dbfs выше
+    peak_limit_dbfs (не выше 0 dBFS), чтобы не было клиппинга. Для тишины — 0.
+    """
+    if rms_dbfs == float('-inf'):
+        return 0.0
+    gain = target_rms_dbfs - rms_dbfs
+    peak_gain = peak_normalization_gain(peak_dbfs, peak_limit_dbfs)
+    if gain > peak_gain:
+        print(f"  Предупреждение: RMS {target_rms_dbfs} dBFS недостижим без клиппинга, усиление ограничено пиком {min(peak_limit_dbfs, 0.0)} dBFS.")
+        gain = peak_gain
+    return gain
 
 def print(*args, **kwargs):
     kwargs['flush'] = True
     return builtins.print(*args, **kwargs)
 
-def find_silent_split_point(audio_segment, target_time_ms, search_window_ms, silence_thresh_db, min_silence_len_ms):
+# Запущенные процессы ffmpeg: при остановке скрипта (кнопка «Стоп» в GUI шлет SIGTERM только ему)
+# они завершаются вместе с ним, а не дописывают .part файлы в фоне
+_child_processes = set()
+# Получен SIGTERM: main останавливает и процессы пула --jobs
+_terminating = False
+
+
+def start_child_process(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, stdin=None):
+    """Запускает процесс (ffmpeg) и запоминает его, чтобы завершить при остановке скрипта."""
+    process = subprocess.Popen(command, stdin=stdin, stdout=stdout, stderr=stderr)
+    _child_processes.add(process)
+    if _terminating:
+        # SIGTERM пришел, пока процесс запускался в другом потоке: terminate_child_processes его уже не увидел
+        finish_child_process(process)
+    return process
+
+
+def finish_child_process(process):
+    """Завершает процесс, если он еще работает, дожидается его и забывает."""
+    try:
+        if process.poll() is None:
+            process.kill()
+        process.wait()
+    finally:
+        _child_processes.discard(process)
+
+
+def run_child_process(command, stdout=subprocess.DEVNULL, input=None):
+    """Аналог subprocess.run для ffmpeg: процесс учитывается и не переживает остановку скрипта."""
+    process = start_child_process(command, stdout=stdout, stdin=subprocess.PIPE if input is not None else None)
+    try:
+        output, error_output = process.communicate(input)
+    finally:
+        finish_child_process(process)
+    return subprocess.CompletedProcess(command, process.returncode, output, error_output)
+
+
+def terminate_child_processes():
+    """Убивает все запущенные процессы ffmpeg и дожидается их завершения."""
+    for process in list(_child_processes):
+        finish_child_process(process)
+
+
+def _handle_sigterm(signum, frame):
+    global _terminating
+    _terminating = True
+    # Сначала останавливаем ffmpeg (в том числе запущенные из потоков), затем выходим через finally в main
+    terminate_child_processes()
+    raise SystemExit(128 + signum)
+
+
+def install_sigterm_handler():
+    """SIGTERM завершает дочерние процессы ffmpeg перед выходом (также в процессах пула --jobs)."""
+    if hasattr(signal, "SIGTERM"):
+        signal.signal(signal.SIGTERM, _handle_sigterm)
+
+
+def terminate_process_pool(executor):
+    """
+    Останавливает процессы пула (каждый по SIGTERM завершает свой ffmpeg). У ProcessPoolExecutor нет
+    публичного способа прервать уже работающие задачи, поэтому используется список его процессов.
+    """
+    for process in list((getattr(executor, "_processes", None) or {}).values()):
+        if process.is_alive():
+            process.terminate()
+
+
+# Размер блока, который читается из ffmpeg за один раз в потоковом режиме
+STREAM_READ_BLOCK_MS = 10000
+
+class PcmStreamReader:
+    """
+    Потоковый источник PCM: декодирует MP3 через ffmpeg и держит в памяти только запрошенный участок.
+    Поддерживает len() и срезы в миллисекундах так же, как AudioSegment, поэтому может
+    подставляться вместо него в split_mp3() и find_silent_split_point().
+    """
+
+    def __init__(self, input_file, block_ms=STREAM_READ_BLOCK_MS, silence_scanner_params=None):
+        info = mediainfo(input_file)
+        try:
+            self.frame_rate = int(info['sample_rate'])
+            self.channels = int(info['channels'])
+            estimated_duration_s = float(info.get('duration', 0) or 0)
+        except (KeyError, ValueError):
+            raise CouldntDecodeError(f"ffprobe не смог определить параметры аудио: {input_file}")
+        # pydub декодирует MP3 в 16-битный PCM, делаем так же, чтобы точки разреза совпадали
+        self.sample_width = 2
+        self.frame_width = self.sample_width * self.channels
+        self._block_frames = max(1, int(block_ms * (self.frame_rate / 1000.0)))
+        self._estimated_len_ms = int(round(estimated_duration_s * 1000))
+
+        self._buffer = bytearray()
+        self._buffer_start_frame = 0 # Номер первого кадра, который еще хранится в буфере
+        self._frames_read = 0
+        self._eof = False
+        # Если заданы (silence_thresh_db, min_silence_len_ms), индекс тишины строится по мере чтения
+        self.silence_scanner = None
+        if silence_scanner_params:
+            self.silence_scanner = SilenceScanner(self.frame_rate, self.channels, self.sample_width,
+                                                  silence_scanner_params[1], silence_scanner_params[0])
+
+        command = [
+            AudioSegment.converter, "-v", "error", "-i", input_file,
+            "-f", "s16le", "-acodec", "pcm_s16le",
+            "-ac", str(self.channels), "-ar", str(self.frame_rate), "-"
+        ]
+        self._process = start_child_process(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+
+    def __len__(self):
+        if self._eof:
+            return round(1000 * self._frames_read / self.frame_rate)
+        # Пока поток не дочитан, длина не может быть меньше уже прочитанного
+        read_ms = int(1000 * self._frames_read / self.frame_rate)
+        return max(self._estimated_len_ms, read_ms + 1)
+
+    def _read_block(self):
+        data = self._process.stdout.read(self._block_frames * self.frame_width)
+        data = data[:len(data) - len(data) % self.frame_width]
+        if not data:
+            self._eof = True
+            return_code = self._process.wait()
+            if return_code != 0:
+                # Сбой в середине файла — тоже ошибка: иначе книга молча обрезалась бы на этом месте
+                read_s = self._frames_read / self.frame_rate
+                raise CouldntDecodeError(f"ffmpeg не смог декодировать поток (код выхода {return_code}, "
+                                         f"декодировано {read_s:.1f} сек)")
+            if self.silence_scanner:
+                self.silence_scanner.finish()
+            return
+        if self.silence_scanner:
+            self.silence_scanner.feed(data)
+        self._buffer.extend(data)
+        self._frames_read += len(data) // self.frame_width
+
+    def _ms_to_frame(self, ms):
+        if ms == float("inf"):
+            return ms # Конец потока
+        # Та же арифметика, что и в AudioSegment._parse_position
+        return int(ms * (self.frame_rate / 1000.0))
+
+    def prefetch(self, position_ms):
+        """Дочитывает поток до position_ms (или до конца файла)."""
+        target_frame = self._ms_to_frame(position_ms)
+        while not self._eof and self._frames_read < target_frame:
+            self._read_block()
+
+    def __getitem__(self, millisecond):
+        if not isinstance(millisecond, slice) or millisecond.step:
+            raise TypeError("PcmStreamReader поддерживает только срезы вида [start:end]")
+        start = millisecond.start if millisecond.start is not None else 0
+        if millisecond.stop is None:
+            self.prefetch(float("inf"))
+            end = len(self)
+        else:
+            end = millisecond.stop
+            self.prefetch(end)
+        start = min(start, len(self))
+        end = min(end, len(self))
+
+        start_frame = self._ms_to_frame(start)
+        end_frame = min(self._ms_to_frame(end), self._frames_read)
+        if start_frame < self._buffer_start_frame:
+            raise IndexError(f"Участок {start}ms уже освобожден из буфера потокового чтения")
+        offset = (start_frame - self._buffer_start_frame) * self.frame_width
+        length = max(0, end_frame - start_frame) * self.frame_width
+        data = bytes(self._buffer[offset:offset + length])
+        return AudioSegment(data=data, sample_width=self.sample_width, frame_rate=self.frame_rate, channels=self.channels)
+
+    def drain(self):
+        """Дочитывает поток до конца, не сохраняя PCM (нужно только для анализа)."""
+        while not self._eof:
+            self._read_block()
+            self.release_before(float("inf"))
+
+    def release_before(self, position_ms):
+        """Освобождает из буфера все данные до position_ms."""
+        frame = min(self._ms_to_frame(max(0, position_ms)), self._frames_read)
+        if frame > self._buffer_start_frame:
+            del self._buffer[:(frame - self._buffer_start_frame) * self.frame_width]
+            self._buffer_start_frame = frame
+
+    def close(self):
+        if self._process.poll() is None:
+            self._process.kill()
+        self._process.stdout.close()
+        finish_child_process(self._process)
+        self._buffer = bytearray()
+
+
+# Шаг огибающей RMS/пиков, которая сохраняется в кэше анализа
+ENVELOPE_STEP_MS = 10
+
+# Типы сэмплов NumPy для PCM разной разрядности (как их трактует audioop: 8 бит — знаковые)
+_PCM_DTYPES = {1: np.int8, 2: np.int16, 4: np.int32}
+
+class SilenceScanner:
+    """
+    Векторизованный (NumPy) детектор тишины. Принимает PCM блоками и за один линейный проход находит
+    те же интервалы, что pydub.silence.detect_silence(seek_step=1).
+    Энергия сэмплов суммируется по миллисекундам, RMS каждого окна min_silence_len_ms (с шагом 1 мс)
+    считается как разность кумулятивных сумм, поэтому стоимость не зависит от длины окна тишины.
+    Попутно строится огибающая RMS/пиков с шагом ENVELOPE_STEP_MS (для кэша и статистики).
+    """
+
+    def __init__(self, frame_rate, channels, sample_width, min_silence_len_ms, silence_thresh_db):
+        self.frame_rate = frame_rate
+        self.channels = channels
+        self.sample_width = sample_width
+        self.min_silence_len_ms = int(min_silence_len_ms)
+        self.silence_thresh_db = silence_thresh_db
+        # Как в detect_silence: порог в dBFS переводится в абсолютную амплитуду
+        self._thresh = db_to_float(silence_thresh_db) * (2 ** (8 * sample_width) / 2)
+        self._dtype = _PCM_DTYPES[sample_width]
+        # 32-битные сэмплы в квадрате переполнили бы int64 при суммировании
+        self._acc_dtype = np.float64 if sample_width == 4 else np.int64
+        self._frames_per_ms = frame_rate / 1000.0 # Та же арифметика, что и в AudioSegment.frame_count
+
+        self._pending_energy = np.zeros(0, dtype=self._acc_dtype) # Энергия кадров после последней полной миллисекунды
+        self._pending_peak = np.zeros(0, dtype=np.int64) # Пиковая амплитуда тех же кадров
+        self._frames_done = 0 # Кадров, разложенных по полным миллисекундам
+        self._ms_done = 0 # Число полных миллисекунд
+        self._next_start = 0 # Первое окно (мс), которое еще не проверено
+        self._ms_energy_tail = np.zeros(0, dtype=self._acc_dtype) # Энергия миллисекунд [_next_start, _ms_done)
+        # Серии подряд идущих начал тихих окон [runs_lo[k], runs_hi[k]] (мс), отсортированы и не пересекаются
+        self.runs_lo = []
+        self.runs_hi = []
+        self.duration_ms = None # Известна после finish()
+
+        # Огибающая: на каждый шаг ENVELOPE_STEP_MS — RMS и пиковая амплитуда
+        self._envelope_rms = []
+        self._envelope_peak = []
+        self._envelope_carry = (np.zeros(0), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64))
+        self._total_energy = 0.0
+        self._total_samples = 0
+        self._total_peak = 0
+        self.envelope_rms = None # np.float32, известна после finish()
+        self.envelope_peak = None # np.int32, известна после finish()
+
+    def _ms_bounds(self, first_ms, last_ms):
+        """Номера первых кадров миллисекунд first_ms..last_ms включительно."""
+        return (np.arange(first_ms, last_ms + 1, dtype=np.float64) * self._frames_per_ms).astype(np.int64)
+
+    def _take_ms_values(self, bounds):
+        """Складывает энергию и пики ожидающих кадров по миллисекундам с границами bounds."""
+        cumulative = np.concatenate(([0], np.cumsum(self._pending_energy)))
+        local = np.minimum(bounds - self._frames_done, len(self._pending_energy))
+        ms_energy = cumulative[local[1:]] - cumulative[local[:-1]]
+
+        ms_samples = (local[1:] - local[:-1]) * self.channels
+        ms_peak = np.zeros(len(ms_energy), dtype=np.int64)
+        non_empty = ms_samples > 0 # Пустыми могут быть только миллисекунды за концом данных
+        if non_empty.any():
+            last_frame = local[1:][non_empty][-1]
+            ms_peak[non_empty] = np.maximum.reduceat(self._pending_peak[:last_frame], local[:-1][non_empty])
+        self._add_to_envelope(ms_energy, ms_peak, ms_samples)
+        return ms_energy
+
+    def _add_to_envelope(self, ms_energy, ms_peak, ms_samples, flush=False):
+        """Сворачивает миллисекундные значения в шаги огибающей, неполный шаг переносится дальше."""
+        carry_energy, carry_peak, carry_samples = self._envelope_carry
+        energy = np.concatenate((carry_energy, ms_energy.astype(np.float64)))
+        peak = np.concatenate((carry_peak, ms_peak))
+        samples = np.concatenate((carry_samples, ms_samples))
+        self._total_energy += float(ms_energy.sum())
+        self._total_samples += int(ms_samples.sum())
+        if len(ms_peak):
+            self._total_peak = max(self._total_peak, int(ms_peak.max()))
+
+        step = ENVELOPE_STEP_MS
+        full = len(energy) if flush else len(energy) // step * step
+        if full:
+            pad = -full % step # Последний неполный шаг при flush дополняется пустыми миллисекундами
+            step_energy = np.concatenate((energy[:full], np.zeros(pad))).reshape(-1, step).sum(axis=1)
+            step_samples = np.concatenate((samples[:full], np.zeros(pad, dtype=np.int64))).reshape(-1, step).sum(axis=1)
+            step_peak = np.concatenate((peak[:full], np.zeros(pad, dtype=np.int64))).reshape(-1, step).max(axis=1)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                step_rms = np.sqrt(np.where(step_samples > 0, step_energy / step_samples, 0.0))
+            self._envelope_rms.append(step_rms.astype(np.float32))
+            self._envelope_peak.append(step_peak.astype(np.int32))
+        self._envelope_carry = (energy[full:], peak[full:], samples[full:])
+
+    def feed(self, raw_data):
+        """Добавляет очередной блок PCM (целое число кадров)."""
+        samples = np.frombuffer(raw_data, dtype=self._dtype).astype(self._acc_dtype)
+        frame_energy = (samples * samples).reshape(-1, self.channels).sum(axis=1)
+        frame_peak = np.abs(samples).reshape(-1, self.channels).max(axis=1).astype(np.int64)
+        self._pending_energy = np.concatenate((self._pending_energy, frame_energy))
+        self._pending_peak = np.concatenate((self._pending_peak, frame_peak))
+
+        total_frames = self._frames_done + len(self._pending_energy)
+        last_ms = int(total_frames / self._frames_per_ms) + 1
+        bounds = self._ms_bounds(self._ms_done, last_ms)
+        bounds = bounds[bounds <= total_frames]
+        if len(bounds) < 2:
+            return
+        ms_energy = self._take_ms_values(bounds)
+        self._pending_energy = self._pending_energy[bounds[-1] - self._frames_done:]
+        self._pending_peak = self._pending_peak[bounds[-1] - self._frames_done:]
+        self._frames_done = int(bounds[-1])
+        self._ms_done += len(ms_energy)
+        # Последнюю миллисекунду оставляем в запасе: точная длина файла станет известна только в finish()
+        self._scan_windows(ms_energy, self._ms_done - 1 - self.min_silence_len_ms)
+
+    def finish(self):
+        """Обрабатывает остаток потока. Возвращает self для цепочки вызовов."""
+        total_frames = self._frames_done + len(self._pending_energy)
+        self.duration_ms = round(1000 * total_frames / self.frame_rate)
+        if self.duration_ms > self._ms_done:
+            # Кадры за пределами данных считаются нулевыми — так AudioSegment дополняет срез тишиной
+            bounds = self._ms_bounds(self._ms_done, self.duration_ms)
+            ms_energy = self._take_ms_values(bounds)
+            self._ms_done = self.duration_ms
+        else:
+            ms_energy = np.zeros(0, dtype=self._acc_dtype)
+        self._pending_energy = np.zeros(0, dtype=self._acc_dtype)
+        self._pending_peak = np.zeros(0, dtype=np.int64)
+        self._scan_windows(ms_energy, self.duration_ms - self.min_silence_len_ms)
+
+        self._add_to_envelope(np.zeros(0), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), flush=True)
+        self.envelope_rms = np.concatenate(self._envelope_rms) if self._envelope_rms else np.zeros(0, dtype=np.float32)
+        self.envelope_peak = np.concatenate(self._envelope_peak) if self._envelope_peak else np.zeros(0, dtype=np.int32)
+        self._envelope_rms = []
+        self._envelope_peak = []
+        return self
+
+    @property
+    def max_possible_amplitude(self):
+        return 2 ** (8 * self.sample_width) / 2
+
+    def overall_dbfs(self):
+        """(RMS, пик) всего прочитанного аудио в dBFS."""
+        if not self._total_samples or not self._total_energy:
+            rms_dbfs = float('-inf')
+        else:
+            rms_dbfs = ratio_to_db((self._total_energy / self._total_samples) ** 0.5 / self.max_possible_amplitude)
+        peak = self._total_peak
+        peak_dbfs = ratio_to_db(peak / self.max_possible_amplitude) if peak else float('-inf')
+        return rms_dbfs, peak_dbfs
+
+    def _scan_windows(self, ms_energy, last_start):
+        """Проверяет окна с началами [_next_start, last_start] и добавляет тихие в серии."""
+        energy = np.concatenate((self._ms_energy_tail, ms_energy))
+        first_start = self._next_start
+        window = self.min_silence_len_ms
+        if window <= 0 or last_start < first_start:
+            self._ms_energy_tail = energy
+            return
+
+        cumulative = np.concatenate(([0], np.cumsum(energy)))
+        count = last_start - first_start + 1
+        window_energy = (cumulative[window:window + count] - cumulative[:count]).astype(np.float64)
+        bounds = self._ms_bounds(first_start, last_start + window)
+        window_samples = (bounds[window:window + count] - bounds[:count]) * self.channels
+        with np.errstate(divide='ignore', invalid='ignore'):
+            # audioop.rms отбрасывает дробную часть корня
+            rms = np.floor(np.sqrt(np.where(window_samples > 0, window_energy / window_samples, 0.0)))
+        starts = np.flatnonzero(rms <= self._thresh) + first_start
+        self._add_silent_starts(starts)
+
+        self._next_start = last_start + 1
+        self._ms_energy_tail = energy[self._next_start - first_start:]
+
+    def _add_silent_starts(self, starts):
+        """Сворачивает отсортированные начала тихих окон в серии подряд идущих миллисекунд."""
+        if not len(starts):
+            return
+        breaks = np.flatnonzero(np.diff(starts) > 1)
+        runs_lo = starts[np.concatenate(([0], breaks + 1))].tolist()
+        runs_hi = starts[np.concatenate((breaks, [len(starts) - 1]))].tolist()
+        if self.runs_hi and runs_lo[0] == self.runs_hi[-1] + 1:
+            self.runs_hi[-1] = runs_hi.pop(0)
+            runs_lo.pop(0)
+        self.runs_lo.extend(runs_lo)
+        self.runs_hi.extend(runs_hi)
+
+    def silent_ranges(self):
+        """Интервалы тишины [start, end] в мс, как их возвращает detect_silence(seek_step=1)."""
+        if not self.runs_lo:
+            return []
+        runs_lo = np.array(self.runs_lo, dtype=np.int64)
+        runs_hi = np.array(self.runs_hi, dtype=np.int64)
+        # detect_silence объединяет окна, если следующее начинается не дальше min_silence_len от предыдущего
+        breaks = np.flatnonzero(runs_lo[1:] > runs_hi[:-1] + self.min_silence_len_ms)
+        range_starts = runs_lo[np.concatenate(([0], breaks + 1))]
+        range_ends = runs_hi[np.concatenate((breaks, [len(runs_hi) - 1]))] + self.min_silence_len_ms
+        return [[int(s), int(e)] for s, e in zip(range_starts, range_ends)]
+
+
+class SilenceIndex:
+    """
+    Индекс тишины всего файла: отсортированные серии начал тихих окон, построенные за один проход
+    SilenceScanner. Интервалы тишины в любом окне находятся бинарным поиском, без повторного анализа аудио.
+    """
+
+    def __init__(self, runs_lo, runs_hi, min_silence_len_ms, duration_ms):
+        self.runs_lo = runs_lo
+        self.runs_hi = runs_hi
+        self.min_silence_len_ms = min_silence_len_ms
+        self.duration_ms = duration_ms
+
+    @classmethod
+    def from_scanner(cls, scanner):
+        # Списки не копируются: в потоковом режиме индекс растет вместе со сканером
+        return cls(scanner.runs_lo, scanner.runs_hi, scanner.min_silence_len_ms, scanner.duration_ms)
+
+    def silences_between(self, start_ms, end_ms):
+        """
+        Интервалы тишины (start, end) в абсолютных мс, которые detect_silence нашел бы
+        в срезе audio[start_ms:end_ms] (с точностью ±1 мс): учитываются только окна, целиком лежащие в срезе.
+        """
+        # Окна индекса идут по сетке мс от начала файла. При частотах, не кратных 1000 Гц (44.1, 22.05,
+        # 11.025 кГц), граница мс в срезе попадает на другой сэмпл, чем та же мс от начала файла,
+        # поэтому окна среза сдвинуты на долю мс, и граница тишины может отличаться на 1 мс.
+        # Для выбора точки разреза это несущественно, а пересчет по сетке среза потребовал бы PCM.
+        window = self.min_silence_len_ms
+        last_start = min(end_ms, self.duration_ms) - window
+        if last_start < start_ms:
+            return []
+        first_run = bisect.bisect_left(self.runs_hi, start_ms)
+        end_run = bisect.bisect_right(self.runs_lo, last_start)
+        silences = []
+        prev_hi = None
+        for k in range(first_run, end_run):
+            lo = max(self.runs_lo[k], start_ms)
+            hi = min(self.runs_hi[k], last_start)
+            if prev_hi is not None and lo <= prev_hi + window:
+                silences[-1] = (silences[-1][0], hi + window)
+            else:
+                silences.append((lo, hi + window))
+            prev_hi = hi
+        return silences
+
+    def silence_stats(self):
+        """(число интервалов тишины, их суммарная длина в мс) по всему файлу."""
+        window = self.min_silence_len_ms
+        count = 0
+        total_ms = 0
+        prev_hi = None
+        for lo, hi in zip(self.runs_lo, self.runs_hi):
+            if prev_hi is not None and lo <= prev_hi + window:
+                total_ms += hi - prev_hi # Серия продолжает предыдущий интервал
+            else:
+                count += 1
+                total_ms += hi - lo + window
+            prev_hi = hi
+        return count, total_ms
+
+
+class AudioAnalysis:
+    """
+    Результат анализа одного файла: индекс тишины, огибающая RMS/пиков и общие уровни.
+    Не зависит от длительности кусков и окна поиска, поэтому хранится в AnalysisCache.
+    """
+
+    def __init__(self, silence_index, silence_thresh_db, frame_rate, channels, sample_width,
+                 envelope_rms, envelope_peak, original_rms, original_peak, envelope_step_ms=ENVELOPE_STEP_MS):
+        self.silence_index = silence_index
+        self.silence_thresh_db = silence_thresh_db
+        self.frame_rate = frame_rate
+        self.channels = channels
+        self.sample_width = sample_width
+        self.envelope_rms = envelope_rms
+        self.envelope_peak = envelope_peak
+        self.envelope_step_ms = envelope_step_ms
+        self.original_rms = original_rms
+        self.original_peak = original_peak
+
+    @property
+    def duration_ms(self):
+        return self.silence_index.duration_ms
+
+    @classmethod
+    def from_scanner(cls, scanner):
+        original_rms, original_peak = scanner.overall_dbfs()
+        silence_index = SilenceIndex.from_scanner(scanner)
+        silence_index.duration_ms = scanner.duration_ms
+        return cls(silence_index, scanner.silence_thresh_db, scanner.frame_rate, scanner.channels, scanner.sample_width,
+                   scanner.envelope_rms, scanner.envelope_peak, original_rms, original_peak)
+
+    def to_arrays(self):
+        """Словарь массивов для np.savez."""
+        return {
+            'runs_lo': np.array(self.silence_index.runs_lo, dtype=np.int64),
+            'runs_hi': np.array(self.silence_index.runs_hi, dtype=np.int64),
+            'envelope_rms': self.envelope_rms,
+            'envelope_peak': self.envelope_peak,
+            'params': np.array([self.silence_index.min_silence_len_ms, self.silence_index.duration_ms, self.frame_rate,
+                                self.channels, self.sample_width, self.envelope_step_ms], dtype=np.int64),
+            'levels': np.array([self.silence_thresh_db, self.original_rms, self.original_peak], dtype=np.float64),
+        }
+
+    @classmethod
+    def from_arrays(cls, data):
+        min_silence_len_ms, duration_ms, frame_rate, channels, sample_width, envelope_step_ms = (int(v) for v in data['params'])
+        silence_thresh_db, original_rms, original_peak = (float(v) for v in data['levels'])
+        silence_index = SilenceIndex(data['runs_lo'].tolist(), data['runs_hi'].tolist(), min_silence_len_ms, duration_ms)
+        return cls(silence_index, silence_thresh_db, frame_rate, channels, sample_width,
+                   data['envelope_rms'], data['envelope_peak'], original_rms, original_peak, envelope_step_ms)
+
+
+def analyze_audio_segment(audio_segment, silence_thresh_db, min_silence_len_ms, block_ms=STREAM_READ_BLOCK_MS):
+    """Анализирует загруженный в память AudioSegment за один проход блоками."""
+    scanner = SilenceScanner(audio_segment.frame_rate, audio_segment.channels, audio_segment.sample_width,
+                             min_silence_len_ms, silence_thresh_db)
+    raw_data = memoryview(audio_segment.raw_data)
+    block_bytes = max(1, int(block_ms * (audio_segment.frame_rate / 1000.0))) * audio_segment.frame_width
+    for offset in range(0, len(raw_data), block_bytes):
+        scanner.feed(raw_data[offset:offset + block_bytes])
+    return AudioAnalysis.from_scanner(scanner.finish())
+
+
+# Способ экспорта кусков: 'segment' — один ffmpeg на файл, 'chunks' — отдельный экспорт каждого куска
+EXPORT_MODES = ('segment', 'chunks')
+DEFAULT_EXPORT_MODE = 'segment'
+# Сколько PCM (МБ) могут занимать куски, ожидающие параллельного кодирования в режиме chunks
+DEFAULT_ENCODE_BUFFER_MB = 256
+# Предел --encode-workers по умолчанию: на машине с многими ядрами пул ffmpeg одного файла остается небольшим
+DEFAULT_MAX_ENCODE_WORKERS = 4
+# Режимы нормализации: пик каждого куска, пик всей книги, средняя громкость (RMS) всей книги
+NORMALIZE_MODES = ('peak-chunk', 'peak-book', 'rms-book')
+DEFAULT_NORMALIZE_MODE = 'peak-chunk'
+DEFAULT_NORM_RMS_DBFS = -20.0
+
+# Кэш анализа по умолчанию (относительно текущей папки, как source_mp3/ready_mp3)
+DEFAULT_CACHE_DIR = ".mp3_autocut_cache"
+DEFAULT_CACHE_MAX_MB = 512
+# Увеличивается при изменении формата записей кэша, старые записи просто перестают находиться
+ANALYSIS_CACHE_VERSION = 1
+
+def file_content_hash(filepath, block_size=1024 * 1024):
+    """SHA256 содержимого файла (читается блоками по 1 МБ)."""
+    sha256_hash = hashlib.sha256()
+    with open(filepath, "rb") as f:
+        for byte_block in iter(lambda: f.read(block_size), b""):
+            sha256_hash.update(byte_block)
+    return sha256_hash.hexdigest()
+
+
+class AnalysisCache:
+    """
+    Дисковый кэш AudioAnalysis. Ключ — хеш содержимого файла, порог и минимальная длина тишины,
+    поэтому повторный запуск с другими --duration/--window не анализирует аудио заново.
+    Размер ограничен: при превышении удаляются записи, к которым дольше всего не обращались (LRU).
+    """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_size_mb=DEFAULT_CACHE_MAX_MB):
+        self.cache_dir = cache_dir
+        self.max_size_bytes = int(max_size_mb * 1024 * 1024)
+
+    def make_key(self, input_file, silence_thresh_db, min_silence_len_ms, content_hash=None):
+        # Хеш может быть уже известен (индекс библиотеки), тогда файл не читается повторно
+        content_hash = content_hash or file_content_hash(input_file)
+        return f"{content_hash}_t{float(silence_thresh_db):g}_m{int(min_silence_len_ms)}_v{ANALYSIS_CACHE_VERSION}"
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + ".npz")
+
+    def load(self, key):
+        """Возвращает AudioAnalysis или None, если записи нет или она повреждена."""
+        path = self._path(key)
+        if not os.path.exists(path):
+            return None
+        try:
+            with np.load(path, allow_pickle=False) as data:
+                analysis = AudioAnalysis.from_arrays(data)
+            os.utime(path) # Отмечаем обращение для LRU
+            return analysis
+        except Exception as e:
+            print(f"  Предупреждение: Запись кэша анализа повреждена и будет удалена ({path}): {e}")
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return None
+
+    def store(self, key, analysis):
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            path = self._path(key)
+            tmp_path = path + ".tmp.npz"
+            np.savez_compressed(tmp_path, **analysis.to_arrays())
+            os.replace(tmp_path, path) # Атомарно: прерванная запись не оставит битую запись
+        except Exception as e:
+            print(f"  Предупреждение: Не удалось сохранить анализ в кэш ({self.cache_dir}): {e}")
+            return
+        self.evict()
+
+    def evict(self):
+        """Удаляет самые старые по обращению записи, пока кэш не уложится в лимит."""
+        try:
+            entries = []
+            for entry in os.scandir(self.cache_dir):
+                if entry.is_file() and entry.name.endswith(".npz"):
+                    st = entry.stat()
+                    entries.append((st.st_mtime, st.st_size, entry.path))
+        except OSError:
+            return
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_size <= self.max_size_bytes:
+                break
+            try:
+                os.remove(path)
+                total_size -= size
+            except OSError:
+                pass
+
+
+# Манифест обработки в корне выходной папки: какие куски получены из какого исходника и с какими параметрами
+PROCESSING_MANIFEST_NAME = ".mp3_autocut_manifest.json"
+PROCESSING_MANIFEST_VERSION = 1
+
+
+class ProcessingManifest:
+    """
+    Манифест выходной папки: для каждого исходного файла (по пути относительно входной папки) хранит
+    размер и mtime исходника, эффективные параметры нарезки и список кусков с их размерами.
+    Позволяет без декодирования решить, какие файлы актуальны, и найти устаревшие куски.
+    """
+
+    def __init__(self, output_root):
+        self.path = os.path.join(output_root, PROCESSING_MANIFEST_NAME)
+        self.output_root = output_root
+        self.entries = {}
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            if data.get('version') == PROCESSING_MANIFEST_VERSION:
+                self.entries = data.get('files', {})
+        except (OSError, ValueError) as e:
+            print(f"Предупреждение: Манифест {self.path} не прочитан ({e}), все файлы будут обработаны заново.")
+
+    @staticmethod
+    def source_signature(input_file):
+        st = os.stat(input_file)
+        return {'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+
+    def is_up_to_date(self, key, input_file, params):
+        """Актуальны ли куски файла: исходник и параметры не менялись, все куски на месте и нужного размера."""
+        entry = self.entries.get(key)
+        if not entry or entry.get('params') != params:
+            return False
+        try:
+            if entry.get('source') != self.source_signature(input_file):
+                return False
+        except OSError:
+            return False
+        for chunk in entry.get('chunks', []):
+            try:
+                if os.path.getsize(os.path.join(self.output_root, chunk['name'])) != chunk['size']:
+                    return False
+            except OSError:
+                return False
+        return bool(entry.get('chunks'))
+
+    def forget(self, key):
+        """Удаляет запись (файл будет обработан заново). Возвращает список кусков из старой записи."""
+        entry = self.entries.pop(key, None)
+        return [chunk['name'] for chunk in entry.get('chunks', [])] if entry else []
+
+    def record(self, key, input_file, params, output_files):
+        self.entries[key] = {
+            'source': self.source_signature(input_file),
+            'params': params,
+            'chunks': [{'name': os.path.relpath(path, self.output_root).replace(os.sep, "/"),
+                        'size': os.path.getsize(path)} for path in output_files if os.path.exists(path)],
+        }
+
+    def save(self):
+        try:
+            os.makedirs(self.output_root, exist_ok=True)
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({'version': PROCESSING_MANIFEST_VERSION, 'files': self.entries}, f, ensure_ascii=False, indent=1)
+            os.replace(tmp_path, self.path) # Атомарно: прерванная запись не портит манифест
+        except OSError as e:
+            print(f"Предупреждение: Не удалось сохранить манифест {self.path}: {e}")
+
+    def remove_orphaned_chunks(self, output_dir, base_filename, old_chunks, output_files):
+        """
+        Удаляет куски, которые больше не относятся к файлу: из старой записи манифеста и
+        файлы вида {base_filename}_NNN.mp3 в output_dir (например, после прерванного запуска).
+        Возвращает число удаленных файлов.
+        """
+        keep = {os.path.abspath(path) for path in output_files}
+        candidates = {os.path.abspath(os.path.join(self.output_root, name)) for name in old_chunks}
+        chunk_pattern = re.compile(re.escape(base_filename) + r"_\d{3,}\.mp3$")
+        try:
+            candidates.update(os.path.abspath(os.path.join(output_dir, name))
+                              for name in os.listdir(output_dir) if chunk_pattern.match(name))
+        except OSError:
+            pass
+        removed = 0
+        for path in sorted(candidates - keep):
+            try:
+                os.remove(path)
+                removed += 1
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                print(f"  Предупреждение: Не удалось удалить устаревший кусок {path}: {e}")
+        return removed
+
+
+# Версия формата контрольной точки нарезки
+CHUNK_CHECKPOINT_VERSION = 1
+# Суффикс куска, который еще пишется: в итоговое имя он переименовывается только целиком
+CHUNK_PART_SUFFIX = ".part"
+
+
+class ChunkCheckpoint:
+    """
+    Контрольная точка нарезки одного файла: какие куски (номер и границы) уже записаны целиком.
+    Куски пишутся во временный файл {кусок}.part и переименовываются после завершения, поэтому
+    после прерывания (кнопка «Стоп» в GUI, сбой) в выходной папке нет недописанных кусков,
+    а следующий запуск продолжает с первого незаписанного куска.
+    Точка действительна только для того же исходника (размер и mtime) и тех же параметров.
+    """
+
+    def __init__(self, output_dir, base_filename, input_file, params):
+        self.output_dir = output_dir
+        self.base_filename = base_filename
+        self.path = os.path.join(output_dir, f".{base_filename}.checkpoint.json")
+        self.source = ProcessingManifest.source_signature(input_file)
+        self.params = params
+        self.done = {} # номер куска -> [start_ms, end_ms]
+        data = None
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, "r", encoding="utf-8") as f:
+                    data = json.load(f)
+            except (OSError, ValueError):
+                data = None
+        if (data and data.get('version') == CHUNK_CHECKPOINT_VERSION and data.get('source') == self.source
+                and data.get('params') == params):
+            self.done = {int(index): points for index, points in data.get('done', {}).items()}
+        else:
+            # Точка от другого исходника или других параметров: ее куски будут перезаписаны
+            self._remove_leftovers()
+
+    def chunk_path(self, chunk_index):
+        return os.path.join(self.output_dir, f"{self.base_filename}_{chunk_index:03d}.mp3")
+
+    def part_path(self, chunk_index):
+        return self.chunk_path(chunk_index) + CHUNK_PART_SUFFIX
+
+    def segment_list_path(self, start_number):
+        """CSV-список готовых сегментов, который ffmpeg дописывает после закрытия каждого куска."""
+        return os.path.join(self.output_dir, f".{self.base_filename}.segments_{start_number:03d}.csv")
+
+    def is_done(self, chunk_index, start_ms, end_ms):
+        return self.done.get(chunk_index) == [start_ms, end_ms] and os.path.exists(self.chunk_path(chunk_index))
+
+    def commit(self, chunk_index, start_ms, end_ms, part_path=None):
+        """Переименовывает готовый временный файл в итоговый кусок и записывает контрольную точку."""
+        if part_path:
+            os.replace(part_path, self.chunk_path(chunk_index))
+        self.done[chunk_index] = [start_ms, end_ms]
+        self.save()
+
+    def recover_segments(self, split_points, keep_lists=False):
+        """
+        Принимает куски, которые ffmpeg (segment muxer) успел полностью записать до прерывания:
+        они перечислены в его списках сегментов, а их .part файлы еще не переименованы.
+        keep_lists=True — опрос во время работы ffmpeg: списки остаются, ffmpeg продолжает их дописывать.
+        """
+        chunk_pattern = re.compile(r"_(\d{3,})\.mp3" + re.escape(CHUNK_PART_SUFFIX) + "$")
+        for list_path in self._segment_lists():
+            try:
+                with open(list_path, "r", encoding="utf-8", newline="") as f:
+                    rows = list(csv.reader(f))
+            except OSError:
+                continue
+            for row in rows:
+                match = chunk_pattern.search(row[0]) if row else None
+                if not match:
+                    continue
+                chunk_index = int(match.group(1))
+                part_path = self.part_path(chunk_index)
+                if 1 <= chunk_index <= len(split_points) and os.path.exists(part_path):
+                    self.commit(chunk_index, *split_points[chunk_index - 1], part_path=part_path)
+            if not keep_lists:
+                os.remove(list_path)
+
+    def save(self):
+        data = {'version': CHUNK_CHECKPOINT_VERSION, 'source': self.source, 'params': self.params,
+                'done': {str(index): points for index, points in sorted(self.done.items())}}
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f)
+        os.replace(tmp_path, self.path)
+
+    def finish(self):
+        """Файл нарезан полностью: контрольная точка и временные файлы больше не нужны."""
+        self._remove_leftovers()
+
+    def _segment_lists(self):
+        prefix = f".{self.base_filename}.segments_"
+        try:
+            return sorted(os.path.join(self.output_dir, name) for name in os.listdir(self.output_dir)
+                          if name.startswith(prefix) and name.endswith(".csv"))
+        except OSError:
+            return []
+
+    def _remove_leftovers(self):
+        part_pattern = re.compile(re.escape(self.base_filename) + r"_\d{3,}\.mp3" + re.escape(CHUNK_PART_SUFFIX) + "$")
+        try:
+            names = os.listdir(self.output_dir)
+        except OSError:
+            names = []
+        leftovers = [os.path.join(self.output_dir, name) for name in names if part_pattern.match(name)]
+        leftovers += self._segment_lists() + [self.path]
+        for path in leftovers:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                print(f"  Предупреждение: Не удалось удалить {path}: {e}")
+        self.done = {}
+
+
+# Индекс библиотеки исходных файлов (в папке кэша)
+LIBRARY_INDEX_NAME = "library.sqlite3"
+
+
+def scan_mp3_files(root_dir):
+    """
+    Рекурсивно находит MP3 файлы через os.scandir (размер и mtime берутся при том же обходе).
+    Возвращает список (путь, размер, mtime_ns), отсортированный по пути.
+    """
+    found = []
+    directories = [root_dir]
+    while directories:
+        directory = directories.pop()
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    # Как os.walk по умолчанию: по символическим ссылкам на папки не переходим
+                    if entry.is_dir(follow_symlinks=False):
+                        directories.append(entry.path)
+                    elif entry.name.lower().endswith('.mp3') and entry.is_file():
+                        st = entry.stat()
+                        found.append((entry.path, st.st_size, st.st_mtime_ns))
+        except OSError as e:
+            print(f"Предупреждение: Не удалось прочитать папку {directory}: {e}")
+    found.sort()
+    return found
+
+
+class LibraryIndex:
+    """
+    Постоянный индекс исходных файлов в SQLite: путь, размер, mtime, длительность, хеш содержимого
+    и статистика тишины. Обновляется инкрементально: производные поля сбрасываются только у файлов,
+    у которых изменились размер или mtime, поэтому длительности и хеши не вычисляются каждый запуск.
+    """
+
+    def __init__(self, db_path):
+        if db_path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self.connection = sqlite3.connect(db_path)
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                duration_ms INTEGER,
+                content_hash TEXT,
+                silence_thresh_db REAL,
+                min_silence_ms INTEGER,
+                silence_count INTEGER,
+                silence_total_ms INTEGER,
+                rms_dbfs REAL,
+                peak_dbfs REAL
+            )""")
+        self.connection.commit()
+
+    def refresh(self, root_dir, scanned):
+        """
+        Сверяет индекс с результатом scan_mp3_files(root_dir). Возвращает (новых или измененных, удаленных).
+        """
+        root_prefix = os.path.join(os.path.abspath(root_dir), "")
+        known = {path: (size, mtime_ns) for path, size, mtime_ns in
+                 self.connection.execute("SELECT path, size, mtime_ns FROM files")
+                 if path.startswith(root_prefix)}
+        changed = []
+        seen = set()
+        for path, size, mtime_ns in scanned:
+            path = os.path.abspath(path)
+            seen.add(path)
+            if known.get(path) != (size, mtime_ns):
+                changed.append((path, size, mtime_ns))
+        removed = [(path,) for path in known if path not in seen]
+        with self.connection:
+            # INSERT OR REPLACE сбрасывает производные поля измененного файла
+            self.connection.executemany("INSERT OR REPLACE INTO files (path, size, mtime_ns) VALUES (?, ?, ?)", changed)
+            self.connection.executemany("DELETE FROM files WHERE path = ?", removed)
+        return len(changed), len(removed)
+
+    def get(self, path, column):
+        row = self.connection.execute(f"SELECT {column} FROM files WHERE path = ?", (os.path.abspath(path),)).fetchone()
+        return row[0] if row else None
+
+    def durations(self, paths):
+        """Словарь путь -> длительность в мс (None, если еще не известна)."""
+        known = dict(self.connection.execute("SELECT path, duration_ms FROM files"))
+        return {path: known.get(os.path.abspath(path)) for path in paths}
+
+    def set_durations(self, durations):
+        with self.connection:
+            self.connection.executemany("UPDATE files SET duration_ms = ? WHERE path = ?",
+                                        [(duration, os.path.abspath(path)) for path, duration in durations.items()])
+
+    def levels(self, paths):
+        """Словарь путь -> (длительность в мс, RMS, пик в dBFS) или None, если уровни файла еще не известны."""
+        rows = self.connection.execute("SELECT path, duration_ms, rms_dbfs, peak_dbfs FROM files"
+                                       " WHERE duration_ms IS NOT NULL AND rms_dbfs IS NOT NULL AND peak_dbfs IS NOT NULL")
+        known = {path: (duration_ms, rms_dbfs, peak_dbfs) for path, duration_ms, rms_dbfs, peak_dbfs in rows}
+        return {path: known.get(os.path.abspath(path)) for path in paths}
+
+    def set_levels(self, path, duration_ms, rms_dbfs, peak_dbfs, content_hash=None):
+        with self.connection:
+            self.connection.execute(
+                "UPDATE files SET duration_ms = ?, rms_dbfs = ?, peak_dbfs = ?, content_hash = COALESCE(?, content_hash)"
+                " WHERE path = ?", (duration_ms, rms_dbfs, peak_dbfs, content_hash, os.path.abspath(path)))
+
+    def record_processing(self, path, stats, silence_thresh_db, min_silence_len_ms):
+        """Сохраняет то, что стало известно при обработке файла: хеш, длительность, уровни и статистику тишины."""
+        with self.connection:
+            self.connection.execute(
+                "UPDATE files SET content_hash = COALESCE(?, content_hash), duration_ms = ?, silence_thresh_db = ?,"
+                " min_silence_ms = ?, silence_count = ?, silence_total_ms = ?, rms_dbfs = ?, peak_dbfs = ? WHERE path = ?",
+                (stats.get('content_hash'), stats['original_duration_ms'], silence_thresh_db, min_silence_len_ms,
+                 stats.get('silence_count'), stats.get('silence_total_ms'), stats.get('original_rms'),
+                 stats.get('original_peak'), os.path.abspath(path)))
+
+    def close(self):
+        self.connection.close()
+
+
+# Режим наблюдения за папкой (--watch)
+DEFAULT_WATCH_INTERVAL_S = 5
+DEFAULT_WATCH_SETTLE_S = 10
+# События inotify, после которых папка пересканируется: запись, закрытие, перемещение, создание, удаление
+_INOTIFY_MASK = 0x2 | 0x8 | 0x40 | 0x80 | 0x100 | 0x200
+_INOTIFY_NONBLOCK = 0o4000
+_INOTIFY_CLOEXEC = 0o2000000
+_INOTIFY_IGNORED = 0x8000  # подписка снята ядром (папка удалена или файловая система отмонтирована)
+_INOTIFY_EVENT_HEADER = struct.Struct("iIII")  # wd, mask, cookie, len (за ним имя длиной len)
+
+
+class FolderWatcher:
+    """
+    Следит за папкой с исходниками и возвращает MP3 файлы, которые появились или изменились
+    и перестали меняться (размер и mtime не менялись settle_s секунд), то есть докопированы.
+    На Linux ждет событий inotify, иначе (или если inotify недоступен) опрашивает папку раз в interval_s секунд.
+    """
+
+    def __init__(self, root_dir, interval_s=DEFAULT_WATCH_INTERVAL_S, settle_s=DEFAULT_WATCH_SETTLE_S):
+        self.root_dir = root_dir
+        self.interval_s = interval_s
+        self.settle_s = settle_s
+        self.known = {}    # путь -> (размер, mtime_ns) уже обработанной версии
+        self.pending = {}  # путь -> ((размер, mtime_ns), время, с которого подпись не меняется)
+        self._inotify_fd = None
+        self._watched_dirs = {}  # путь папки -> дескриптор подписки inotify
+        if sys.platform.startswith("linux"):
+            try:
+                self._libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+                fd = self._libc.inotify_init1(_INOTIFY_NONBLOCK | _INOTIFY_CLOEXEC)
+                if fd < 0:
+                    raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+                self._inotify_fd = fd
+            except (OSError, AttributeError) as e:
+                print(f"Предупреждение: inotify недоступен ({e}), папка будет опрашиваться каждые {interval_s} с.")
+
+    @property
+    def uses_inotify(self):
+        return self._inotify_fd is not None
+
+    def mark_processed(self, scanned):
+        """Запоминает версии файлов из scan_mp3_files(), которые уже обработаны (или учтены) последним проходом."""
+        for path, size, mtime_ns in scanned:
+            self.known[path] = (size, mtime_ns)
+            self.pending.pop(path, None)
+
+    def _watch_directories(self):
+        # Новые подпапки (например, новая книга) тоже нужно слушать; повторная подписка на папку ничего не стоит
+        directories = [self.root_dir]
+        while directories:
+            directory = directories.pop()
+            if directory not in self._watched_dirs:
+                wd = self._libc.inotify_add_watch(self._inotify_fd, os.fsencode(directory), _INOTIFY_MASK)
+                if wd >= 0:
+                    self._watched_dirs[directory] = wd
+            try:
+                with os.scandir(directory) as entries:
+                    directories.extend(entry.path for entry in entries if entry.is_dir(follow_symlinks=False))
+            except OSError:
+                pass
+
+    def _wait_for_event(self, timeout_s):
+        if self._inotify_fd is None:
+            time.sleep(timeout_s)
+            return
+        readable, _, _ = select.select([self._inotify_fd], [], [], timeout_s)
+        if readable:
+            # Какие именно файлы изменились, не важно (папка все равно сканируется заново),
+            # но снятые подписки нужно забыть: иначе удаленная и заново созданная папка больше не слушается
+            try:
+                while True:
+                    data = os.read(self._inotify_fd, 65536)
+                    if not data:
+                        break
+                    self._forget_ignored_watches(data)
+            except BlockingIOError:
+                pass
+
+    def _forget_ignored_watches(self, data):
+        ignored = set()
+        offset = 0
+        while offset + _INOTIFY_EVENT_HEADER.size <= len(data):
+            wd, mask, _, name_len = _INOTIFY_EVENT_HEADER.unpack_from(data, offset)
+            if mask & _INOTIFY_IGNORED:
+                ignored.add(wd)
+            offset += _INOTIFY_EVENT_HEADER.size + name_len
+        if ignored:
+            # Папку могли уже пересоздать и подписаться на нее заново с другим дескриптором — ее не трогаем
+            for directory in [d for d, wd in self._watched_dirs.items() if wd in ignored]:
+                del self._watched_dirs[directory]
+
+    def wait_for_changes(self):
+        """
+        Блокируется, пока не появятся стабильные новые или измененные MP3 файлы.
+        Возвращает (результат scan_mp3_files всей папки, множество готовых к обработке путей).
+        """
+        while True:
+            if self._inotify_fd is not None:
+                self._watch_directories()
+            scanned = scan_mp3_files(self.root_dir)
+            now = time.monotonic()
+            ready = set()
+            current_paths = set()
+            for path, size, mtime_ns in scanned:
+                current_paths.add(path)
+                signature = (size, mtime_ns)
+                if self.known.get(path) == signature:
+                    self.pending.pop(path, None)
+                    continue
+                pending = self.pending.get(path)
+                if pending is None or pending[0] != signature:
+                    self.pending[path] = (signature, now)
+                elif now - pending[1] >= self.settle_s:
+                    ready.add(path)
+            for path in list(self.pending):
+                if path not in current_paths:
+                    del self.pending[path]
+            for path in [path for path in self.known if path not in current_paths]:
+                del self.known[path]
+            if ready:
+                return scanned, ready
+            if self.pending:
+                # Файл еще копируется: проверяем снова, когда истечет время стабилизации
+                oldest = min(since for _, since in self.pending.values())
+                timeout_s = max(0.5, min(self.interval_s, oldest + self.settle_s - now))
+            else:
+                timeout_s = self.interval_s if self._inotify_fd is None else None
+            self._wait_for_event(timeout_s)
+
+    def close(self):
+        if self._inotify_fd is not None:
+            os.close(self._inotify_fd)
+            self._inotify_fd = None
+
+
+def is_service_file(filename):
+    """Служебный файл выходной папки (манифест, контрольная точка, недописанный кусок), а не результат."""
+    return (filename == PROCESSING_MANIFEST_NAME or filename.endswith(CHUNK_PART_SUFFIX)
+            or (filename.startswith(".") and filename.endswith((".checkpoint.json", ".csv", ".tmp"))))
+
+
+def find_silent_split_point(silence_index, target_time_ms, search_window_ms):
     """
     Ищет точку разделения в тишине в заданном окне вокруг целевого времени.
+    Интервалы тишины берутся из индекса всего файла (бинарный поиск), аудио повторно не анализируется.
     Возвращает время (в мс) для разделения или None, если тишина не найдена.
     """
+    total_duration_ms = silence_index.duration_ms
     start_search = max(0, target_time_ms - search_window_ms // 2)
-    end_search = min(len(audio_segment), target_time_ms + search_window_ms // 2)
+    end_search = min(total_duration_ms, target_time_ms + search_window_ms // 2)
 
     # Add check for valid search window relative to segment length
-    if start_search >= end_search or start_search >= len(audio_segment):
-         print(f"    Debug: Invalid search window [{start_search}, {end_search}] for segment length {len(audio_segment)} around {target_time_ms}ms")
+    if start_search >= end_search or start_search >= total_duration_ms:
+         print(f"    Debug: Invalid search window [{start_search}, {end_search}] for segment length {total_duration_ms} around {target_time_ms}ms")
          return None # Окно поиска некорректно или за пределами аудио
 
-    search_area = audio_segment[start_search:end_search]
-
-    # Add a check for empty search area which can cause errors
-    if len(search_area) == 0:
-        print(f"    Debug: Empty search area created for window [{start_search}, {end_search}]")
-        return None
-
-    try:
-        # Use a slightly larger seek_step if performance is an issue, but 1 is most accurate
-        silences = detect_silence(
-            search_area,
-            min_silence_len=min_silence_len_ms,
-            silence_thresh=silence_thresh_db,
-            seek_step=1 # Check every ms for finer granularity
-        )
-    except Exception as e:
-         print(f"    Error detecting silence in window [{start_search}, {end_search}]: {e}")
-         return None # Error during silence detection
+    absolute_silences = silence_index.silences_between(start_search, end_search)
 
-
-    if not silences:
-        # print(f"    Debug: No silence found in window [{start_search}, {end_search}] with threshold {silence_thresh_db}dB and min_len {min_silence_len_ms}ms")
+    if not absolute_silences:
+        # print(f"    Debug: No silence found in window [{start_search}, {end_search}]")
         return None # Тишина не найдена в окне
 
-    # Конвертируем время тишины относительно search_area в абсолютное время
-    absolute_silences = [(s + start_search, e + start_search) for s, e in silences]
-
     # Ищем тишину, середина которой ближе всего к target_time_ms
     best_silence = min(
         absolute_silences,
@@ -90,31 +1170,76 @@ def find_silent_split_point(audio_segment, target_time_ms, search_window_ms, sil
     return split_time
 
 
-def split_mp3(input_file, output_dir, target_chunk_duration_s=100, search_window_s=10, silence_thresh_db=-40, min_silence_len_ms=500, speed_factor=1.0, target_normalization_dbfs=-0.1, enable_normalization=False):
+def split_mp3(input_file, output_dir, target_chunk_duration_s=100, search_window_s=10, silence_thresh_db=-40, min_silence_len_ms=500, speed_factor=1.0, target_normalization_dbfs=-0.1, enable_normalization=False, streaming=False, analysis_cache=None, export_mode=DEFAULT_EXPORT_MODE, lossless_cut=False, intro_file=None, encode_workers=1, encode_buffer_mb=DEFAULT_ENCODE_BUFFER_MB, content_hash=None, book_gain_db=None, on_chunk_ready=None):
     """
     Разделяет ОДИН MP3 файл на части по ~target_chunk_duration_s, стараясь резать по тишине.
     Сохраняет части в указанную output_dir, опционально изменяя скорость и нормализуя громкость.
+    При streaming=True файл декодируется потоково (PcmStreamReader), и в памяти держится
+    только текущий кусок и окно поиска тишины.
+    Если передан analysis_cache (AnalysisCache), анализ тишины берется из кэша или сохраняется в него.
+    export_mode='segment' сначала вычисляет все точки разреза, а затем кодирует все куски одним
+    вызовом ffmpeg (segment muxer); 'chunks' экспортирует каждый кусок отдельно через pydub.
+    lossless_cut=True режет исходный MP3 по границам кадров без перекодирования
+    (только при speed_factor == 1.0 и выключенной нормализации).
+    intro_file (например, WAV с TTS сообщением) ставится в начало первого куска до его кодирования,
+    без изменения скорости и громкости; в статистику кусков вступление не входит.
+    encode_workers > 1 кодирует куски параллельно (в режиме chunks PCM ожидающих кусков ограничен encode_buffer_mb).
+    content_hash — уже известный SHA256 файла (из индекса библиотеки) для ключа кэша анализа.
+    book_gain_db — общее усиление нормализации для всей книги (--normalize-mode peak-book/rms-book);
+    если не задано, пик каждого куска нормализуется отдельно.
+    on_chunk_ready(путь) вызывается для каждого готового куска (например, для копирования на устройство
+    во время нарезки, см. DeviceCopier).
     Возвращает словарь со статистикой обработки или None при ошибке.
     """
     if not os.path.exists(input_file):
         print(f"Ошибка: Файл не найден - {input_file}")
         return None
 
-    # Validate speed factor
-    if not (0.5 <= speed_factor <= 10.0): # Allow up to 10x, but atempo works best 0.5-2.0, chaining needed > 2.0
-         print(f"Предупреждение: Коэффициент скорости {speed_factor} находится вне рекомендуемого диапазона (0.5-2.0) для фильтра atempo. Результат может быть неидеальным или ffmpeg может выдать ошибку для очень больших значений.")
-         # For speeds > 2.0, ffmpeg needs chained atempo filters. Pydub might not handle this directly via parameters.
-         # Example for 3x speed: -filter:a atempo=2.0,atempo=1.5
-         # We'll try passing it directly, ffmpeg might handle simple cases > 2.0 or fail.
-         if speed_factor <= 0:
-             print(f"Ошибка: Коэффициент скорости должен быть положительным.")
-             return None
+    # Validate speed factor: любые значения диапазона раскладываются в цепочку atempo (plan_atempo_chain)
+    if not (MIN_SPEED_FACTOR <= speed_factor <= MAX_SPEED_FACTOR):
+        print(f"Ошибка: Коэффициент скорости {speed_factor} вне допустимого диапазона ({MIN_SPEED_FACTOR}-{MAX_SPEED_FACTOR}).")
+        return None
+    tempo = effective_speed(speed_factor)
 
 
     print(f"🎵 --- Обработка файла: {input_file} (Скорость: {speed_factor}x) ---")
+    analysis = None
+    cache_key = None
+    if analysis_cache:
+        try:
+            content_hash = content_hash or file_content_hash(input_file)
+            cache_key = analysis_cache.make_key(input_file, silence_thresh_db, min_silence_len_ms, content_hash=content_hash)
+            analysis = analysis_cache.load(cache_key)
+        except OSError as e:
+            print(f"  Предупреждение: Кэш анализа недоступен для {input_file}: {e}")
+        if analysis:
+            print(f"  Анализ тишины загружен из кэша (длительность: {analysis.duration_ms/1000:.2f}s).")
+
+    if lossless_cut and (speed_factor != 1.0 or enable_normalization):
+        print(f"  Предупреждение: Нарезка без перекодирования невозможна при изменении скорости или нормализации. Куски будут перекодированы.")
+        lossless_cut = False
+    # Нормализация — это усиление в фильтре кодировщика, поэтому segment muxer ее поддерживает
+    use_segment_export = export_mode == 'segment' and not lossless_cut
+    # Для обоих режимов PCM нужен только для анализа тишины
+    analysis_only = use_segment_export or lossless_cut
+
     print(f"  Загрузка...")
     try:
-        audio = AudioSegment.from_mp3(input_file)
+        if analysis_only:
+            # PCM для экспорта не нужен: при необходимости файл один раз анализируется потоково
+            audio = None
+            if not analysis:
+                print(f"  Анализ тишины (потоковое декодирование)...")
+                analysis = analyze_audio_file(input_file, silence_thresh_db, min_silence_len_ms)
+                print(f"  Анализ готов: {len(analysis.silence_index.runs_lo)} тихих участков.")
+                if analysis_cache and cache_key:
+                    analysis_cache.store(cache_key, analysis)
+        elif streaming:
+            # Если анализ уже есть в кэше, поток нужен только для извлечения кусков
+            scanner_params = None if analysis else (silence_thresh_db, min_silence_len_ms)
+            audio = PcmStreamReader(input_file, silence_scanner_params=scanner_params)
+        else:
+            audio = AudioSegment.from_mp3(input_file)
     except CouldntDecodeError: # More specific error catch
          print(f"  Ошибка: Не удалось декодировать файл: {input_file}. Возможно, он поврежден или не является MP3.")
          return None
@@ -126,20 +1251,36 @@ def split_mp3(input_file, output_dir, target_chunk_duration_s=100, search_window
         print("  Убедись, что ffmpeg или libav установлены и доступны в PATH.")
         return None
 
-    print(f"  Файл загружен (длительность: {len(audio)/1000:.2f}s).")
-    total_duration_ms = len(audio)
+    if analysis_only:
+        print(f"  Длительность: {analysis.duration_ms/1000:.2f}s.")
+    elif streaming:
+        print(f"  Файл открыт в потоковом режиме (оценка длительности: {len(audio)/1000:.2f}s).")
+    else:
+        print(f"  Файл загружен (длительность: {len(audio)/1000:.2f}s).")
+    if not analysis and not streaming:
+        print(f"  Анализ тишины...")
+        analysis = analyze_audio_segment(audio, silence_thresh_db, min_silence_len_ms)
+        print(f"  Анализ готов: {len(analysis.silence_index.runs_lo)} тихих участков.")
+        if analysis_cache and cache_key:
+            analysis_cache.store(cache_key, analysis)
+    total_duration_ms = analysis.duration_ms if analysis else len(audio)
     target_chunk_duration_ms = target_chunk_duration_s * 1000
     search_window_ms = search_window_s * 1000
     
     # Инициализация статистики
     import time
     start_time = time.time()
-    original_rms = audio.dBFS
-    original_peak = audio.max_dBFS
+    if analysis:
+        original_rms = analysis.original_rms
+        original_peak = analysis.original_peak
+    else:
+        # В потоковом режиме уровни всего файла известны только после его полного чтения
+        original_rms = None
+        original_peak = None
     
     stats = {
         'original_duration_ms': total_duration_ms,
-        'target_duration_ms': total_duration_ms / speed_factor,  # После ускорения
+        'target_duration_ms': total_duration_ms / tempo,  # После ускорения (точная скорость цепочки atempo)
         'original_rms': original_rms,
         'original_peak': original_peak,
         'chunks_count': 0,
@@ -148,7 +1289,9 @@ def split_mp3(input_file, output_dir, target_chunk_duration_s=100, search_window
         'peak_values': [],
         'speed_factor': speed_factor,
         'enable_normalization': enable_normalization,
-        'processing_time_sec': 0
+        'processing_time_sec': 0,
+        'output_files': [],
+        'content_hash': content_hash
     }
 
     if not os.path.exists(output_dir):
@@ -159,10 +1302,876 @@ def split_mp3(input_file, output_dir, target_chunk_duration_s=100, search_window
              print(f"  Ошибка создания директории {output_dir}: {e}")
              return None
 
+    # Контрольная точка: при повторном запуске после прерывания уже записанные куски не кодируются заново
+    checkpoint_params = {
+        'duration_s': target_chunk_duration_s,
+        'window_s': search_window_s,
+        'threshold_db': silence_thresh_db,
+        'min_silence_ms': min_silence_len_ms,
+        'speed': speed_factor,
+        'normalization': target_normalization_dbfs if enable_normalization else None,
+        'book_gain_db': round(book_gain_db, 2) if enable_normalization and book_gain_db is not None else None,
+        'lossless_cut': lossless_cut,
+        'intro': bool(intro_file),
+    }
+    try:
+        checkpoint = ChunkCheckpoint(output_dir, os.path.splitext(os.path.basename(input_file))[0], input_file,
+                                     checkpoint_params)
+    except OSError as e:
+        print(f"  Предупреждение: Контрольная точка недоступна ({e}), продолжение без нее.")
+        checkpoint = None
+
+    if analysis:
+        silence_index = analysis.silence_index
+    else:
+        # Индекс достраивается по мере чтения потока (см. prefetch в _split_audio_into_chunks)
+        silence_index = SilenceIndex.from_scanner(audio.silence_scanner)
+        silence_index.duration_ms = len(audio)
+
+    if not enable_normalization:
+        book_gain_db = None
+    elif book_gain_db is not None:
+        print(f"  Нормализация по всей книге: усиление {book_gain_db:+.2f} dB для всех кусков.")
+
+    if analysis_only:
+        split_points = plan_split_points(silence_index, target_chunk_duration_ms, search_window_ms, min_silence_len_ms)
+        if lossless_cut:
+            exported = _export_lossless(input_file, output_dir, split_points, analysis, stats, min_silence_len_ms,
+                                        intro_file=intro_file, checkpoint=checkpoint, on_chunk_ready=on_chunk_ready)
+        else:
+            intro = load_intro_audio(intro_file) if intro_file else None
+            exported = _export_segments(input_file, output_dir, split_points, analysis, stats, speed_factor,
+                                        normalization_dbfs=target_normalization_dbfs if enable_normalization else None,
+                                        book_gain_db=book_gain_db,
+                                        intro_file=intro_file if intro else None,
+                                        intro_ms=len(intro) if intro else 0,
+                                        encode_workers=encode_workers, checkpoint=checkpoint,
+                                        on_chunk_ready=on_chunk_ready)
+        if not exported:
+            return None
+    else:
+        try:
+            intro = load_intro_audio(intro_file) if intro_file else None
+            _split_audio_into_chunks(audio, silence_index, input_file, output_dir, stats, target_chunk_duration_ms, search_window_ms,
+                                     min_silence_len_ms, speed_factor,
+                                     target_normalization_dbfs, enable_normalization, streaming, intro,
+                                     encode_workers=encode_workers, encode_buffer_mb=encode_buffer_mb,
+                                     checkpoint=checkpoint, analysis=analysis, book_gain_db=book_gain_db,
+                                     on_chunk_ready=on_chunk_ready)
+        except CouldntDecodeError as e:
+            # Файл не дочитан до конца: куски не фиксируются, и файл не считается обработанным
+            print(f"  Ошибка: Не удалось декодировать файл: {input_file} ({e}).")
+            return None
+        finally:
+            if streaming:
+                audio.close()
+    if checkpoint:
+        checkpoint.finish()
+
+    if not analysis and audio.silence_scanner.duration_ms is not None:
+        # Потоковый проход дочитал файл до конца: анализ готов и может быть сохранен в кэш
+        analysis = AudioAnalysis.from_scanner(audio.silence_scanner)
+        stats['original_duration_ms'] = analysis.duration_ms
+        stats['target_duration_ms'] = analysis.duration_ms / tempo
+        stats['original_rms'] = analysis.original_rms
+        stats['original_peak'] = analysis.original_peak
+        if analysis_cache and cache_key:
+            analysis_cache.store(cache_key, analysis)
+
+    if analysis:
+        # Для индекса библиотеки
+        stats['silence_count'], stats['silence_total_ms'] = analysis.silence_index.silence_stats()
 
+    # Завершаем сбор статистики
+    stats['processing_time_sec'] = time.time() - start_time
+    
+    # Вычисляем средние значения громкости
+    if stats['rms_values']:
+        stats['avg_final_rms'] = sum(stats['rms_values']) / len(stats['rms_values'])
+        stats['avg_final_peak'] = sum(stats['peak_values']) / len(stats['peak_values'])
+    else:
+        stats['avg_final_rms'] = 0
+        stats['avg_final_peak'] = 0
+
+    print(f"--- Обработка файла {input_file} завершена ---")
+    print("═══════════════════════════════════════════════════════════")
+    
+    return stats
+
+
+# Длина кадра (в сэмплах), по которому переключается покусковое усиление. Декодер MP3 отдает кадры по 1152
+# сэмпла (~26 мс), и без дробления речь у разреза не в тишине получала бы до кадра чужого усиления
+VOLUME_SWITCH_SAMPLES = 64
+
+
+def volume_filter(gains_db, boundaries_ms=()):
+    """
+    Фильтр ffmpeg volume, который применяет усиление нормализации при кодировании (None, если усиление не нужно).
+    gains_db — усиление идущих подряд кусков, boundaries_ms — границы между ними от начала входа фильтра.
+    Разное усиление кусков задается кусочно-постоянным выражением от времени кадра (eval=frame);
+    кадры предварительно дробятся до VOLUME_SWITCH_SAMPLES сэмплов, чтобы усиление менялось почти точно на границе.
+    """
+    if not any(gains_db):
+        return None
+    if len(set(gains_db)) == 1:
+        return f"volume={gains_db[0]:.4f}dB"
+    terms = []
+    for i, gain in enumerate(gains_db):
+        # Сумма, а не вложенные if(): глубина вложенности выражений ffmpeg ограничена
+        factors = [f"{db_to_float(gain):.8g}"]
+        if i > 0:
+            factors.append(f"gte(t,{boundaries_ms[i - 1] / 1000:.6f})")
+        if i < len(gains_db) - 1:
+            factors.append(f"lt(t,{boundaries_ms[i] / 1000:.6f})")
+        terms.append("*".join(factors))
+    # Время отсчитывается от начала входа фильтра, даже если у потока ненулевое начальное время
+    return (f"asetpts=PTS-STARTPTS,asetnsamples=n={VOLUME_SWITCH_SAMPLES}:p=0,"
+            f"volume='{'+'.join(terms)}':eval=frame")
+
+
+# Допустимые коэффициенты скорости и диапазон одного фильтра atempo, который поддерживают все версии ffmpeg
+MIN_SPEED_FACTOR = 0.5
+MAX_SPEED_FACTOR = 10.0
+_ATEMPO_MIN = 0.5
+_ATEMPO_MAX = 2.0
+
+
+def plan_atempo_chain(speed_factor):
+    """
+    Раскладывает коэффициент скорости на цепочку фильтров atempo, каждый из которых в диапазоне [0.5, 2.0].
+    Множители одинаковые (например, 3.0 = 1.732 × 1.732), так искажения делятся между звеньями поровну.
+    Возвращает список множителей в том виде, в каком они попадут в фильтр (пустой для скорости 1.0).
+    """
+    if speed_factor == 1.0:
+        return []
+    ratio = speed_factor if speed_factor > 1.0 else 1.0 / speed_factor
+    # Небольшой допуск, чтобы ровно 4.0 не превратилось в три звена из-за погрешности логарифма
+    stages = max(1, math.ceil(math.log(ratio) / math.log(_ATEMPO_MAX) - 1e-9))
+    factor = speed_factor ** (1.0 / stages)
+    return [f"{factor:.10g}"] * stages
+
+
+def effective_speed(speed_factor):
+    """Точная итоговая скорость цепочки atempo (произведение множителей ровно в том виде, как они записаны в фильтр)."""
+    speed = 1.0
+    for factor in plan_atempo_chain(speed_factor):
+        speed *= float(factor)
+    return speed
+
+
+def validate_tempo_filter(speed_factor):
+    """
+    Один раз за запуск проверяет, что ffmpeg принимает цепочку atempo для этой скорости,
+    прогоняя через нее долю секунды сгенерированной тишины. Возвращает текст ошибки или None.
+    """
+    audio_filter = build_audio_filter(speed_factor)
+    if not audio_filter:
+        return None
+    command = [AudioSegment.converter, "-v", "error", "-f", "lavfi", "-i", "anullsrc=r=44100:cl=stereo",
+               "-t", "0.1", "-filter:a", audio_filter, "-f", "null", "-"]
+    try:
+        result = run_child_process(command)
+    except OSError as e:
+        return str(e)
+    if result.returncode != 0:
+        return result.stderr.decode("utf-8", errors="replace").strip()[-500:] or f"код выхода {result.returncode}"
+    return None
+
+
+def build_audio_filter(speed_factor, intro_ms=0, volume=None):
+    """
+    Строит цепочку аудиофильтров ffmpeg для экспорта кусков (пустая строка, если фильтры не нужны).
+    intro_ms > 0 означает, что в начале входа стоит вступление (TTS) такой длины: оно проходит без фильтров,
+    а фильтры применяются только к остальной части.
+    volume — фильтр усиления из volume_filter(); ставится перед atempo, чтобы время кадров было временем исходника.
+    """
+    filters = [volume] if volume else []
+    filters.extend(f"atempo={factor}" for factor in plan_atempo_chain(speed_factor))
+    if not filters or intro_ms <= 0:
+        return ",".join(filters)
+    intro_s = f"{intro_ms / 1000:.6f}"
+    return (f"asplit[intro][body];"
+            f"[intro]atrim=end={intro_s},asetpts=PTS-STARTPTS[intro_out];"
+            f"[body]atrim=start={intro_s},asetpts=PTS-STARTPTS,{','.join(filters)}[body_out];"
+            f"[intro_out][body_out]concat=n=2:v=0:a=1")
+
+
+def write_filter_script(filter_graph):
+    """
+    Записывает граф фильтров во временный файл для -filter_script / -filter_complex_script и возвращает путь.
+    Выражение volume с покусковым усилением растет с числом кусков и в командной строке может превысить
+    ее предел (32767 символов в Windows).
+    """
+    with NamedTemporaryFile("w", suffix=".txt", delete=False, encoding="utf-8") as f:
+        f.write(filter_graph)
+    return f.name
+
+
+def _channel_layout(channels):
+    """Имя раскладки каналов ffmpeg (None, если для такого числа каналов не задаем явно)."""
+    return {1: "mono", 2: "stereo"}.get(channels)
+
+
+def load_intro_audio(intro_file):
+    """Загружает вступление (WAV от TTS) целиком — оно короткое. Возвращает AudioSegment или None при ошибке."""
+    try:
+        return AudioSegment.from_file(intro_file)
+    except Exception as e:
+        print(f"  Предупреждение: Не удалось прочитать вступление {intro_file}: {e}. Куски будут без него.")
+        return None
+
+
+def _amplitude_to_dbfs(amplitude, max_amplitude):
+    with np.errstate(divide='ignore'):
+        return 20 * np.log10(np.asarray(amplitude, dtype=np.float64) / max_amplitude)
+
+
+def chunk_levels_from_envelope(analysis, split_points):
+    """
+    (RMS, пик) в dBFS для всех кусков split_points [(start_ms, end_ms), ...] за один векторизованный проход
+    по огибающей анализа, без чтения аудио. Возвращает список пар в порядке кусков.
+    Границы округляются наружу до шага огибающей, поэтому пик не бывает занижен.
+    """
+    if not split_points:
+        return []
+    step = analysis.envelope_step_ms
+    envelope_len = len(analysis.envelope_rms)
+    points = np.asarray(split_points, dtype=np.int64).reshape(-1, 2)
+    first = np.minimum(points[:, 0] // step, envelope_len)
+    last = np.minimum(np.maximum(first + 1, -(-points[:, 1] // step)), envelope_len)
+    counts = last - first
+    # Средний квадрат RMS по шагам куска — через разность кумулятивных сумм
+    cumulative = np.concatenate(([0.0], np.cumsum(np.square(analysis.envelope_rms, dtype=np.float64))))
+    mean_square = (cumulative[last] - cumulative[first]) / np.maximum(counts, 1)
+    # Пики: reduceat по парам индексов [first, last); нулевой элемент в конце делает last допустимым индексом
+    peaks = np.zeros(len(points), dtype=np.int64)
+    non_empty = counts > 0
+    if non_empty.any():
+        envelope_peak = np.append(analysis.envelope_peak.astype(np.int64), 0)
+        indices = np.column_stack((first[non_empty], last[non_empty])).ravel()
+        peaks[non_empty] = np.maximum.reduceat(envelope_peak, indices)[::2]
+    max_amplitude = 2 ** (8 * analysis.sample_width) / 2
+    rms_dbfs = _amplitude_to_dbfs(np.sqrt(mean_square), max_amplitude)
+    peak_dbfs = _amplitude_to_dbfs(peaks, max_amplitude)
+    return list(zip(rms_dbfs.tolist(), peak_dbfs.tolist()))
+
+
+# Сколько сэмплов переводится в float64 за раз при подсчете уровней сегмента
+PCM_LEVELS_BLOCK_SAMPLES = 1 << 20
+
+
+def pcm_levels(audio_segment):
+    """
+    (RMS, пик) AudioSegment в dBFS за один векторизованный проход по сэмплам — вместо отдельных
+    проходов audio_segment.dBFS и audio_segment.max_dBFS. Нужен, когда огибающей анализа еще нет.
+    """
+    samples = np.frombuffer(audio_segment.raw_data, dtype=_PCM_DTYPES[audio_segment.sample_width])
+    if not len(samples):
+        return float('-inf'), float('-inf')
+    energy = 0.0
+    peak = 0.0
+    for offset in range(0, len(samples), PCM_LEVELS_BLOCK_SAMPLES):
+        block = samples[offset:offset + PCM_LEVELS_BLOCK_SAMPLES].astype(np.float64)
+        energy += float(np.dot(block, block))
+        peak = max(peak, float(np.abs(block).max()))
+    max_amplitude = audio_segment.max_possible_amplitude
+    rms_dbfs, peak_dbfs = _amplitude_to_dbfs([np.sqrt(energy / len(samples)), peak], max_amplitude).tolist()
+    return rms_dbfs, peak_dbfs
+
+
+def analyze_audio_file(input_file, silence_thresh_db, min_silence_len_ms):
+    """Анализирует файл за один потоковый проход, не держа PCM в памяти."""
+    reader = PcmStreamReader(input_file, silence_scanner_params=(silence_thresh_db, min_silence_len_ms))
+    try:
+        reader.drain()
+    finally:
+        reader.close()
+    return AudioAnalysis.from_scanner(reader.silence_scanner)
+
+
+# Запас (мс) перед началом диапазона при перемотке входа части файла
+SEEK_PREROLL_MS = 1000
+
+
+def export_segments_ffmpeg(input_file, output_dir, base_filename, split_points, speed_factor,
+                           intro_file=None, intro_ms=0, frame_rate=None, channels=None,
+                           start_number=1, trim=False, trim_end=True, output_suffix="", segment_list=None,
+                           volume=None):
+    """
+    Кодирует все куски одним вызовом ffmpeg через segment muxer: файл декодируется и кодируется один раз,
+    без временных WAV и отдельного процесса на каждый кусок.
+    Если задан intro_file (длиной intro_ms), он ставится перед первым куском в том же проходе,
+    с приведением к frame_rate/channels книги.
+    trim=True кодирует только диапазон split_points (часть файла для параллельного экспорта),
+    куски нумеруются с start_number; trim_end=False оставляет диапазон открытым до конца файла.
+    Вход перематывается (-ss) к началу диапазона, поэтому часть в конце файла не требует декодировать
+    все, что перед ней. output_suffix добавляется к именам кусков (временные .part файлы),
+    в segment_list ffmpeg записывает каждый законченный кусок. volume — фильтр усиления (volume_filter())
+    с временем от начала диапазона.
+    Возвращает список путей к кускам (в порядке split_points) или None при ошибке ffmpeg.
+    """
+    range_start_ms = split_points[0][0] if trim else 0
+    # Точки разреза задаются во времени выходного потока, т.е. уже после atempo и вступления
+    intro_offset_ms = intro_ms if intro_file else 0
+    tempo = effective_speed(speed_factor)
+    segment_times = ",".join(f"{(intro_offset_ms + (end_ms - range_start_ms) / tempo) / 1000:.6f}"
+                             for _, end_ms in split_points[:-1])
+    # % в имени файла ffmpeg воспримет как часть шаблона номера
+    pattern = os.path.join(output_dir, base_filename.replace("%", "%%") + "_%03d.mp3" + output_suffix)
+    command = [AudioSegment.converter, "-v", "error", "-y"]
+    audio_filter = build_audio_filter(speed_factor, volume=volume)
+    input_options = []
+    if trim:
+        # Перемотка на входе с запасом SEEK_PREROLL_MS: декодер MP3 успевает восстановить бит-резервуар
+        # до начала диапазона, а точное начало (до сэмпла) отрезает atrim по времени декодированного звука
+        seek_ms = max(0, range_start_ms - SEEK_PREROLL_MS)
+        if seek_ms > 0:
+            input_options = ["-ss", f"{seek_ms / 1000:.6f}"]
+        trim_filter = f"atrim=start={(range_start_ms - seek_ms) / 1000:.6f}"
+        if trim_end:
+            trim_filter += f":end={(split_points[-1][1] - seek_ms) / 1000:.6f}"
+        audio_filter = ",".join(f for f in (trim_filter + ",asetpts=PTS-STARTPTS", audio_filter) if f)
+    if intro_file:
+        # Вступление и книга склеиваются фильтром concat, поэтому приводим их к одному формату
+        audio_format = "aformat=sample_fmts=s16"
+        if frame_rate:
+            audio_format += f":sample_rates={frame_rate}"
+        if _channel_layout(channels):
+            audio_format += f":channel_layouts={_channel_layout(channels)}"
+        body_filters = ",".join(f for f in (audio_filter, audio_format) if f)
+        filter_script = write_filter_script(f"[0:a]{audio_format}[intro];[1:a:0]{body_filters}[body];"
+                                            f"[intro][body]concat=n=2:v=0:a=1[out]")
+        command += ["-i", intro_file] + input_options + ["-i", input_file, "-map_metadata", "-1",
+                    "-filter_complex_script", filter_script, "-map", "[out]"]
+    else:
+        command += input_options + ["-i", input_file, "-map", "0:a:0", "-map_metadata", "-1"]
+        filter_script = write_filter_script(audio_filter) if audio_filter else None
+        if filter_script:
+            command += ["-filter_script:a", filter_script]
+    # Без бит-резервуара каждый кадр декодируется сам по себе: первый кадр куска не ссылается на данные
+    # последнего кадра предыдущего, и на стыке кусков при воспроизведении не бывает щелчка
+    command += ["-c:a", "libmp3lame", "-reservoir", "0", "-f", "segment", "-segment_format", "mp3",
+                "-segment_start_number", str(start_number), "-reset_timestamps", "1"]
+    if segment_times:
+        command += ["-segment_times", segment_times]
+    if segment_list:
+        command += ["-segment_list", segment_list, "-segment_list_type", "csv"]
+    command.append(pattern)
+
+    try:
+        result = run_child_process(command)
+    finally:
+        if filter_script:
+            os.remove(filter_script)
+    if result.returncode != 0:
+        error_text = result.stderr.decode("utf-8", errors="replace").strip()
+        print(f"  Ошибка ffmpeg (segment muxer) для {input_file}: {error_text[-500:]}")
+        return None
+    return [os.path.join(output_dir, f"{base_filename}_{i:03d}.mp3{output_suffix}")
+            for i in range(start_number, start_number + len(split_points))]
+
+
+def group_split_points(split_points, groups):
+    """Делит точки разреза на не более чем groups идущих подряд групп примерно равной длительности."""
+    if groups <= 1 or len(split_points) <= 1:
+        return [split_points]
+    total_ms = split_points[-1][1] - split_points[0][0]
+    result = [[]]
+    for start_ms, end_ms in split_points:
+        # Новая группа начинается, когда набранная длительность достигла своей доли
+        if result[-1] and len(result) < groups and start_ms - split_points[0][0] >= total_ms * len(result) / groups:
+            result.append([])
+        result[-1].append((start_ms, end_ms))
+    return result
+
+
+# Как часто (сек) во время работы ffmpeg проверяются списки готовых сегментов
+SEGMENT_LIST_POLL_SECONDS = 0.5
+
+
+def _export_segments(input_file, output_dir, split_points, analysis, stats, speed_factor, intro_file=None, intro_ms=0,
+                     encode_workers=1, checkpoint=None, normalization_dbfs=None, book_gain_db=None,
+                     on_chunk_ready=None):
+    """
+    Экспорт всех кусков через segment muxer и сбор статистики по ним. Возвращает False при ошибке.
+    normalization_dbfs — целевой пик нормализации (None — без нормализации); усиление каждого куска
+    вычисляется по огибающей (или берется общее book_gain_db) и применяется фильтром volume в том же проходе ffmpeg.
+    При encode_workers > 1 файл делится на части, которые кодируются параллельными процессами ffmpeg.
+    С checkpoint куски пишутся во временные файлы и фиксируются по мере готовности,
+    а уже записанные в прошлый раз куски не кодируются повторно.
+    """
     base_filename = os.path.splitext(os.path.basename(input_file))[0]
+    chunk_levels = chunk_levels_from_envelope(analysis, split_points)
+    if normalization_dbfs is None:
+        chunk_gains = [0.0] * len(split_points)
+    elif book_gain_db is not None:
+        chunk_gains = [book_gain_db] * len(split_points)
+    else:
+        chunk_gains = [peak_normalization_gain(peak, normalization_dbfs) for _, peak in chunk_levels]
+    if checkpoint:
+        checkpoint.recover_segments(split_points)
+    remaining = [chunk_index for chunk_index, points in enumerate(split_points, start=1)
+                 if not (checkpoint and checkpoint.is_done(chunk_index, *points))]
+    resuming = len(remaining) < len(split_points)
+    if resuming:
+        print(f"  Продолжение с контрольной точки: готово {len(split_points) - len(remaining)} из {len(split_points)} кусков.")
+
+    # Незаписанные куски идут одним или несколькими непрерывными диапазонами; каждый делится на группы для ffmpeg
+    jobs = [] # (номер первого куска, точки группы)
+    run = []
+    for chunk_index in remaining + [None]:
+        if run and (chunk_index is None or chunk_index != run[-1] + 1):
+            run_points = split_points[run[0] - 1:run[-1]]
+            start_number = run[0]
+            for group in group_split_points(run_points, encode_workers):
+                jobs.append((start_number, group))
+                start_number += len(group)
+            run = []
+        if chunk_index is not None:
+            run.append(chunk_index)
+
+    def export_job(start_number, group):
+        last_number = start_number + len(group) - 1
+        whole_file = start_number == 1 and last_number == len(split_points)
+        # Границы кусков отсчитываются от начала кодируемого диапазона (весь файл или его часть)
+        range_start_ms = group[0][0] if not whole_file else 0
+        volume = volume_filter(chunk_gains[start_number - 1:last_number],
+                               [end_ms - range_start_ms for _, end_ms in group[:-1]])
+        files = export_segments_ffmpeg(
+            input_file, output_dir, base_filename, group, speed_factor, volume=volume,
+            intro_file=intro_file if start_number == 1 else None, intro_ms=intro_ms if start_number == 1 else 0,
+            frame_rate=analysis.frame_rate, channels=analysis.channels,
+            start_number=start_number, trim=not whole_file, trim_end=last_number < len(split_points),
+            output_suffix=CHUNK_PART_SUFFIX if checkpoint else "",
+            segment_list=checkpoint.segment_list_path(start_number) if checkpoint else None)
+        return files is not None
+
+    announced = 0 # сколько первых кусков уже передано в on_chunk_ready
+
+    def announce_ready_chunks():
+        # Куски передаются по порядку номеров, как только зафиксированы все предыдущие
+        nonlocal announced
+        while announced < len(split_points) and checkpoint.is_done(announced + 1, *split_points[announced]):
+            announced += 1
+            on_chunk_ready(checkpoint.chunk_path(announced))
+
+    if len(jobs) == 1:
+        print(f"  Экспорт {len(jobs[0][1])} кусков одним проходом ffmpeg (segment muxer)...")
+    elif jobs:
+        print(f"  Экспорт {len(remaining)} кусков: {len(jobs)} параллельных процессов ffmpeg (segment muxer)...")
+    if jobs:
+        # ffmpeg работает в отдельных процессах, поэтому потоков достаточно для параллельности;
+        # вызывающий поток тем временем опрашивает списки сегментов и отдает готовые куски
+        with ThreadPoolExecutor(max_workers=len(jobs)) as executor:
+            futures = [executor.submit(export_job, start_number, group) for start_number, group in jobs]
+            not_done = futures
+            while not_done:
+                not_done = wait(not_done, timeout=SEGMENT_LIST_POLL_SECONDS).not_done
+                if checkpoint and on_chunk_ready:
+                    checkpoint.recover_segments(split_points, keep_lists=bool(not_done))
+                    announce_ready_chunks()
+            results = [future.result() for future in futures]
+    else:
+        results = []
+    if checkpoint:
+        # Фиксируем все законченные куски, в том числе при ошибке одного из процессов ffmpeg
+        checkpoint.recover_segments(split_points)
+    if not all(results):
+        return False
+
+    for chunk_index, ((start_ms, end_ms), (rms, peak), gain) in enumerate(zip(split_points, chunk_levels, chunk_gains), start=1):
+        output_filename = os.path.join(output_dir, f"{base_filename}_{chunk_index:03d}.mp3")
+        if not os.path.exists(output_filename):
+            print(f"  Ошибка: ffmpeg не создал кусок {chunk_index} ({output_filename}).")
+            continue
+        if normalization_dbfs is not None and book_gain_db is None:
+            print(f"  Кусок {chunk_index}: Пиковая нормализация до {normalization_dbfs} dBFS: усиление {gain:+.2f} dB.")
+        rms, peak = rms + gain, peak + gain
+        print(f"  Кусок {chunk_index}: {output_filename} [{start_ms/1000:.2f}s - {end_ms/1000:.2f}s] RMS: {rms:.2f} dBFS, Пик: {peak:.2f} dBFS.")
+        stats['output_files'].append(output_filename)
+        stats['chunks_count'] += 1
+        stats['total_output_size_bytes'] += os.path.getsize(output_filename)
+        stats['rms_values'].append(rms)
+        stats['peak_values'].append(peak)
+        if on_chunk_ready and chunk_index > announced:
+            on_chunk_ready(output_filename)
+    return True
+
+
+# --- Покадровый разбор MP3 (для --lossless-cut) ---
+
+# Битрейты (кбит/с) по индексу: ключ — (MPEG-1?, слой)
+_MP3_BITRATES = {
+    (True, 1): [0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448],
+    (True, 2): [0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384],
+    (True, 3): [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+    (False, 1): [0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256],
+    (False, 2): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+    (False, 3): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+}
+# Частоты дискретизации по индексу версии (биты 19-20 заголовка): 0 — MPEG-2.5, 2 — MPEG-2, 3 — MPEG-1
+_MP3_SAMPLE_RATES = {0: [11025, 12000, 8000], 2: [22050, 24000, 16000], 3: [44100, 48000, 32000]}
+# Флаги полей заголовка Xing/Info
+_XING_FRAMES_FLAG = 0x1
+_XING_BYTES_FLAG = 0x2
+_XING_TOC_FLAG = 0x4
+_XING_QUALITY_FLAG = 0x8
+# Задержка декодера MP3 в сэмплах (учитывается вместе с задержкой энкодера из тега LAME)
+_MP3_DECODER_DELAY = 529
+
+
+def parse_mp3_frame_header(header):
+    """
+    Разбирает 4-байтовый заголовок MP3 кадра.
+    Возвращает словарь с параметрами кадра или None, если это не заголовок (или free-format).
+    """
+    if len(header) < 4 or header[0] != 0xFF or (header[1] & 0xE0) != 0xE0:
+        return None
+    version_bits = (header[1] >> 3) & 0x3
+    layer_bits = (header[1] >> 1) & 0x3
+    bitrate_index = header[2] >> 4
+    sample_rate_index = (header[2] >> 2) & 0x3
+    if version_bits == 1 or layer_bits == 0 or bitrate_index in (0, 15) or sample_rate_index == 3:
+        return None
+    mpeg1 = version_bits == 3
+    layer = 4 - layer_bits
+    bitrate = _MP3_BITRATES[(mpeg1, layer)][bitrate_index] * 1000
+    sample_rate = _MP3_SAMPLE_RATES[version_bits][sample_rate_index]
+    padding = (header[2] >> 1) & 0x1
+    channels = 1 if (header[3] >> 6) == 3 else 2
+    if layer == 1:
+        samples_per_frame = 384
+        frame_size = (12 * bitrate // sample_rate + padding) * 4
+    elif layer == 2 or mpeg1:
+        samples_per_frame = 1152
+        frame_size = 144 * bitrate // sample_rate + padding
+    else:
+        samples_per_frame = 576
+        frame_size = 72 * bitrate // sample_rate + padding
+    # Смещение side info (после заголовка и CRC) и ее длина — там же лежит тег Xing/Info
+    side_info_offset = 4 if header[1] & 0x1 else 6
+    if mpeg1:
+        side_info_size = 17 if channels == 1 else 32
+    else:
+        side_info_size = 9 if channels == 1 else 17
+    return {
+        'mpeg1': mpeg1,
+        'layer': layer,
+        'bitrate': bitrate,
+        'sample_rate': sample_rate,
+        'channels': channels,
+        'samples_per_frame': samples_per_frame,
+        'frame_size': frame_size,
+        'side_info_offset': side_info_offset,
+        'side_info_size': side_info_size,
+    }
+
+
+def _id3v2_size(data):
+    """Размер тега ID3v2 в начале файла (0, если тега нет)."""
+    if len(data) < 10 or data[:3] != b"ID3":
+        return 0
+    size = ((data[6] & 0x7F) << 21) | ((data[7] & 0x7F) << 14) | ((data[8] & 0x7F) << 7) | (data[9] & 0x7F)
+    footer = 10 if data[5] & 0x10 else 0
+    return 10 + size + footer
+
+
+def _parse_xing_tag(frame, info):
+    """
+    Ищет тег Xing/Info в первом кадре. Возвращает словарь (frames, bytes, encoder_delay, encoder_padding)
+    или None. Тег LAME читается так же, как это делает ffmpeg: сразу после присутствующих полей Xing.
+    """
+    offset = info['side_info_offset'] + info['side_info_size']
+    tag_id = bytes(frame[offset:offset + 4])
+    if tag_id not in (b"Xing", b"Info"):
+        return None
+    flags = int.from_bytes(frame[offset + 4:offset + 8], "big")
+    pos = offset + 8
+    result = {'tag_offset': offset, 'tag_id': tag_id, 'frames': None, 'bytes': None,
+              'encoder_delay': None, 'encoder_padding': None}
+    if flags & _XING_FRAMES_FLAG:
+        result['frames'] = int.from_bytes(frame[pos:pos + 4], "big")
+        pos += 4
+    if flags & _XING_BYTES_FLAG:
+        result['bytes'] = int.from_bytes(frame[pos:pos + 4], "big")
+        pos += 4
+    if flags & _XING_TOC_FLAG:
+        pos += 100
+    if flags & _XING_QUALITY_FLAG:
+        pos += 4
+    encoder = bytes(frame[pos:pos + 4])
+    if encoder in (b"LAME", b"Lavf", b"Lavc") and len(frame) >= pos + 24:
+        delay_padding = int.from_bytes(frame[pos + 21:pos + 24], "big")
+        result['encoder_delay'] = delay_padding >> 12
+        result['encoder_padding'] = delay_padding & 0xFFF
+    return result
+
+
+def _mp3_decoded_samples(frames_count, samples_per_frame, xing):
+    """
+    Сколько сэмплов выдаст декодер (ffmpeg) для frames_count кадров. При наличии тега LAME
+    он отбрасывает задержку энкодера в начале и паддинг в конце (задержка декодера при этом взаимно сокращается).
+    """
+    samples = frames_count * samples_per_frame
+    if xing and xing['encoder_delay'] is not None:
+        samples -= xing['encoder_delay'] + xing['encoder_padding']
+    return max(0, samples)
+
+
+def _parse_vbri_tag(frame):
+    """Число кадров из тега VBRI (Fraunhofer), который стоит через 32 байта после заголовка первого кадра."""
+    offset = 4 + 32
+    if bytes(frame[offset:offset + 4]) != b"VBRI" or len(frame) < offset + 18:
+        return None
+    return int.from_bytes(frame[offset + 14:offset + 18], "big")
+
+
+# Размер блока, которым читается файл при построении таблицы кадров
+MP3_SCAN_BLOCK_BYTES = 1024 * 1024
+# Больше самого длинного кадра MPEG 1/2/2.5 Layer I–III (2881 байт): кадр целиком помещается в окно чтения
+_MP3_MAX_FRAME_BYTES = 4096
+
+
+class Mp3FrameIndex:
+    """
+    Таблица MP3 кадров файла: смещения и размеры кадров, main_data_begin (резервуар битов Layer III),
+    а также данные тега Xing/Info/LAME первого кадра. Строится одним проходом по заголовкам, без декодирования.
+    Файл читается блоками по MP3_SCAN_BLOCK_BYTES, поэтому память не зависит от длины книги.
+    """
+
+    def __init__(self, filepath, data=None):
+        self.filepath = filepath
+        self.offsets = []
+        self.sizes = []
+        self.main_data_begin = []
+        self.xing = None
+        self.xing_frame = None # Байты кадра Xing/Info (шаблон для заголовков кусков)
+        self.sample_rate = None
+        self.channels = None
+        self.samples_per_frame = None
+        self.layer = None
+        with io.BytesIO(data) if data is not None else open(filepath, "rb") as f:
+            self._scan(f)
+
+    def _scan(self, f):
+        f.seek(0, os.SEEK_END)
+        end = f.tell()
+        if end >= 128:
+            f.seek(end - 128)
+            if f.read(3) == b"TAG":
+                end -= 128 # ID3v1 в конце файла
+        f.seek(0)
+        pos = _id3v2_size(f.read(10))
+        f.seek(pos)
+        # Окно файла [buffer_start, buffer_start + len(buffer)); кадр, начатый в конце блока, дочитывается со следующим
+        buffer = bytearray()
+        buffer_start = pos
+        while pos + 4 <= end:
+            if pos + _MP3_MAX_FRAME_BYTES > buffer_start + len(buffer) and buffer_start + len(buffer) < end:
+                del buffer[:pos - buffer_start]
+                buffer_start = pos
+                buffer += f.read(MP3_SCAN_BLOCK_BYTES)
+            offset = pos - buffer_start
+            info = parse_mp3_frame_header(buffer[offset:offset + 4])
+            if info is None or pos + info['frame_size'] > end or (
+                    self.sample_rate is not None and info['sample_rate'] != self.sample_rate):
+                pos += 1 # Мусор или потеря синхронизации: ищем следующий заголовок
+                continue
+            if self.sample_rate is None:
+                self.sample_rate = info['sample_rate']
+                self.channels = info['channels']
+                self.samples_per_frame = info['samples_per_frame']
+                self.layer = info['layer']
+                frame = bytes(buffer[offset:offset + info['frame_size']])
+                xing = _parse_xing_tag(frame, info)
+                if xing:
+                    # Кадр Xing/Info не содержит звука и декодерами пропускается
+                    self.xing = xing
+                    self.xing_frame = frame
+                    pos += info['frame_size']
+                    continue
+            main_data_begin = 0
+            if info['layer'] == 3:
+                side = offset + info['side_info_offset']
+                if info['mpeg1']:
+                    main_data_begin = (buffer[side] << 1) | (buffer[side + 1] >> 7)
+                else:
+                    main_data_begin = buffer[side]
+            self.offsets.append(pos)
+            self.sizes.append(info['frame_size'])
+            self.main_data_begin.append(main_data_begin)
+            pos += info['frame_size']
+
+    def __len__(self):
+        return len(self.offsets)
+
+    @property
+    def start_delay_samples(self):
+        """Сколько сэмплов в начале отбрасывает декодер (ffmpeg) по данным тега LAME."""
+        if self.xing and self.xing['encoder_delay'] is not None:
+            return self.xing['encoder_delay'] + _MP3_DECODER_DELAY
+        return 0
+
+    def duration_ms(self):
+        """Длительность по числу кадров с учетом задержки и паддинга энкодера."""
+        if not self.sample_rate:
+            return 0
+        samples = _mp3_decoded_samples(len(self.offsets), self.samples_per_frame, self.xing)
+        return round(1000 * samples / self.sample_rate)
+
+    def frame_for_time(self, time_ms, search_radius_ms=0):
+        """
+        Номер кадра, на границе которого ближе всего к time_ms (время декодированного звука).
+        В пределах search_radius_ms предпочитается кадр без ссылок в резервуар битов (main_data_begin == 0),
+        чтобы первый кадр куска декодировался без потерь.
+        """
+        frame_ms = 1000 * self.samples_per_frame / self.sample_rate
+        position = (time_ms * self.sample_rate / 1000 + self.start_delay_samples) / self.samples_per_frame
+        nearest = min(max(0, int(round(position))), len(self.offsets))
+        radius = int(search_radius_ms // frame_ms)
+        candidates = range(max(0, nearest - radius), min(len(self.offsets), nearest + radius) + 1)
+        independent = [i for i in candidates if i < len(self.offsets) and self.main_data_begin[i] == 0]
+        if independent:
+            return min(independent, key=lambda i: abs(i - position))
+        return nearest
+
+    def frame_time_ms(self, frame_number):
+        """Время (мс декодированного звука), с которого начинается кадр frame_number."""
+        samples = frame_number * self.samples_per_frame - self.start_delay_samples
+        return max(0, round(1000 * samples / self.sample_rate))
+
+    def header_frame_for(self, frames_count, payload_bytes):
+        """
+        Кадр Xing/Info для куска из frames_count кадров: по шаблону исходного кадра, только с числом кадров
+        и байтов (без TOC и тега LAME — задержка энкодера относится к началу исходного файла).
+        Возвращает None, если в исходном файле такого кадра не было.
+        """
+        if not self.xing_frame:
+            return None
+        offset = self.xing['tag_offset']
+        frame = bytearray(len(self.xing_frame))
+        frame[:offset] = self.xing_frame[:offset]
+        frame[offset:offset + 4] = self.xing['tag_id']
+        frame[offset + 4:offset + 8] = (_XING_FRAMES_FLAG | _XING_BYTES_FLAG).to_bytes(4, "big")
+        frame[offset + 8:offset + 12] = frames_count.to_bytes(4, "big")
+        frame[offset + 12:offset + 16] = (payload_bytes + len(frame)).to_bytes(4, "big")
+        return bytes(frame)
+
+
+def encode_intro_frames(intro_file, frame_index):
+    """
+    Кодирует вступление в MP3 кадры с частотой и числом каналов исходного файла, чтобы их можно было
+    поставить перед кадрами книги. Возвращает (байты кадров, число кадров) или None при ошибке.
+    """
+    command = [AudioSegment.converter, "-v", "error", "-i", intro_file, "-map_metadata", "-1",
+               "-ar", str(frame_index.sample_rate), "-ac", str(frame_index.channels),
+               "-c:a", "libmp3lame", "-write_xing", "0", "-id3v2_version", "0", "-f", "mp3", "pipe:1"]
+    result = run_child_process(command, stdout=subprocess.PIPE)
+    if result.returncode != 0 or not result.stdout:
+        error_text = result.stderr.decode("utf-8", errors="replace").strip()
+        print(f"  Предупреждение: Не удалось закодировать вступление {intro_file}: {error_text[-300:]}")
+        return None
+    intro_index = Mp3FrameIndex(intro_file, data=result.stdout)
+    if not len(intro_index) or intro_index.sample_rate != frame_index.sample_rate:
+        return None
+    start = intro_index.offsets[0]
+    end = intro_index.offsets[-1] + intro_index.sizes[-1]
+    return result.stdout[start:end], len(intro_index)
+
+
+def export_lossless_cut(input_file, output_dir, base_filename, split_points, frame_index, search_radius_ms=0,
+                        intro_frames=None, checkpoint=None):
+    """
+    Режет MP3 без перекодирования: каждая точка разреза сдвигается на ближайшую границу кадра,
+    а кусок записывается как диапазон байтов исходного файла (плюс собственный кадр Xing/Info).
+    intro_frames — (байты, число кадров) вступления, которые ставятся перед первым куском.
+    С checkpoint кусок пишется во временный файл и фиксируется, уже записанные куски пропускаются.
+    Возвращает список (номер, путь, start_ms, end_ms) с фактическими границами кусков.
+    """
+    boundaries = [0]
+    for _, end_ms in split_points[:-1]:
+        frame = frame_index.frame_for_time(end_ms, search_radius_ms)
+        boundaries.append(max(frame, boundaries[-1]))
+    boundaries.append(len(frame_index))
+
+    results = []
+    with open(input_file, "rb") as source:
+        for chunk_index, (first_frame, end_frame) in enumerate(zip(boundaries[:-1], boundaries[1:]), start=1):
+            output_filename = os.path.join(output_dir, f"{base_filename}_{chunk_index:03d}.mp3")
+            if end_frame <= first_frame:
+                print(f"  Предупреждение: Кусок {chunk_index} пуст после привязки к кадрам. Пропуск.")
+                continue
+            start_ms = frame_index.frame_time_ms(first_frame)
+            end_ms = frame_index.duration_ms() if end_frame == len(frame_index) else frame_index.frame_time_ms(end_frame)
+            if checkpoint and checkpoint.is_done(chunk_index, start_ms, end_ms):
+                results.append((chunk_index, output_filename, start_ms, end_ms))
+                continue
+            start_byte = frame_index.offsets[first_frame]
+            end_byte = frame_index.offsets[end_frame - 1] + frame_index.sizes[end_frame - 1]
+            prefix, prefix_frames = intro_frames if (intro_frames and chunk_index == 1) else (b"", 0)
+            header_frame = frame_index.header_frame_for(end_frame - first_frame + prefix_frames,
+                                                        end_byte - start_byte + len(prefix))
+            source.seek(start_byte)
+            write_path = checkpoint.part_path(chunk_index) if checkpoint else output_filename
+            with open(write_path, "wb") as out:
+                if header_frame:
+                    out.write(header_frame)
+                out.write(prefix)
+                remaining = end_byte - start_byte
+                while remaining > 0:
+                    block = source.read(min(remaining, 1024 * 1024))
+                    if not block:
+                        break
+                    out.write(block)
+                    remaining -= len(block)
+            if checkpoint:
+                checkpoint.commit(chunk_index, start_ms, end_ms, part_path=write_path)
+            results.append((chunk_index, output_filename, start_ms, end_ms))
+    return results
+
+
+def _export_lossless(input_file, output_dir, split_points, analysis, stats, min_silence_len_ms, intro_file=None,
+                     checkpoint=None, on_chunk_ready=None):
+    """Экспорт без перекодирования и сбор статистики. Возвращает False при ошибке."""
+    base_filename = os.path.splitext(os.path.basename(input_file))[0]
+    print(f"  Разбор MP3 кадров...")
+    try:
+        frame_index = Mp3FrameIndex(input_file)
+    except OSError as e:
+        print(f"  Ошибка чтения файла {input_file}: {e}")
+        return False
+    if not len(frame_index):
+        print(f"  Ошибка: В файле {input_file} не найдено MP3 кадров.")
+        return False
+    # Вступление нужно только первому куску; если он уже записан, кодировать его незачем
+    need_intro = intro_file and not (checkpoint and 1 in checkpoint.done)
+    intro_frames = encode_intro_frames(intro_file, frame_index) if need_intro else None
+    print(f"  Кадров: {len(frame_index)}, экспорт {len(split_points)} кусков без перекодирования...")
+    # Точка разреза — середина тишины длиной не меньше min_silence_len_ms, сдвиг на полдлины остается в тишине
+    pieces = export_lossless_cut(input_file, output_dir, base_filename, split_points, frame_index,
+                                 search_radius_ms=min_silence_len_ms // 2, intro_frames=intro_frames,
+                                 checkpoint=checkpoint)
+    chunk_levels = chunk_levels_from_envelope(analysis, [(start_ms, end_ms) for _, _, start_ms, end_ms in pieces])
+    for (chunk_index, output_filename, start_ms, end_ms), (rms, peak) in zip(pieces, chunk_levels):
+        print(f"  Кусок {chunk_index}: {output_filename} [{start_ms/1000:.2f}s - {end_ms/1000:.2f}s] RMS: {rms:.2f} dBFS, Пик: {peak:.2f} dBFS.")
+        stats['output_files'].append(output_filename)
+        stats['chunks_count'] += 1
+        stats['total_output_size_bytes'] += os.path.getsize(output_filename)
+        stats['rms_values'].append(rms)
+        stats['peak_values'].append(peak)
+        if on_chunk_ready:
+            on_chunk_ready(output_filename)
+    return True
+
+
+def iter_split_points(silence_index, target_chunk_duration_ms, search_window_ms, min_silence_len_ms, prefetch=None):
+    """
+    Генерирует границы кусков (start_ms, end_ms), принимая решения только по индексу тишины.
+    prefetch(position_ms), если передан, вызывается перед каждым решением: в потоковом режиме
+    он дочитывает файл и достраивает индекс до нужной позиции.
+    """
+    total_duration_ms = silence_index.duration_ms
     current_pos_ms = 0
-    chunk_index = 1
     # Safety counter to prevent infinite loops in edge cases
     # Estimate iterations based on original duration, speed doesn't affect number of split points
     max_iterations = (total_duration_ms // (target_chunk_duration_ms / 2)) + 20 # Increased buffer
@@ -172,17 +2181,20 @@ def split_mp3(input_file, output_dir, target_chunk_duration_s=100, search_window
     while current_pos_ms < total_duration_ms and iterations < max_iterations:
         iterations += 1
         ideal_split_point_ms = current_pos_ms + target_chunk_duration_ms
+        if prefetch:
+            # Дочитываем поток чуть дальше окна поиска: если конец файла рядом,
+            # решения о последнем куске принимаются по точной, а не оценочной длине
+            prefetch(ideal_split_point_ms + search_window_ms + min_silence_len_ms)
+            total_duration_ms = silence_index.duration_ms
 
         if ideal_split_point_ms >= total_duration_ms - (search_window_ms / 2):
             split_point_ms = total_duration_ms
             # print(f"  Достигнут конец файла, последний кусок {chunk_index}.")
         else:
             found_split_point = find_silent_split_point(
-                audio,
+                silence_index,
                 ideal_split_point_ms,
-                search_window_ms,
-                silence_thresh_db,
-                min_silence_len_ms
+                search_window_ms
             )
 
             if found_split_point:
@@ -221,123 +2233,466 @@ def split_mp3(input_file, output_dir, target_chunk_duration_s=100, search_window
                      break
                  continue
 
+        yield current_pos_ms, split_point_ms
+        current_pos_ms = split_point_ms
+
+    if iterations >= max_iterations:
+        print(f"  Предупреждение: Достигнут лимит итераций ({max_iterations}). Возможно, зацикливание или ошибка в логике.")
 
-        # print(f"  Извлечение куска {chunk_index}: [{current_pos_ms/1000:.2f}s - {split_point_ms/1000:.2f}s] (Длительность оригинала: {(split_point_ms - current_pos_ms)/1000:.2f}s)")
+
+def plan_split_points(silence_index, target_chunk_duration_ms, search_window_ms, min_silence_len_ms):
+    """Возвращает список границ всех кусков файла по готовому индексу тишины."""
+    return list(iter_split_points(silence_index, target_chunk_duration_ms, search_window_ms, min_silence_len_ms))
+
+
+# Формат сырого PCM для ffmpeg по ширине сэмпла AudioSegment (8-битный PCM в pydub знаковый)
+_PCM_FORMATS = {1: "s8", 2: "s16le", 3: "s24le", 4: "s32le"}
+
+
+def export_chunk_mp3(segment, export_path, parameters=None):
+    """
+    Кодирует AudioSegment в MP3 так же, как segment.export(format="mp3"), но PCM передается ffmpeg
+    через stdin, а сам процесс учитывается в run_child_process: при остановке скрипта (SIGTERM)
+    кодировщики из пула потоков завершаются вместе с ним.
+    """
+    command = [AudioSegment.converter, "-y", "-v", "error", "-f", _PCM_FORMATS[segment.sample_width],
+               "-ar", str(segment.frame_rate), "-ac", str(segment.channels), "-i", "pipe:0"]
+    command += list(parameters or []) + ["-f", "mp3", export_path]
+    result = run_child_process(command, input=segment.raw_data)
+    if result.returncode != 0:
+        error_text = result.stderr.decode("utf-8", errors="replace").strip()
+        raise CouldntEncodeError(f"ffmpeg завершился с кодом {result.returncode}: {error_text[-500:]}")
+
+
+def _split_audio_into_chunks(audio, silence_index, input_file, output_dir, stats, target_chunk_duration_ms, search_window_ms,
+                             min_silence_len_ms, speed_factor,
+                             target_normalization_dbfs, enable_normalization, streaming, intro=None,
+                             encode_workers=1, encode_buffer_mb=DEFAULT_ENCODE_BUFFER_MB, checkpoint=None, analysis=None,
+                             book_gain_db=None, on_chunk_ready=None):
+    """
+    Основной цикл нарезки: идет по точкам разреза из индекса и экспортирует куски, заполняя stats.
+    С checkpoint куски пишутся во временные файлы и фиксируются по порядку; записанные ранее куски не кодируются.
+    intro (AudioSegment) ставится перед первым куском в том же экспорте.
+    При encode_workers > 1 куски кодируются параллельно в пуле потоков (каждый экспорт — отдельный ffmpeg),
+    а извлечение и нормализация идут последовательно. PCM кусков, ожидающих кодирования, не больше
+    encode_buffer_mb; статистика собирается в порядке номеров кусков.
+    Если есть analysis, уровни всех кусков считаются заранее одним проходом по огибающей,
+    иначе (потоковый режим без кэша) — одним проходом по PCM каждого куска.
+    book_gain_db, если задано, заменяет покусковую пиковую нормализацию общим усилением книги.
+    """
+    base_filename = os.path.splitext(os.path.basename(input_file))[0]
+    executor = ThreadPoolExecutor(max_workers=encode_workers) if encode_workers > 1 else None
+    pending = collections.deque() # (номер, границы, имя файла, future, RMS, пик, байт PCM) в порядке кусков
+    pending_bytes = 0
+    buffer_limit_bytes = encode_buffer_mb * 1024 * 1024
+
+    def collect_oldest():
+        nonlocal pending_bytes
+        chunk_index, points, output_filename, future, final_rms, final_peak, pcm_bytes = pending.popleft()
+        pending_bytes -= pcm_bytes
         try:
-            chunk = audio[current_pos_ms:split_point_ms]
-        except IndexError:
-             print(f"  Ошибка (IndexError) при извлечении куска {chunk_index} ({current_pos_ms}:{split_point_ms}). Возможно, проблема с расчетом времени. Пропуск.")
-             current_pos_ms = split_point_ms + 1
-             if current_pos_ms >= total_duration_ms: break
-             continue
+            future.result()
+            if checkpoint:
+                checkpoint.commit(chunk_index, *points, part_path=checkpoint.part_path(chunk_index))
         except Exception as e:
-             print(f"  Ошибка при извлечении куска {chunk_index} ({current_pos_ms}:{split_point_ms}): {e}")
-             current_pos_ms = split_point_ms + 1
-             if current_pos_ms >= total_duration_ms: break
-             continue
-
+            print(f"  Ошибка экспорта куска {chunk_index} ({output_filename}): {e}")
+            return
+        record_stats(output_filename, final_rms, final_peak)
 
-        output_filename = os.path.join(output_dir, f"{base_filename}_{chunk_index:03d}.mp3")
+    def record_stats(output_filename, final_rms, final_peak):
+        # Собираем статистику
+        stats['output_files'].append(output_filename)
+        stats['chunks_count'] += 1
+        try:
+            file_size = os.path.getsize(output_filename)
+            stats['total_output_size_bytes'] += file_size
+        except:
+            pass
+        # Собираем данные о громкости финального куска
+        stats['rms_values'].append(final_rms)
+        stats['peak_values'].append(final_peak)
+        if on_chunk_ready:
+            on_chunk_ready(output_filename)
 
-        if len(chunk) > 0:
-            # Нормализация перед экспортом, если включена
-            current_chunk_to_export = chunk # По умолчанию экспортируем оригинальный чанк
-            if enable_normalization:
-                initial_dbfs = chunk.dBFS
-                print(f"  Кусок {chunk_index}: Начальный уровень громкости: {initial_dbfs:.2f} dBFS.") # Это RMS
-                
-                normalized_chunk = normalize_audio(chunk, target_dbfs=target_normalization_dbfs)
-                # final_dbfs = normalized_chunk.dBFS # Это RMS после нормализации
-                # Обновим лог, чтобы было понятнее, что это пиковая нормализация
-                print(f"  Кусок {chunk_index}: Пиковая нормализация до {target_normalization_dbfs} dBFS выполнена. RMS после: {normalized_chunk.dBFS:.2f} dBFS, Пик после: {normalized_chunk.max_dBFS:.2f} dBFS.")
-                current_chunk_to_export = normalized_chunk # Экспортируем нормализованный чанк
-            else:
-                print(f"  Кусок {chunk_index}: Нормализация отключена. RMS: {chunk.dBFS:.2f} dBFS, Пик: {chunk.max_dBFS:.2f} dBFS.")
-
-            export_params = {}
-            if speed_factor != 1.0:
-                # Basic atempo filter. For speed > 2.0, might need 'atempo=2.0,atempo=...'
-                # We pass it directly, ffmpeg might handle simple cases or fail gracefully.
-                export_params["parameters"] = ["-filter:a", f"atempo={speed_factor}"]
-                # Estimate new duration for logging
-                estimated_new_duration = len(chunk) / speed_factor
-                print(f"  Экспорт куска {chunk_index}: {output_filename} (Ориг. длина: {len(chunk)/1000:.2f}s, Ожид. новая: {estimated_new_duration/1000:.2f}s)")
-            else:
-                print(f"  Экспорт куска {chunk_index}: {output_filename} (Длительность: {len(chunk)/1000:.2f}s)")
+    prefetch = None
+    if streaming and audio.silence_scanner:
+        def prefetch(position_ms):
+            audio.prefetch(position_ms)
+            silence_index.duration_ms = len(audio)
 
+    if analysis:
+        # Индекс тишины готов, поэтому все точки разреза и уровни кусков известны до экспорта
+        split_points = plan_split_points(silence_index, target_chunk_duration_ms, search_window_ms, min_silence_len_ms)
+        chunk_levels = chunk_levels_from_envelope(analysis, split_points)
+    else:
+        split_points = iter_split_points(silence_index, target_chunk_duration_ms, search_window_ms, min_silence_len_ms, prefetch)
+        chunk_levels = None
+    try:
+        for chunk_index, (current_pos_ms, split_point_ms) in enumerate(split_points, start=1):
+            # print(f"  Извлечение куска {chunk_index}: [{current_pos_ms/1000:.2f}s - {split_point_ms/1000:.2f}s] (Длительность оригинала: {(split_point_ms - current_pos_ms)/1000:.2f}s)")
             try:
-                # Use parameters for ffmpeg filters/options
-                # Экспортируем нужный чанк (оригинальный или нормализованный)
-                current_chunk_to_export.export(output_filename, format="mp3", parameters=export_params.get("parameters"))
-                
-                # Собираем статистику
-                stats['chunks_count'] += 1
-                try:
-                    file_size = os.path.getsize(output_filename)
-                    stats['total_output_size_bytes'] += file_size
-                except:
-                    pass
-                
-                # Собираем данные о громкости финального куска
-                final_rms = current_chunk_to_export.dBFS
-                final_peak = current_chunk_to_export.max_dBFS
-                stats['rms_values'].append(final_rms)
-                stats['peak_values'].append(final_peak)
-                
+                chunk = audio[current_pos_ms:split_point_ms]
+            except CouldntDecodeError:
+                raise # Сбой декодирования прерывает весь файл, а не один кусок
+            except IndexError:
+                 print(f"  Ошибка (IndexError) при извлечении куска {chunk_index} ({current_pos_ms}:{split_point_ms}). Возможно, проблема с расчетом времени. Пропуск.")
+                 continue
             except Exception as e:
-                print(f"  Ошибка экспорта куска {chunk_index} ({output_filename}): {e}")
-        else:
-             # print(f"  Предупреждение: Кусок {chunk_index} пуст (длительность 0ms). Экспорт пропущен.")
-             pass
+                 print(f"  Ошибка при извлечении куска {chunk_index} ({current_pos_ms}:{split_point_ms}): {e}")
+                 continue
 
 
-        current_pos_ms = split_point_ms
-        chunk_index += 1
+            output_filename = os.path.join(output_dir, f"{base_filename}_{chunk_index:03d}.mp3")
 
+            if len(chunk) > 0:
+                # Уровни куска считаются один раз; после усиления они получаются прибавлением gain
+                levels = chunk_levels[chunk_index - 1] if chunk_levels else pcm_levels(chunk)
+                if not enable_normalization:
+                    gain = 0.0
+                elif book_gain_db is not None:
+                    gain = book_gain_db
+                else:
+                    gain = peak_normalization_gain(levels[1], target_normalization_dbfs)
+                final_rms, final_peak = levels[0] + gain, levels[1] + gain
 
-    if iterations >= max_iterations:
-        print(f"  Предупреждение: Достигнут лимит итераций ({max_iterations}) для файла {input_file}. Возможно, зацикливание или ошибка в логике.")
+            if len(chunk) > 0 and checkpoint and checkpoint.is_done(chunk_index, current_pos_ms, split_point_ms):
+                # Кусок записан в прошлый раз
+                print(f"  Кусок {chunk_index}: уже записан (контрольная точка), пропуск: {output_filename}")
+                record_stats(output_filename, final_rms, final_peak)
+            elif len(chunk) > 0:
+                # Нормализация — усиление в фильтре кодировщика: копия куска с измененной громкостью не создается
+                if enable_normalization and book_gain_db is None:
+                    print(f"  Кусок {chunk_index}: Начальный уровень громкости: RMS {levels[0]:.2f} dBFS, Пик: {levels[1]:.2f} dBFS.")
+                    if target_normalization_dbfs > 0:
+                        print(f"    Предупреждение: Целевой пиковый уровень {target_normalization_dbfs} dBFS > 0. Установлен на 0 dBFS.")
+                    print(f"  Кусок {chunk_index}: Пиковая нормализация до {target_normalization_dbfs} dBFS: усиление {gain:+.2f} dB при кодировании. RMS после: {final_rms:.2f} dBFS, Пик после: {final_peak:.2f} dBFS.")
+                elif enable_normalization:
+                    print(f"  Кусок {chunk_index}: Нормализация по книге ({gain:+.2f} dB). RMS после: {final_rms:.2f} dBFS, Пик после: {final_peak:.2f} dBFS.")
+                else:
+                    print(f"  Кусок {chunk_index}: Нормализация отключена. RMS: {final_rms:.2f} dBFS, Пик: {final_peak:.2f} dBFS.")
 
-    # Завершаем сбор статистики
-    stats['processing_time_sec'] = time.time() - start_time
-    
-    # Вычисляем средние значения громкости
-    if stats['rms_values']:
-        stats['avg_final_rms'] = sum(stats['rms_values']) / len(stats['rms_values'])
-        stats['avg_final_peak'] = sum(stats['peak_values']) / len(stats['peak_values'])
-    else:
-        stats['avg_final_rms'] = 0
-        stats['avg_final_peak'] = 0
+                export_params = {}
+                intro_ms = 0
+                if intro and chunk_index == 1:
+                    # Вступление приводится к формату куска и проходит мимо atempo (см. build_audio_filter)
+                    intro = intro.set_frame_rate(chunk.frame_rate).set_channels(chunk.channels).set_sample_width(chunk.sample_width)
+                    intro_ms = len(intro)
+                audio_filter = build_audio_filter(speed_factor, intro_ms, volume=volume_filter([gain]))
+                if audio_filter:
+                    export_params["parameters"] = ["-filter:a", audio_filter]
+                if speed_factor != 1.0:
+                    # Estimate new duration for logging
+                    estimated_new_duration = len(chunk) / effective_speed(speed_factor)
+                    print(f"  Экспорт куска {chunk_index}: {output_filename} (Ориг. длина: {len(chunk)/1000:.2f}s, Ожид. новая: {estimated_new_duration/1000:.2f}s)")
+                else:
+                    print(f"  Экспорт куска {chunk_index}: {output_filename} (Длительность: {len(chunk)/1000:.2f}s)")
+
+                segment_to_export = intro + chunk if intro_ms else chunk
+                pcm_bytes = len(segment_to_export.raw_data)
+                # Ограничение памяти: ждем завершения самых старых экспортов, пока новый кусок не поместится
+                while pending and pending_bytes + pcm_bytes > buffer_limit_bytes:
+                    collect_oldest()
+                # С контрольной точкой кусок сначала пишется во временный файл
+                export_path = checkpoint.part_path(chunk_index) if checkpoint else output_filename
+                if executor:
+                    future = executor.submit(export_chunk_mp3, segment_to_export, export_path,
+                                             export_params.get("parameters"))
+                else:
+                    future = Future()
+                    try:
+                        # Use parameters for ffmpeg filters/options
+                        export_chunk_mp3(segment_to_export, export_path, export_params.get("parameters"))
+                        future.set_result(None)
+                    except Exception as e:
+                        future.set_exception(e)
+                pending.append((chunk_index, (current_pos_ms, split_point_ms), output_filename, future,
+                                final_rms, final_peak, pcm_bytes))
+                pending_bytes += pcm_bytes
+                if not executor:
+                    collect_oldest()
+            else:
+                 # print(f"  Предупреждение: Кусок {chunk_index} пуст (длительность 0ms). Экспорт пропущен.")
+                 pass
+
+            if streaming:
+                # Следующее окно поиска может начаться раньше текущей позиции, если окно шире куска
+                audio.release_before(split_point_ms - search_window_ms // 2)
+        while pending:
+            collect_oldest()
+    finally:
+        if executor:
+            # После ошибки или остановки ожидающие в очереди куски уже не кодируются
+            executor.shutdown(wait=True, cancel_futures=True)
+
+
+# Размер буфера копирования и проверки: крупные чтения намного быстрее мелких на медленных USB-накопителях
+COPY_BUFFER_BYTES = 4 * 1024 * 1024
+# fcntl F_NOCACHE на macOS (в модуле fcntl есть не во всех версиях Python)
+_F_NOCACHE = 48
+
+
+def _drop_file_cache(fd):
+    """
+    Просит ОС не отдавать файл из страничного кэша, чтобы проверка читала данные с самого устройства.
+    Linux — posix_fadvise(DONTNEED) после fsync, macOS — F_NOCACHE; на других системах ничего не делает.
+    """
+    try:
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        elif sys.platform == 'darwin':
+            import fcntl
+            fcntl.fcntl(fd, getattr(fcntl, 'F_NOCACHE', _F_NOCACHE), 1)
+    except OSError:
+        pass
+
+
+class Crc32Hash:
+    """zlib.crc32 с интерфейсом hashlib (update/hexdigest)."""
+
+    def __init__(self):
+        self.value = 0
+
+    def update(self, data):
+        self.value = zlib.crc32(data, self.value)
+
+    def hexdigest(self):
+        return f"{self.value:08x}"
+
+
+class Verifier:
+    """
+    Способ проверки копии (--verify). Отпечаток источника считается по тем же данным, что пишутся
+    в копию, отпечаток копии — по ее содержимому на устройстве (или только по размеру).
+    new_hash — фабрика объекта с интерфейсом hashlib; без нее сравниваются только размеры (size)
+    или проверка не выполняется вовсе (none). Отпечаток — строка; None — файл не удалось прочитать.
+    """
+
+    def __init__(self, name, new_hash=None, enabled=True):
+        self.name = name
+        self.new_hash = new_hash
+        self.enabled = enabled
+
+    @property
+    def reads_back(self):
+        """Нужно ли читать копию обратно с устройства."""
+        return self.new_hash is not None
+
+    def digest_file(self, filepath, buffer=None, drop_cache=False):
+        """
+        Отпечаток файла. buffer — переиспользуемый bytearray для чтения (readinto),
+        drop_cache=True читает файл мимо страничного кэша (проверка записанной копии).
+        """
+        try:
+            if not self.enabled:
+                return ""
+            if self.new_hash is None:
+                return str(os.path.getsize(filepath))
+            digest = self.new_hash()
+            buffer = buffer if buffer is not None else bytearray(COPY_BUFFER_BYTES)
+            view = memoryview(buffer)
+            with open(filepath, "rb", buffering=0) as f:
+                if drop_cache:
+                    _drop_file_cache(f.fileno())
+                # Читаем файл кусками в один и тот же буфер, чтобы не загружать большие файлы в память целиком
+                while True:
+                    size = f.readinto(buffer)
+                    if not size:
+                        break
+                    digest.update(view[:size])
+            return digest.hexdigest()
+        except FileNotFoundError:
+            print(f"  Ошибка: Файл не найден при вычислении хеша: {filepath}")
+            return None
+        except Exception as e:
+            print(f"  Ошибка чтения файла при вычислении хеша ({filepath}): {e}")
+            return None
+
+
+# Способы проверки копий (--verify): от надежного к быстрому
+VERIFIERS = {
+    'sha256': Verifier('sha256', hashlib.sha256),
+    'blake2b': Verifier('blake2b', hashlib.blake2b),
+    'crc32': Verifier('crc32', Crc32Hash),
+    'size': Verifier('size'),
+    'none': Verifier('none', enabled=False),
+}
+DEFAULT_VERIFY = 'sha256'
+
+
+def verification_problems(verifier, source_digest, dest_digest, dest_file):
+    """Описания ошибки проверки копии (пустой список — копия проверена)."""
+    if dest_digest is not None and source_digest == dest_digest:
+        return []
+    if dest_digest is None:
+        return [f"Не удалось вычислить хеш назначения: {dest_file}"]
+    label = "размер" if verifier.name == 'size' else f"хеш {verifier.name}"
+    return [f"Источник {label}: {source_digest}", f"Назначение {label}: {dest_digest}"]
+
+
+def copy_file_with_verify(source_file, dest_file, buffer=None, verifier=None):
+    """
+    Копирует один файл и сверяет отпечатки источника и копии (verifier, по умолчанию SHA256).
+    Источник читается один раз: отпечаток считается по тем же блокам, что пишутся в копию.
+    Копия сбрасывается на устройство (fsync), вытесняется из страничного кэша и один раз читается
+    обратно для проверки.
+    buffer — переиспользуемый bytearray (по умолчанию выделяется COPY_BUFFER_BYTES).
+    Возвращает (отпечаток источника, список описаний ошибок верификации — пустой, если копия проверена).
+    Ошибки копирования пробрасываются как исключения.
+    """
+    verifier = verifier or VERIFIERS[DEFAULT_VERIFY]
+    buffer = buffer if buffer is not None else bytearray(COPY_BUFFER_BYTES)
+    source_digest, _ = write_file_copy(source_file, dest_file, buffer, verifier)
+    dest_digest = verifier.digest_file(dest_file, buffer, drop_cache=True)
+    return source_digest, verification_problems(verifier, source_digest, dest_digest, dest_file)
+
+
+# Сколько байт начала каждого файла читается заранее при копировании (куски обычно помещаются целиком)
+COPY_PREFETCH_BYTES = 4 * COPY_BUFFER_BYTES
+
+
+class PrefetchedSource:
+    """
+    Начало файла-источника, заранее прочитанное в буферы из общего пула, и отпечаток прочитанного.
+    Файл больше COPY_PREFETCH_BYTES дочитывается при записи. release() возвращает буферы в пул.
+    """
+
+    def __init__(self, source_file, verifier, buffer_pool):
+        self.buffer_pool = buffer_pool
+        self.blocks = [] # (буфер, заполнено байт)
+        self.digest = verifier.new_hash() if verifier.reads_back else None
+        self.size = 0
+        self.complete = False
+        try:
+            with open(source_file, "rb", buffering=0) as f:
+                while self.size < COPY_PREFETCH_BYTES:
+                    buffer = buffer_pool.pop()
+                    size = f.readinto(buffer)
+                    if not size:
+                        buffer_pool.append(buffer)
+                        self.complete = True
+                        break
+                    self.blocks.append((buffer, size))
+                    if self.digest:
+                        self.digest.update(memoryview(buffer)[:size])
+                    self.size += size
+        except BaseException:
+            self.release()
+            raise
+
+    def release(self):
+        for buffer, _ in self.blocks:
+            self.buffer_pool.append(buffer)
+        self.blocks = []
+
+
+def write_file_copy(source_file, dest_file, buffer, verifier, prefetched=None):
+    """
+    Записывает копию блоками через переиспользуемый buffer, по пути считая отпечаток источника,
+    и сбрасывает ее на устройство (fsync), вытесняя из страничного кэша для проверки.
+    prefetched (PrefetchedSource) — уже прочитанное начало файла: оно пишется первым, остальное дочитывается.
+    Возвращает (отпечаток источника, размер в байтах).
+    """
+    view = memoryview(buffer)
+    os.makedirs(os.path.dirname(dest_file), exist_ok=True)
+    digest = verifier.new_hash() if verifier.reads_back else None
+    copied_size = 0
+    with open(source_file, "rb", buffering=0) as source, open(dest_file, "wb") as dest:
+        if prefetched:
+            digest = prefetched.digest
+            for block, size in prefetched.blocks:
+                dest.write(memoryview(block)[:size])
+            copied_size = prefetched.size
+            source.seek(copied_size)
+        while not (prefetched and prefetched.complete):
+            size = source.readinto(buffer)
+            if not size:
+                break
+            if digest:
+                digest.update(view[:size])
+            dest.write(view[:size])
+            copied_size += size
+        dest.flush()
+        os.fsync(dest.fileno())
+        _drop_file_cache(dest.fileno())
+    shutil.copystat(source_file, dest_file)
+    if not verifier.enabled:
+        return "", copied_size
+    return (digest.hexdigest() if digest else str(copied_size)), copied_size
 
-    print(f"--- Обработка файла {input_file} завершена ---")
-    print("═══════════════════════════════════════════════════════════")
-    
-    return stats
 
+# Размер синтетического файла и число попыток для --bench-verify
+BENCH_VERIFY_SIZE_MB = 64
+BENCH_VERIFY_ROUNDS = 3
 
-def calculate_sha256(filepath):
-    """Вычисляет SHA256 хеш файла."""
-    sha256_hash = hashlib.sha256()
+
+def _timed(function, *args):
+    start = time.perf_counter()
+    function(*args)
+    return time.perf_counter() - start
+
+
+def bench_verifiers(size_mb=BENCH_VERIFY_SIZE_MB, rounds=BENCH_VERIFY_ROUNDS):
+    """
+    Измеряет скорость (МБ/с) каждого способа проверки из VERIFIERS на синтетическом файле.
+    Файл читается из страничного кэша, поэтому измеряется стоимость самой проверки, а не скорость диска.
+    Возвращает словарь имя -> МБ/с (None — без чтения файла).
+    """
+    size = int(size_mb * 1024 * 1024)
+    buffer = bytearray(COPY_BUFFER_BYTES)
+    results = {}
+    with NamedTemporaryFile(suffix=".bin", delete=False) as f:
+        bench_path = f.name
+        block = os.urandom(COPY_BUFFER_BYTES)
+        for offset in range(0, size, len(block)):
+            f.write(block[:size - offset])
     try:
-        with open(filepath, "rb") as f:
-            # Читаем файл кусками, чтобы не загружать большие файлы в память целиком
-            for byte_block in iter(lambda: f.read(4096), b""):
-                sha256_hash.update(byte_block)
-        return sha256_hash.hexdigest()
-    except FileNotFoundError:
-        print(f"  Ошибка: Файл не найден при вычислении хеша: {filepath}")
-        return None
-    except Exception as e:
-        print(f"  Ошибка чтения файла при вычислении хеша ({filepath}): {e}")
-        return None
+        print(f"Скорость способов проверки копий (--verify) на этой машине: файл {size_mb:g} МБ, лучшая из {rounds} попыток.")
+        for name, verifier in VERIFIERS.items():
+            if not verifier.reads_back:
+                results[name] = None
+                print(f"  {name:<8} копия не читается обратно ({'только сравнение размера' if verifier.enabled else 'без проверки'})")
+                continue
+            verifier.digest_file(bench_path, buffer)  # прогрев страничного кэша
+            best_s = min(_timed(verifier.digest_file, bench_path, buffer) for _ in range(rounds))
+            results[name] = size / 1024**2 / best_s if best_s > 0 else float('inf')
+            print(f"  {name:<8} {format_rate(size, best_s)}")
+    finally:
+        os.remove(bench_path)
+    return results
+
 
+# Сколько файлов читается заранее и сколько копий проверяется параллельно при копировании (--copy-jobs)
+DEFAULT_COPY_JOBS = 2
 
-def copy_with_verify(source_root, dest_root):
-    """Копирует файлы из source_root в dest_root с проверкой хеша."""
+
+def format_rate(size_bytes, seconds):
+    """Скорость в МБ/с для вывода."""
+    return f"{size_bytes / 1024**2 / seconds:.1f} МБ/с" if seconds > 0 else "— МБ/с"
+
+
+def copy_with_verify(source_root, dest_root, already_copied=None, device_manifest=None, prune_roots=None,
+                     copy_jobs=DEFAULT_COPY_JOBS, verify=DEFAULT_VERIFY):
+    """
+    Копирует файлы из source_root в dest_root с проверкой хеша.
+    already_copied — относительные пути файлов, уже скопированных и проверенных стадией
+    копирования конвейера (DeviceCopier); они не копируются повторно.
+    device_manifest (DeviceManifest, --sync) — копируются только новые и измененные файлы.
+    prune_roots — с device_manifest удалить с устройства файлы манифеста, которых нет ни в source_root,
+    ни в одной из этих папок (например, в папке уже скопированных файлов).
+    copy_jobs — на сколько файлов вперед источники читаются и хешируются (начало каждого, не больше
+    COPY_PREFETCH_BYTES) и сколько копий проверяется параллельно; на устройство файлы записываются
+    по одному в порядке имен.
+    verify — способ проверки копий (ключ VERIFIERS).
+    """
     abs_source_root = os.path.abspath(source_root)
     abs_dest_root = os.path.abspath(dest_root)
+    already_copied = already_copied or set()
 
-    print(f"\nЗапуск копирования из '{abs_source_root}' в '{abs_dest_root}' с проверкой...")
+    verifier = VERIFIERS[verify]
+    if verifier.enabled:
+        print(f"\nЗапуск копирования из '{abs_source_root}' в '{abs_dest_root}' с проверкой ({verifier.name})...")
+    else:
+        print(f"\nЗапуск копирования из '{abs_source_root}' в '{abs_dest_root}' без проверки...")
 
     if not os.path.isdir(abs_source_root):
         print(f"Ошибка: Исходная директория для копирования не найдена: {abs_source_root}")
@@ -352,62 +2707,151 @@ def copy_with_verify(source_root, dest_root):
         files.sort()
         dirs.sort()
         for filename in files:
+            if is_service_file(filename):
+                continue # Служебные файлы выходной папки на устройство не нужны
             source_path = os.path.join(root, filename)
             relative_path = os.path.relpath(source_path, abs_source_root)
             files_to_copy.append(relative_path)
 
     files_to_copy.sort()
 
-    if not files_to_copy:
+    if not files_to_copy and not (device_manifest and prune_roots is not None):
         print("В исходной директории нет файлов для копирования.")
         return True # Nothing to copy is not an error in itself
 
     print(f"Найдено {len(files_to_copy)} файлов для копирования.")
     copied_count = 0
     verified_count = 0
+    unchanged_count = 0
     copy_errors = 0
     verification_errors = 0
+    copied_bytes = 0
+    copy_jobs = max(1, copy_jobs)
+    # Буферы проверки переиспользуются потоками пула (одновременно проверяется не больше copy_jobs файлов),
+    # запись дочитывает большие файлы через свой буфер
+    buffers = collections.deque(bytearray(COPY_BUFFER_BYTES) for _ in range(copy_jobs))
+    write_buffer = bytearray(COPY_BUFFER_BYTES)
+    # Пул упреждающего чтения: copy_jobs читаемых вперед файлов и записываемый файл, память не зависит
+    # от размера файлов
+    prefetch_pool = collections.deque(bytearray(COPY_BUFFER_BYTES) for _ in
+                                      range((copy_jobs + 1) * (COPY_PREFETCH_BYTES // COPY_BUFFER_BYTES)))
 
-    for i, relative_path in enumerate(files_to_copy):
-        source_file = os.path.join(abs_source_root, relative_path)
-        dest_file = os.path.join(abs_dest_root, relative_path)
-        dest_dir = os.path.dirname(dest_file)
-
-        print(f"[{i+1}/{len(files_to_copy)}] Копирование: {relative_path}", end='')
-
+    def verify_copy(dest_file):
+        buffer = buffers.pop()
         try:
-            os.makedirs(dest_dir, exist_ok=True)
-            shutil.copy2(source_file, dest_file)
-            copied_count += 1
-            print(f" -> Скопирован...", end='')
+            return verifier.digest_file(dest_file, buffer, drop_cache=True)
+        finally:
+            buffers.append(buffer)
 
-            print(" Проверка...", end='')
-            source_hash = calculate_sha256(source_file)
-            dest_hash = calculate_sha256(dest_file)
+    def report(entry):
+        # Результаты выводятся строго в порядке файлов, даже если проверки завершаются в другом порядке
+        nonlocal copied_count, verified_count, copy_errors, verification_errors, copied_bytes
+        number, relative_path, source_file, source_hash, future, size, write_s = entry
+        print(f"[{number}/{len(files_to_copy)}] Копирование: {relative_path}", end='')
+        try:
+            dest_hash = future.result()
+        except Exception as e:
+            print(f" ОШИБКА КОПИРОВАНИЯ! {e}")
+            copy_errors += 1
+            return
+        copied_count += 1
+        copied_bytes += size
+        if not verifier.enabled:
+            print(f" -> Скопирован ({format_rate(size, write_s)}), без проверки")
+            if device_manifest:
+                device_manifest.record(relative_path, source_file, source_hash, verifier.name)
+            return
+        print(f" -> Скопирован ({format_rate(size, write_s)}), проверка...", end='')
+        problems = verification_problems(verifier, source_hash, dest_hash, os.path.join(abs_dest_root, relative_path))
+        if not problems:
+            print(" OK")
+            verified_count += 1
+            if device_manifest:
+                device_manifest.record(relative_path, source_file, source_hash, verifier.name)
+        else:
+            print(" ОШИБКА ВЕРИФИКАЦИИ!")
+            for problem in problems:
+                print(f"    {problem}")
+            verification_errors += 1
 
-            if source_hash and dest_hash and source_hash == dest_hash:
-                print(" OK")
+    copy_start_time = time.time()
+    # Потоки для упреждающего чтения и для проверки копий
+    executor = ThreadPoolExecutor(max_workers=2 * copy_jobs)
+    try:
+        jobs = []
+        for i, relative_path in enumerate(files_to_copy):
+            source_file = os.path.join(abs_source_root, relative_path)
+            if relative_path in already_copied:
+                print(f"[{i+1}/{len(files_to_copy)}] Уже скопирован и проверен во время обработки: {relative_path}")
+                copied_count += 1
                 verified_count += 1
+            elif device_manifest and device_manifest.is_current(relative_path, source_file):
+                print(f"[{i+1}/{len(files_to_copy)}] Без изменений на устройстве: {relative_path}")
+                unchanged_count += 1
             else:
-                print(" ОШИБКА ВЕРИФИКАЦИИ!")
-                if not source_hash:
-                    print(f"    Не удалось вычислить хеш источника: {source_file}")
-                if not dest_hash:
-                    print(f"    Не удалось вычислить хеш назначения: {dest_file}")
-                if source_hash and dest_hash:
-                    print(f"    Источник хеш: {source_hash}")
-                    print(f"    Назначение хеш: {dest_hash}")
-                verification_errors += 1
+                jobs.append((i + 1, relative_path, source_file))
 
-        except Exception as e:
-            print(f" ОШИБКА КОПИРОВАНИЯ! {e}")
-            copy_errors += 1
+        # Источники читаются и хешируются в пуле на copy_jobs файлов вперед, а запись на устройство идет
+        # в этом потоке строго по порядку: плеер воспроизводит файлы в порядке создания записей каталога.
+        # Проверка записанной копии идет в пуле, пока пишется следующий файл.
+        reads = collections.deque()
+        verifications = collections.deque()
+        next_read = 0
+        for number, relative_path, source_file in jobs:
+            while next_read < len(jobs) and len(reads) < copy_jobs:
+                reads.append(executor.submit(PrefetchedSource, jobs[next_read][2], verifier, prefetch_pool))
+                next_read += 1
+            dest_file = os.path.join(abs_dest_root, relative_path)
+            source_hash, size, write_s = None, 0, 0
+            try:
+                prefetched = reads.popleft().result()
+                try:
+                    if device_manifest:
+                        device_manifest.forget(relative_path)
+                    write_start = time.time()
+                    source_hash, size = write_file_copy(source_file, dest_file, write_buffer, verifier, prefetched)
+                    write_s = time.time() - write_start
+                finally:
+                    prefetched.release()
+                if verifier.reads_back:
+                    future = executor.submit(verify_copy, dest_file)
+                else:
+                    future = Future()
+                    future.set_result(verifier.digest_file(dest_file))
+            except Exception as e:
+                future = Future()
+                future.set_exception(e)
+            verifications.append((number, relative_path, source_file, source_hash, future, size, write_s))
+            while verifications and (verifications[0][4].done() or len(verifications) > copy_jobs):
+                report(verifications.popleft())
+        while verifications:
+            report(verifications.popleft())
+        copy_elapsed_s = time.time() - copy_start_time
+
+        pruned_count = 0
+        if device_manifest and prune_roots is not None:
+            # Файл удален из библиотеки, если его нет ни среди копируемых, ни в папках prune_roots
+            keep = set(files_to_copy)
+            keep.update(relative_path for relative_path in device_manifest.paths()
+                        if any(os.path.exists(os.path.join(root, relative_path)) for root in prune_roots))
+            pruned_count = device_manifest.prune(keep)
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+        if device_manifest:
+            # Сохраняется и при прерывании: уже скопированные файлы не будут копироваться заново
+            device_manifest.save()
 
     print("\n--------------------------------------")
     print("Копирование завершено.")
     print(f"Всего файлов для копирования: {len(files_to_copy)}")
+    if device_manifest:
+        print(f"Без изменений (уже на устройстве): {unchanged_count}")
     print(f"Успешно скопировано: {copied_count}")
     print(f"Успешно проверено: {verified_count}")
+    if copied_bytes:
+        print(f"Скорость копирования: {format_rate(copied_bytes, copy_elapsed_s)} ({copied_bytes / 1024**2:.1f} МБ за {copy_elapsed_s:.1f} сек)")
+    if pruned_count:
+        print(f"Удалено с устройства (нет в источнике): {pruned_count}")
     success = True
     if copy_errors > 0:
         print(f"Ошибок копирования: {copy_errors}")
@@ -419,8 +2863,258 @@ def copy_with_verify(source_root, dest_root):
     return success
 
 
+# Манифест устройства в корне --copy-to: какие файлы скопированы и с какого источника (--sync)
+DEVICE_MANIFEST_NAME = ".mp3_autocut_device.json"
+DEVICE_MANIFEST_VERSION = 1
+
+
+class DeviceManifest:
+    """
+    Манифест устройства для инкрементальной синхронизации (--sync). Хранится в корне папки назначения
+    и для каждого скопированного файла (путь относительно корня) хранит размер, отпечаток копии
+    (и способ проверки --verify, которым он получен) и размер/mtime источника, с которого сделана копия. По нему повторная синхронизация копирует только новые
+    и измененные файлы, а --prune удаляет с устройства файлы, удаленные из библиотеки.
+    """
+
+    def __init__(self, dest_root):
+        self.dest_root = os.path.abspath(dest_root)
+        self.path = os.path.join(self.dest_root, DEVICE_MANIFEST_NAME)
+        self.entries = {}
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            if data.get('version') == DEVICE_MANIFEST_VERSION:
+                self.entries = data.get('files', {})
+        except (OSError, ValueError) as e:
+            print(f"Предупреждение: Манифест устройства {self.path} не прочитан ({e}), все файлы будут скопированы заново.")
+
+    @staticmethod
+    def _key(relative_path):
+        return relative_path.replace(os.sep, "/")
+
+    def paths(self):
+        """Относительные пути (в формате ОС) всех файлов манифеста."""
+        return [key.replace("/", os.sep) for key in self.entries]
+
+    def is_current(self, relative_path, source_file):
+        """Есть ли на устройстве проверенная копия source_file с тем же содержимым."""
+        entry = self.entries.get(self._key(relative_path))
+        if not entry:
+            return False
+        try:
+            if os.path.getsize(os.path.join(self.dest_root, relative_path)) != entry['size']:
+                return False
+            signature = ProcessingManifest.source_signature(source_file)
+        except OSError:
+            return False
+        if signature == entry.get('source'):
+            return True
+        if signature['size'] != entry['size']:
+            return False
+        # Файл пересоздан (например, повторной нарезкой), но мог не измениться: локальное чтение
+        # намного быстрее повторной записи на устройство. Без хеша содержимого (size, none) копируем заново
+        verifier = VERIFIERS.get(entry.get('verify'))
+        if not verifier or not verifier.reads_back or verifier.digest_file(source_file) != entry.get('hash'):
+            return False
+        entry['source'] = signature
+        return True
+
+    def record(self, relative_path, source_file, digest, verify=DEFAULT_VERIFY):
+        signature = ProcessingManifest.source_signature(source_file)
+        self.entries[self._key(relative_path)] = {'size': signature['size'], 'hash': digest, 'verify': verify,
+                                                  'source': signature}
+
+    def forget(self, relative_path):
+        self.entries.pop(self._key(relative_path), None)
+
+    def prune(self, keep):
+        """
+        Удаляет с устройства файлы манифеста, которых нет в keep (относительные пути), и опустевшие
+        после этого папки. Файлы, которых нет в манифесте, не трогаются. Возвращает число удаленных файлов.
+        """
+        keep = {self._key(relative_path) for relative_path in keep}
+        removed = 0
+        for key in sorted(set(self.entries) - keep):
+            dest_file = os.path.join(self.dest_root, key.replace("/", os.sep))
+            try:
+                os.remove(dest_file)
+                print(f"  Удален с устройства: {key}")
+                removed += 1
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                print(f"  Предупреждение: Не удалось удалить с устройства {dest_file}: {e}")
+                continue
+            del self.entries[key]
+            folder = os.path.dirname(dest_file)
+            while folder != self.dest_root and folder.startswith(self.dest_root):
+                try:
+                    os.rmdir(folder)
+                except OSError:
+                    break  # папка не пуста
+                folder = os.path.dirname(folder)
+        return removed
+
+    def save(self):
+        try:
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({'version': DEVICE_MANIFEST_VERSION, 'files': self.entries}, f, ensure_ascii=False, indent=1)
+            os.replace(tmp_path, self.path) # Атомарно: прерванная запись не портит манифест
+        except OSError as e:
+            print(f"Предупреждение: Не удалось сохранить манифест устройства {self.path}: {e}")
+
+
+# Сколько готовых кусков может ждать копирования на устройство; дальше нарезка ждет копирование
+DEFAULT_COPY_QUEUE_CHUNKS = 16
+
+
+class DeviceCopier:
+    """
+    Стадия копирования конвейера обработки: каждый готовый кусок копируется на устройство (--copy-to)
+    с проверкой (verify — ключ VERIFIERS) в фоновом потоке, пока кодируются следующие куски и файлы.
+    Очередь ограничена max_pending кусками: если устройство медленнее кодирования, нарезка ждет,
+    а не копит готовые куски. Куски копируются по одному в порядке готовности, поэтому порядок кусков
+    файла и порядок файлов на устройстве сохраняется. Результаты выводятся из вызывающего потока.
+    С device_manifest (--sync) файлы, уже актуальные на устройстве, не копируются.
+    Плеер воспроизводит файлы в порядке записей каталога, поэтому конвейер останавливается (остальное
+    копирует copy_with_verify после обработки, по порядку имен), как только файл пришлось бы записать
+    раньше предшествующего ему по имени: если копирование не удалось, если в source_root уже лежат
+    еще не скопированные файлы раньше по имени (например, пропущенные --skip-existing) или если файлы
+    готовы не в порядке имен.
+    """
+
+    def __init__(self, source_root, dest_root, max_pending=DEFAULT_COPY_QUEUE_CHUNKS, device_manifest=None,
+                 verify=DEFAULT_VERIFY):
+        self.source_root = os.path.abspath(source_root)
+        self.dest_root = os.path.abspath(dest_root)
+        self.max_pending = max(1, max_pending)
+        self.device_manifest = device_manifest
+        self.verifier = VERIFIERS[verify]
+        self.copied = set()  # относительные пути скопированных и проверенных файлов
+        self.errors = 0
+        self.started_at = time.time()
+        self.first_ready_s = None  # через сколько секунд первый кусок оказался на устройстве
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._pending = collections.deque()
+        self._buffer = bytearray(COPY_BUFFER_BYTES)  # используется только потоком копирования
+        self._stopped = False  # конвейер остановлен, остальные файлы копируются после обработки
+        self._failed = False  # копирование не удалось (флаг ставит поток копирования)
+        self._last_submitted = None
+        self._submitted = set()
+        # Файлы, которые уже лежат в source_root и будут скопированы после обработки (в порядке имен)
+        self._waiting = collections.deque(sorted(
+            relative_path for relative_path in list_result_files(self.source_root)
+            if not (device_manifest and device_manifest.is_current(relative_path,
+                                                                   os.path.join(self.source_root, relative_path)))))
+
+    def _stop(self, reason):
+        if not self._stopped:
+            self._stopped = True
+            print(f"  📲 Копирование во время обработки остановлено: {reason}. "
+                  f"Остальные файлы будут скопированы после обработки по порядку имен.")
+
+    def _copy(self, source_file, relative_path):
+        # Поток копирования один, поэтому после неудачи следующие файлы очереди уже не пишутся
+        if self._stopped or self._failed:
+            return None
+        try:
+            source_hash, problems = copy_file_with_verify(source_file, os.path.join(self.dest_root, relative_path),
+                                                          self._buffer, self.verifier)
+        except Exception as e:
+            source_hash, problems = None, [f"Ошибка копирования: {e}"]
+        if problems:
+            self._failed = True
+        return source_hash, problems, time.time()
+
+    def _collect_oldest(self):
+        relative_path, source_file, future = self._pending.popleft()
+        result = future.result()
+        if result is None:
+            return  # Скопируется после обработки
+        source_hash, problems, finished_at = result
+        if problems:
+            self.errors += 1
+            print(f"  📲 Не удалось скопировать на устройство {relative_path} (будет повторено после обработки):")
+            for problem in problems:
+                print(f"    {problem}")
+            self._stop("ошибка копирования")
+            return
+        self.copied.add(relative_path)
+        if self.device_manifest:
+            self.device_manifest.record(relative_path, source_file, source_hash, self.verifier.name)
+        if self.first_ready_s is None:
+            self.first_ready_s = finished_at - self.started_at
+            print(f"  📲 Первый кусок на устройстве через {self.first_ready_s:.1f} сек.")
+        print(f"  📲 На устройстве: {relative_path}")
+
+    def submit(self, source_file):
+        """Ставит готовый файл из source_root в очередь копирования (ждет, если очередь заполнена)."""
+        while len(self._pending) >= self.max_pending:
+            self._collect_oldest()
+        relative_path = os.path.relpath(os.path.abspath(source_file), self.source_root)
+        if self.device_manifest and self.device_manifest.is_current(relative_path, source_file):
+            self.copied.add(relative_path)
+            print(f"  📲 Без изменений на устройстве: {relative_path}")
+            return
+        self._submitted.add(relative_path)
+        # Файлы, которые уже отданы в конвейер или удалены (устаревшие куски), копирования после обработки не ждут
+        while self._waiting and (self._waiting[0] in self._submitted
+                                 or not os.path.exists(os.path.join(self.source_root, self._waiting[0]))):
+            self._waiting.popleft()
+        if self._waiting and self._waiting[0] < relative_path:
+            self._stop(f"раньше по имени ждет копирования {self._waiting[0]}")
+        elif self._last_submitted is not None and relative_path < self._last_submitted:
+            self._stop(f"{relative_path} готов позже {self._last_submitted}")
+        self._last_submitted = relative_path
+        if self._stopped:
+            return
+        if self.device_manifest:
+            self.device_manifest.forget(relative_path)
+        self._pending.append((relative_path, source_file, self._executor.submit(self._copy, source_file, relative_path)))
+        # Уже законченные копирования выводятся сразу, не дожидаясь заполнения очереди
+        while self._pending and self._pending[0][2].done():
+            self._collect_oldest()
+
+    def close(self, cancel=False):
+        """Дожидается копирования всех кусков очереди (cancel=True — отменяет ожидающие). Возвращает copied."""
+        if cancel:
+            for _, _, future in self._pending:
+                future.cancel()
+            self._pending.clear()
+        while self._pending:
+            self._collect_oldest()
+        self._executor.shutdown(wait=True)
+        return self.copied
+
+
+def list_result_files(root_dir):
+    """Относительные пути файлов результатов в дереве папок (без служебных)."""
+    return [os.path.relpath(os.path.join(root, name), root_dir)
+            for root, _, files in os.walk(root_dir) for name in files if not is_service_file(name)]
+
+
+def count_files(root_dir):
+    """Число файлов результатов в дереве папок без служебных (читаются только записи каталогов)."""
+    return sum(1 for _, _, files in os.walk(root_dir) for name in files if not is_service_file(name))
+
+
+def has_service_files(root_dir):
+    """Есть ли в дереве папок служебные файлы (манифест, контрольная точка, недописанный кусок)."""
+    return any(is_service_file(name) for _, _, files in os.walk(root_dir) for name in files)
+
+
 def move_files_structure(source_root, move_dest_root):
-    """Перемещает все файлы из source_root в move_dest_root, сохраняя структуру папок."""
+    """
+    Перемещает все файлы из source_root в move_dest_root, сохраняя структуру папок.
+    На одной файловой системе папка, которой еще нет в назначении, переименовывается целиком одной
+    операцией (данные файлов не читаются), а существующие папки объединяются по содержимому.
+    Между разными устройствами файлы перемещаются по одному. Служебные файлы (is_service_file) остаются
+    на месте, а папка с ними объединяется по файлам. Опустевшие папки источника удаляются в том же проходе;
+    сама папка source_root остается.
+    """
     abs_source_root = os.path.abspath(source_root)
     abs_move_dest_root = os.path.abspath(move_dest_root)
 
@@ -437,79 +3131,83 @@ def move_files_structure(source_root, move_dest_root):
         print(f"Ошибка создания корневой директории для перемещения {abs_move_dest_root}: {e}")
         return False
 
-    files_to_move = []
-    # Собираем список файлов для перемещения
-    for root, dirs, files in os.walk(abs_source_root):
-        for filename in files:
-            source_path = os.path.join(root, filename)
-            relative_path = os.path.relpath(source_path, abs_source_root)
-            files_to_move.append(relative_path)
-
-    # Сортируем для предсказуемости (хотя порядок для move менее критичен)
-    files_to_move.sort()
-
-    if not files_to_move:
+    total_files = count_files(abs_source_root)
+    if not total_files:
         print("В исходной директории нет файлов для перемещения.")
         return True
 
-    print(f"Найдено {len(files_to_move)} файлов для перемещения.")
+    same_device = os.stat(abs_source_root).st_dev == os.stat(abs_move_dest_root).st_dev
+    print(f"Найдено {total_files} файлов для перемещения." +
+          ("" if same_device else " Назначение на другом устройстве: файлы перемещаются по одному."))
     moved_count = 0
+    renamed_folders_count = 0
+    deleted_folders_count = 0
     move_errors = 0
 
-    # Перемещаем файлы
-    for i, relative_path in enumerate(files_to_move):
-        source_file = os.path.join(abs_source_root, relative_path)
-        dest_file = os.path.join(abs_move_dest_root, relative_path)
-        dest_dir = os.path.dirname(dest_file)
-
-        # Проверяем, существует ли еще исходный файл (на случай ошибок на пред. шагах)
-        if not os.path.exists(source_file):
-            print(f"[{i+1}/{len(files_to_move)}] Пропуск: Исходный файл уже не существует: {relative_path}")
-            continue
-
-        print(f"[{i+1}/{len(files_to_move)}] Перемещение: {relative_path}", end='')
+    def move_tree(source_dir, dest_dir):
+        # Обход в глубину: папка источника удаляется сразу после того, как из нее все перемещено
+        nonlocal moved_count, renamed_folders_count, deleted_folders_count, move_errors
         try:
-            # Создаем папку назначения, если нужно
-            os.makedirs(dest_dir, exist_ok=True)
-            # Перемещаем файл
-            shutil.move(source_file, dest_file)
-            moved_count += 1
-            print(" -> OK")
-        except Exception as e:
-            print(f" ОШИБКА ПЕРЕМЕЩЕНИЯ! {e}")
+            entries = sorted(os.scandir(source_dir), key=lambda entry: entry.name)
+        except OSError as e:
+            print(f"  Ошибка чтения папки {source_dir}: {e}")
             move_errors += 1
-
-    # После перемещения всех файлов, удаляем пустые директории в источнике
-    print(f"\nПроверка и удаление пустых папок в исходной директории: {abs_source_root}...")
-    deleted_folders_count = 0
-    try:
-        # Проходим по дереву папок снизу вверх (topdown=False)
-        # Это важно, чтобы сначала пытаться удалить дочерние папки, а потом родительские
-        for root, dirs, files in os.walk(abs_source_root, topdown=False):
-            if not dirs and not files: # Если в папке нет ни подпапок, ни файлов
-                # Проверяем, что это не сама корневая папка, из которой перемещали,
-                # если только она не была единственной и теперь пуста.
-                # Хотя os.rmdir(abs_source_root) сработает, если она пуста.
+            return
+        for entry in entries:
+            dest_path = os.path.join(dest_dir, entry.name)
+            relative_path = os.path.relpath(entry.path, abs_source_root)
+            is_dir = entry.is_dir(follow_symlinks=False)
+            if not is_dir and is_service_file(entry.name):
+                continue # Манифест обработки, контрольные точки и .part файлы нужны в выходной папке
+            if same_device and not os.path.lexists(dest_path) and not (is_dir and has_service_files(entry.path)):
+                files_count = count_files(entry.path) if is_dir else 1
                 try:
-                    os.rmdir(root)
-                    print(f"  Удалена пустая папка: {root}")
-                    deleted_folders_count +=1
+                    # Одна операция на все поддерево: атомарно и без копирования данных
+                    os.rename(entry.path, dest_path)
+                    moved_count += files_count
+                    if is_dir:
+                        renamed_folders_count += 1
+                        print(f"  Перемещена папка целиком: {relative_path} "
+                              f"({files_count} {plural_ru(files_count, 'файл', 'файла', 'файлов')})")
+                    continue
                 except OSError as e:
-                    # Возможна ошибка, если папка не пуста (например, из-за .DS_Store или других скрытых файлов)
-                    # или если это корень файловой системы (хотя это маловероятно здесь)
-                    print(f"  Не удалось удалить папку {root}: {e}")
-        if deleted_folders_count > 0:
-            print(f"Удалено пустых папок: {deleted_folders_count}")
-        else:
-            print("Пустых папок для удаления не найдено.")
-    except Exception as e: # Более общее исключение на случай непредвиденных ошибок с os.walk
-        print(f"Ошибка при попытке удаления пустых исходных папок: {e}")
+                    print(f"  Не удалось переименовать {relative_path} ({e}), перемещение по одному файлу.")
+            if is_dir:
+                try:
+                    os.makedirs(dest_path, exist_ok=True)
+                except OSError as e:
+                    print(f"  ОШИБКА ПЕРЕМЕЩЕНИЯ папки {relative_path}! {e}")
+                    move_errors += count_files(entry.path)
+                    continue
+                move_tree(entry.path, dest_path)
+                continue
+            try:
+                # shutil.move, а не os.replace: папка могла не переименоваться из-за вложенной точки монтирования
+                # (EXDEV), и тогда файл нужно скопировать и удалить
+                shutil.move(entry.path, dest_path)
+                moved_count += 1
+            except Exception as e:
+                print(f"  ОШИБКА ПЕРЕМЕЩЕНИЯ! {relative_path}: {e}")
+                move_errors += 1
+        # Папка с оставшимися служебными файлами (например, контрольной точкой) не удаляется
+        if source_dir != abs_source_root and not has_service_files(source_dir):
+            try:
+                os.rmdir(source_dir)
+                deleted_folders_count += 1
+            except OSError as e:
+                # Возможна ошибка, если папка не пуста (например, из-за файла, который не удалось переместить)
+                print(f"  Не удалось удалить папку {source_dir}: {e}")
 
+    move_tree(abs_source_root, abs_move_dest_root)
 
     print("\n--------------------------------------")
     print("Перемещение завершено.")
-    print(f"Всего файлов для перемещения: {len(files_to_move)}")
+    print(f"Всего файлов для перемещения: {total_files}")
     print(f"Успешно перемещено: {moved_count}")
+    if renamed_folders_count:
+        print(f"Папок перемещено целиком: {renamed_folders_count}")
+    if deleted_folders_count:
+        print(f"Удалено пустых папок: {deleted_folders_count}")
     success = True
     if move_errors > 0:
         print(f"Ошибок перемещения: {move_errors}")
@@ -518,7 +3216,91 @@ def move_files_structure(source_root, move_dest_root):
     return success
 
 
-def get_total_and_cumulative_durations(mp3_files):
+# Сколько байт читается с начала файла для поиска первого кадра и тегов Xing/VBRI/LAME
+DURATION_PROBE_HEAD_BYTES = 64 * 1024
+# Сколько байт читается из середины файла, чтобы убедиться, что файл без тегов действительно CBR
+DURATION_PROBE_SAMPLE_BYTES = 16 * 1024
+
+
+def _frame_chain_bitrates(data, pos, max_frames):
+    """Битрейты цепочки кадров, идущих подряд с позиции pos (до max_frames или до первого сбоя)."""
+    bitrates = []
+    while len(bitrates) < max_frames and pos + 4 <= len(data):
+        info = parse_mp3_frame_header(data[pos:pos + 4])
+        if info is None:
+            break
+        bitrates.append(info['bitrate'])
+        pos += info['frame_size']
+    return bitrates
+
+
+def _find_frame_chain(data, min_frames=3):
+    """Позиция первой цепочки из min_frames кадров подряд в data (для чтения с произвольного места файла)."""
+    for pos in range(max(0, len(data) - 3)):
+        if data[pos] == 0xFF and len(_frame_chain_bitrates(data, pos, min_frames)) == min_frames:
+            return pos
+    return None
+
+
+def probe_mp3_duration_ms(filepath):
+    """
+    Быстро определяет длительность MP3 без декодирования: по тегу Xing/Info (с задержкой и паддингом из LAME)
+    или VBRI в первом кадре, а если их нет — по проходу по заголовкам всех кадров.
+    Возвращает длительность в мс или None, если MP3 кадры не найдены.
+    """
+    with open(filepath, "rb") as f:
+        head = f.read(10)
+        skip = _id3v2_size(head)
+        f.seek(skip)
+        head = f.read(DURATION_PROBE_HEAD_BYTES)
+        file_size = os.fstat(f.fileno()).st_size
+        f.seek(max(0, file_size - 128))
+        has_id3v1 = f.read(3) == b"TAG"
+        f.seek(skip + (file_size - skip) // 2)
+        middle = f.read(DURATION_PROBE_SAMPLE_BYTES)
+    pos = 0
+    while pos + 4 <= len(head):
+        info = parse_mp3_frame_header(head[pos:pos + 4])
+        if info and pos + info['frame_size'] <= len(head):
+            # Заголовок подтверждается следующим кадром, чтобы не принять случайные байты за кадр
+            next_pos = pos + info['frame_size']
+            next_info = parse_mp3_frame_header(head[next_pos:next_pos + 4])
+            if next_info is None or next_info['sample_rate'] == info['sample_rate']:
+                break
+        pos += 1
+    else:
+        return None
+    frame = memoryview(head)[pos:pos + info['frame_size']]
+    xing = _parse_xing_tag(frame, info)
+    frames_count = xing['frames'] if xing else _parse_vbri_tag(frame)
+    if frames_count:
+        samples = _mp3_decoded_samples(frames_count, info['samples_per_frame'], xing)
+        return round(1000 * samples / info['sample_rate'])
+    # Без тегов: если битрейт в начале и в середине файла один и тот же, это CBR и длительность следует из размера
+    head_bitrates = set(_frame_chain_bitrates(head, pos, 64))
+    middle_pos = _find_frame_chain(middle)
+    if len(head_bitrates) == 1 and middle_pos is not None:
+        if set(_frame_chain_bitrates(middle, middle_pos, 16)) == head_bitrates:
+            audio_bytes = file_size - skip - pos - (128 if has_id3v1 else 0)
+            return round(audio_bytes * 8 * 1000 / head_bitrates.pop())
+    # VBR без тегов — считаем кадры по заголовкам
+    frame_index = Mp3FrameIndex(filepath)
+    return frame_index.duration_ms() if len(frame_index) else None
+
+
+def _probe_duration_or_decode(filepath):
+    """Длительность файла в мс: заголовки MP3, а при неудаче — полное декодирование, как раньше."""
+    duration = probe_mp3_duration_ms(filepath)
+    if duration is None:
+        duration = len(AudioSegment.from_mp3(filepath))
+    return duration
+
+
+def get_total_and_cumulative_durations(mp3_files, library_index=None):
+    """
+    Общая длительность файлов и накопленная длительность до каждого из них (в мс).
+    С library_index известные длительности берутся из индекса, а вычисляются только новые и измененные файлы.
+    """
     total = 0
     cumulative = [0]
     total_files = len(mp3_files)
@@ -526,41 +3308,261 @@ def get_total_and_cumulative_durations(mp3_files):
     if total_files == 0:
         return total, cumulative[:-1]
     
-    print(f"Анализ длительностей {total_files} MP3 файлов...")
-    
-    for i, f in enumerate(mp3_files):
-        print(f"  [{i+1}/{total_files}] Анализ: {os.path.basename(f)}")
+    known = library_index.durations(mp3_files) if library_index else {}
+    to_probe = [f for f in mp3_files if known.get(f) is None]
+    if to_probe:
+        print(f"Анализ длительностей {len(to_probe)} из {total_files} MP3 файлов...")
+    else:
+        print(f"Длительности {total_files} MP3 файлов взяты из индекса библиотеки.")
+
+    # Файлы читаются только по заголовкам, поэтому параллельно в потоках; порядок результатов сохраняется
+    def probe(f):
         try:
-            dur = len(AudioSegment.from_mp3(f))
-            total += dur
-            cumulative.append(total)
+            return _probe_duration_or_decode(f), None
         except Exception as e:
-            print(f"    Ошибка при анализе файла {f}: {e}")
-            cumulative.append(total)  # добавляем текущий total без изменений
+            return None, e
+
+    probed = {}
+    with ThreadPoolExecutor() as executor:
+        for f, (dur, error) in zip(to_probe, executor.map(probe, to_probe)):
+            if error is not None:
+                print(f"  Ошибка при анализе файла {f}: {error}")
+                continue
+            probed[f] = dur
+    if library_index and probed:
+        library_index.set_durations(probed)
+
+    for f in mp3_files:
+        dur = known.get(f) if known.get(f) is not None else probed.get(f)
+        if dur is not None:
+            total += dur
+        cumulative.append(total)  # для файла с ошибкой добавляем текущий total без изменений
     
     hours, minutes = format_time(total)
     print(f"Анализ завершен. Общая длительность: {hours}ч {minutes}м")
     
     return total, cumulative[:-1]  # cumulative[i] — сумма до i-го файла
 
-def tts_to_wav(text, lang='ru'):
-    with NamedTemporaryFile(delete=False, suffix='.wav') as f:
+def combine_levels(file_levels):
+    """
+    Общие (RMS, пик) в dBFS нескольких файлов по их (длительность в мс, RMS, пик):
+    средний квадрат каждого файла взвешивается по длительности, пик — максимальный.
+    """
+    total_ms = sum(duration_ms for duration_ms, _, _ in file_levels)
+    energy = sum(duration_ms * 10 ** (rms_dbfs / 10) for duration_ms, rms_dbfs, _ in file_levels
+                 if rms_dbfs != float('-inf'))
+    rms_dbfs = 10 * np.log10(energy / total_ms) if energy > 0 and total_ms > 0 else float('-inf')
+    peak_dbfs = max((peak for _, _, peak in file_levels), default=float('-inf'))
+    return float(rms_dbfs), peak_dbfs
+
+
+def load_or_analyze_file(input_file, analysis_cache, silence_thresh_db, min_silence_len_ms, content_hash=None):
+    """
+    Анализ тишины файла из кэша или потоковым декодированием с сохранением в кэш (как в split_mp3).
+    Возвращает (анализ, SHA256 содержимого или None без кэша).
+    """
+    analysis = None
+    cache_key = None
+    if analysis_cache:
+        content_hash = content_hash or file_content_hash(input_file)
+        cache_key = analysis_cache.make_key(input_file, silence_thresh_db, min_silence_len_ms, content_hash=content_hash)
+        analysis = analysis_cache.load(cache_key)
+    if analysis is None:
+        analysis = analyze_audio_file(input_file, silence_thresh_db, min_silence_len_ms)
+        if cache_key:
+            analysis_cache.store(cache_key, analysis)
+    return analysis, content_hash
+
+
+def collect_book_levels(mp3_files, library_index, analysis_cache, silence_thresh_db, min_silence_len_ms, workers=1):
+    """
+    Уровни (длительность, RMS, пик) всех файлов книги для нормализации по книге. Известные уровни берутся
+    из индекса библиотеки; остальные файлы анализируются тем же проходом, что нужен для поиска тишины:
+    анализ сохраняется в кэш, и при нарезке файл повторно не декодируется.
+    Возвращает словарь путь -> уровни (файлы с ошибкой анализа пропускаются).
+    """
+    levels = {path: value for path, value in library_index.levels(mp3_files).items() if value is not None}
+    missing = [path for path in mp3_files if path not in levels]
+    if not missing:
+        return levels
+    print(f"Анализ громкости книги: {len(missing)} из {len(mp3_files)} MP3 файлов...")
+    if not analysis_cache:
+        print("  Кэш анализа отключен (--no-cache): при нарезке эти файлы будут проанализированы повторно.")
+    # Индекс библиотеки (SQLite) читается только в этом потоке
+    known_hashes = {path: library_index.get(path, 'content_hash') for path in missing}
+
+    def safe_analyze(path):
+        try:
+            return load_or_analyze_file(path, analysis_cache, silence_thresh_db, min_silence_len_ms,
+                                        known_hashes[path]), None
+        except Exception as e:
+            return None, e
+
+    # Декодирует ffmpeg в отдельных процессах, поэтому достаточно потоков
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        for path, (result, error) in zip(missing, executor.map(safe_analyze, missing)):
+            if error is not None:
+                print(f"  Ошибка анализа громкости {path}: {error}")
+                continue
+            analysis, content_hash = result
+            levels[path] = (analysis.duration_ms, analysis.original_rms, analysis.original_peak)
+            library_index.set_levels(path, *levels[path], content_hash=content_hash)
+    return levels
+
+
+# Параметры синтеза речи (входят в ключ кэша TTS)
+TTS_RATE = 180
+TTS_MAC_VOICE = 'Yuri (Enhanced)'
+# Кэш синтезированных фраз — подпапка папки кэша анализа
+TTS_CACHE_SUBDIR = "tts"
+# Суффикс временного файла синтеза в кэше TTS
+TTS_TMP_SUFFIX = ".tmp.wav"
+DEFAULT_TTS_CACHE_MAX_MB = 64
+
+_tts_engine = None
+
+
+def get_tts_engine():
+    """Один движок pyttsx3 на процесс: его инициализация дольше синтеза короткой фразы."""
+    global _tts_engine
+    if _tts_engine is None:
+        engine = pyttsx3.init()
+        engine.setProperty('rate', TTS_RATE)
+        # Пытаемся найти русский голос, если нет — используем дефолт
+        voices = engine.getProperty('voices')
+        ru_voices = [v.id for v in voices if 'ru' in v.id or 'russian' in v.name.lower()]
+        if ru_voices:
+            engine.setProperty('voice', ru_voices[0])
+        _tts_engine = engine
+    return _tts_engine
+
+
+def tts_voice():
+    """Описание голоса, которым синтезируются фразы (для ключа кэша TTS)."""
+    if platform.system() == 'Darwin':
+        return f"say:{TTS_MAC_VOICE}"
+    return f"pyttsx3:{get_tts_engine().getProperty('voice')}"
+
+
+# Размер заголовка WAV: файл не больше него не содержит звука
+WAV_HEADER_BYTES = 44
+
+
+def tts_to_wav(text, lang='ru', output_path=None):
+    """Синтезирует фразу в WAV. Если синтез не удался или файл пустой, удаляет его и бросает RuntimeError."""
+    with open(output_path, 'wb') if output_path else NamedTemporaryFile(delete=False, suffix='.wav') as f:
+        wav_path = f.name
+    try:
         if platform.system() == 'Darwin':
-            # Используем системный say с голосом Yuri (Enhanced)
-            voice = 'Yuri (Enhanced)'
-            subprocess.run(['say', '-v', voice, '-o', f.name, '--data-format=LEI16@44100', text])
+            # Используем системный say с голосом Yuri (Enhanced); формат файла say берет из расширения .wav
+            result = subprocess.run(['say', '-v', TTS_MAC_VOICE, '-o', wav_path, '--data-format=LEI16@44100', text],
+                                    stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+            if result.returncode != 0:
+                error_text = result.stderr.decode("utf-8", errors="replace").strip()
+                raise RuntimeError(f"say завершился с кодом {result.returncode}: {error_text}")
         else:
             # pyttsx3 для Windows/Linux
-            engine = pyttsx3.init()
-            engine.setProperty('rate', 180)
-            # Пытаемся найти русский голос, если нет — используем дефолт
-            voices = engine.getProperty('voices')
-            ru_voices = [v.id for v in voices if 'ru' in v.id or 'russian' in v.name.lower()]
-            if ru_voices:
-                engine.setProperty('voice', ru_voices[0])
-            engine.save_to_file(text, f.name)
+            engine = get_tts_engine()
+            engine.save_to_file(text, wav_path)
             engine.runAndWait()
-        return f.name
+        if os.path.getsize(wav_path) <= WAV_HEADER_BYTES:
+            raise RuntimeError(f"синтез речи создал пустой файл для фразы \"{text}\"")
+    except BaseException:
+        if os.path.exists(wav_path):
+            os.remove(wav_path)
+        raise
+    return wav_path
+
+
+class TtsCache:
+    """
+    Дисковый кэш синтезированных TTS фраз (WAV). Ключ — текст, голос и скорость речи: фраз о прогрессе
+    немного (проценты × длительность книги), поэтому повторно они не синтезируются ни в этом запуске, ни в следующих.
+    Весь синтез процесса идет в одном фоновом потоке с одним движком (SAPI5 на Windows привязан к потоку),
+    поэтому фразы можно заранее отрендерить (prerender), пока идет нарезка.
+    Размер ограничен: при превышении удаляются фразы, к которым дольше всего не обращались (LRU).
+    """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_size_mb=DEFAULT_TTS_CACHE_MAX_MB):
+        self.cache_dir = os.path.join(cache_dir, TTS_CACHE_SUBDIR)
+        self.max_size_bytes = int(max_size_mb * 1024 * 1024)
+        self._executor = None
+        self._renders = {} # текст -> Future с путем к WAV
+
+    def __getstate__(self):
+        # В процессы пула (--jobs) передаются только настройки; поток синтеза у каждого процесса свой
+        state = self.__dict__.copy()
+        state['_executor'] = None
+        state['_renders'] = {}
+        return state
+
+    def _submit(self, text):
+        future = self._renders.get(text)
+        if future is None:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=1)
+            future = self._executor.submit(self._render, text)
+            self._renders[text] = future
+        return future
+
+    def _render(self, text):
+        key = hashlib.sha256(f"{tts_voice()}|{TTS_RATE}|{text}".encode("utf-8")).hexdigest()
+        path = os.path.join(self.cache_dir, key + ".wav")
+        if os.path.exists(path):
+            os.utime(path) # Отмечаем обращение для LRU
+            return path
+        os.makedirs(self.cache_dir, exist_ok=True)
+        # Расширение .wav обязательно: по нему say выбирает формат файла
+        tmp_path = f"{path}.{os.getpid()}{TTS_TMP_SUFFIX}"
+        try:
+            # Неудачный синтез бросает исключение, и пустой файл не попадает в кэш
+            tts_to_wav(text, output_path=tmp_path)
+            os.replace(tmp_path, path) # Атомарно: параллельные процессы не увидят недописанную фразу
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        self.evict()
+        return path
+
+    def prerender(self, texts):
+        """Ставит фразы в очередь синтеза, не дожидаясь результата."""
+        for text in dict.fromkeys(texts):
+            self._submit(text)
+
+    def get_wav(self, text):
+        """Возвращает путь к WAV с фразой из кэша (синтезирует, если ее еще нет). Файл удалять не нужно."""
+        try:
+            return self._submit(text).result()
+        finally:
+            self._renders.pop(text, None)
+
+    def evict(self):
+        """Удаляет самые старые по обращению фразы, пока кэш не уложится в лимит."""
+        try:
+            entries = []
+            for entry in os.scandir(self.cache_dir):
+                # Временные файлы синтеза в других процессах не трогаем
+                if entry.is_file() and entry.name.endswith(".wav") and not entry.name.endswith(TTS_TMP_SUFFIX):
+                    st = entry.stat()
+                    entries.append((st.st_mtime, st.st_size, entry.path))
+        except OSError:
+            return
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries)[:-1]: # Только что синтезированную фразу не трогаем
+            if total_size <= self.max_size_bytes:
+                break
+            try:
+                os.remove(path)
+                total_size -= size
+            except OSError:
+                pass
+
+    def close(self):
+        if self._executor is not None:
+            # Незапущенные фоновые фразы не нужны: они будут синтезированы при следующем обращении
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self._executor = None
+            self._renders = {}
 
 def format_time(ms):
     s = ms // 1000
@@ -652,6 +3654,186 @@ def print_processing_statistics(all_stats, total_original_duration, total_target
     
     print("="*70)
 
+def run_volume_filter_tests():
+    """
+    Проверяет выражение покускового усиления volume_filter() на границах кусков. Возвращает число ошибок.
+    Выражение вычисляется здесь же: оно состоит из сумм произведений констант и условий gte/lt от t.
+    """
+    errors = 0
+    gains_db = [0.0, 12.0, -6.0]
+    boundaries_ms = [1000, 2537]
+    audio_filter = volume_filter(gains_db, boundaries_ms)
+    expression = re.search(r"volume='([^']*)'", audio_filter).group(1)
+    python_expression = re.sub(r"gte\(t,([0-9.]+)\)", r"(t >= \1)", expression)
+    python_expression = re.sub(r"lt\(t,([0-9.]+)\)", r"(t < \1)", python_expression)
+    checks = [(0.0, 0), (0.9999, 0), (1.0, 1), (2.5369, 1), (2.537, 2), (100.0, 2)]
+    for t, chunk_index in checks:
+        factor = eval(python_expression, {"__builtins__": {}}, {"t": t})
+        expected = db_to_float(gains_db[chunk_index])
+        ok = abs(factor - expected) < 1e-6 * expected
+        if not ok:
+            errors += 1
+        print(f"{'✅' if ok else '❌'} t={t}s → {factor:.6g} (ожидалось: {expected:.6g}, кусок {chunk_index + 1})")
+    # Усиление переключается на кадрах ffmpeg, поэтому кадры должны дробиться до фильтра volume
+    split_position = audio_filter.find(f"asetnsamples=n={VOLUME_SWITCH_SAMPLES}")
+    ok = 0 <= split_position < audio_filter.find("volume=")
+    if not ok:
+        errors += 1
+    max_error_ms = VOLUME_SWITCH_SAMPLES / 44100 * 1000
+    print(f"{'✅' if ok else '❌'} кадры дробятся перед volume: переключение не дальше {max_error_ms:.1f} мс от границы при 44.1 кГц")
+    ok = volume_filter([3.0, 3.0], [1000]) == "volume=3.0000dB" and volume_filter([0.0, 0.0], [1000]) is None
+    if not ok:
+        errors += 1
+    print(f"{'✅' if ok else '❌'} одинаковое усиление — без выражения, нулевое — без фильтра")
+    return errors
+
+
+def _test_audio(duration_ms, frame_rate, channels, silences_ms, seed):
+    """Шум с тихими участками silences_ms [(начало, конец)] для тестов детектора тишины."""
+    rng = np.random.default_rng(seed)
+    frames = duration_ms * frame_rate // 1000
+    samples = rng.integers(-6000, 6000, size=(frames, channels))
+    for start_ms, end_ms in silences_ms:
+        start, end = start_ms * frame_rate // 1000, end_ms * frame_rate // 1000
+        samples[start:end] = rng.integers(-30, 30, size=(end - start, channels))
+    return AudioSegment(samples.astype("<i2").tobytes(), frame_rate=frame_rate, sample_width=2, channels=channels)
+
+
+def _scan_silence(audio, min_silence_len_ms, silence_thresh_db, block_bytes=None):
+    """SilenceScanner по всему AudioSegment; block_bytes — подавать PCM блоками, как в потоковом режиме."""
+    scanner = SilenceScanner(audio.frame_rate, audio.channels, audio.sample_width, min_silence_len_ms, silence_thresh_db)
+    data = audio.raw_data
+    block_bytes = block_bytes or len(data)
+    for offset in range(0, len(data), block_bytes):
+        scanner.feed(data[offset:offset + block_bytes])
+    return scanner.finish()
+
+
+def _reference_split_points(audio, target_chunk_duration_ms, search_window_ms, silence_thresh_db, min_silence_len_ms):
+    """Прежний цикл нарезки: detect_silence по срезу аудио вокруг каждой целевой точки."""
+    from pydub.silence import detect_silence
+    total_duration_ms = len(audio)
+    current_pos_ms = 0
+    result = []
+    while current_pos_ms < total_duration_ms:
+        ideal_split_point_ms = current_pos_ms + target_chunk_duration_ms
+        if ideal_split_point_ms >= total_duration_ms - (search_window_ms / 2):
+            split_point_ms = total_duration_ms
+        else:
+            start_search = max(0, ideal_split_point_ms - search_window_ms // 2)
+            end_search = min(total_duration_ms, ideal_split_point_ms + search_window_ms // 2)
+            silences = detect_silence(audio[start_search:end_search], min_silence_len=min_silence_len_ms,
+                                      silence_thresh=silence_thresh_db, seek_step=1)
+            split_point_ms = ideal_split_point_ms
+            if silences:
+                best = min(silences, key=lambda s: abs((s[0] + s[1]) / 2 + start_search - ideal_split_point_ms))
+                found = (best[0] + best[1]) // 2 + start_search
+                if found > current_pos_ms:
+                    split_point_ms = found
+            if total_duration_ms - split_point_ms < min_silence_len_ms:
+                split_point_ms = total_duration_ms
+        result.append((current_pos_ms, split_point_ms))
+        current_pos_ms = split_point_ms
+    return result
+
+
+def run_silence_tests():
+    """
+    Сравнивает SilenceScanner с pydub.silence.detect_silence(seek_step=1), а plan_split_points —
+    с прежним циклом нарезки по срезам аудио. Возвращает число ошибок.
+    """
+    from pydub.silence import detect_silence
+    errors = 0
+    silences_ms = [(0, 700), (3000, 3400), (5000, 6200), (6500, 7300), (9000, 9499), (11800, 12000)]
+    cases = [
+        # (частота, каналы, мин. длина тишины, порог, размер блока потокового режима)
+        (8000, 1, 500, -40, None),
+        (8000, 1, 300, -40, 4002),
+        (44100, 2, 300, -45, 35284),
+        (22050, 1, 1000, -40, 9998),
+    ]
+    for frame_rate, channels, min_silence_len_ms, silence_thresh_db, block_bytes in cases:
+        audio = _test_audio(12000, frame_rate, channels, silences_ms, seed=frame_rate + min_silence_len_ms)
+        expected = detect_silence(audio, min_silence_len=min_silence_len_ms, silence_thresh=silence_thresh_db, seek_step=1)
+        result = _scan_silence(audio, min_silence_len_ms, silence_thresh_db, block_bytes).silent_ranges()
+        ok = result == expected
+        if not ok:
+            errors += 1
+        print(f"{'✅' if ok else '❌'} {frame_rate} Гц, {channels} кан., тишина от {min_silence_len_ms} мс, "
+              f"{silence_thresh_db} dBFS, блоки {block_bytes or 'весь файл'}: {result}"
+              + ("" if ok else f" (ожидалось: {expected})"))
+
+    # При частоте, кратной 1000 Гц, сетка мс среза совпадает с сеткой файла, и точки должны совпасть точно
+    book_silences = [(9000, 9800), (18500, 19300), (31000, 31600), (33000, 34500), (61000, 61700), (70000, 70900)]
+    audio = _test_audio(80000, 8000, 1, book_silences, seed=7)
+    silence_index = SilenceIndex.from_scanner(_scan_silence(audio, 500, -40))
+    for target_chunk_duration_ms, search_window_ms in [(10000, 4000), (20000, 6000), (30000, 10000), (75000, 10000)]:
+        expected = _reference_split_points(audio, target_chunk_duration_ms, search_window_ms, -40, 500)
+        result = plan_split_points(silence_index, target_chunk_duration_ms, search_window_ms, 500)
+        ok = result == expected
+        if not ok:
+            errors += 1
+        print(f"{'✅' if ok else '❌'} plan_split_points, кусок {target_chunk_duration_ms} мс, окно {search_window_ms} мс: "
+              f"{[end for _, end in result]}" + ("" if ok else f" (ожидалось: {[end for _, end in expected]})"))
+    return errors
+
+
+def _test_mp3_frame(bitrate_index, main_data_begin=0, payload=b""):
+    """Кадр MPEG-1 Layer III, 48 кГц, моно, без CRC (битрейты 128 и 160 кбит/с дают кадры 384 и 480 байт)."""
+    header = bytes([0xFF, 0xFB, (bitrate_index << 4) | (1 << 2), 0xC0])
+    frame = bytearray(144 * _MP3_BITRATES[(True, 3)][bitrate_index] * 1000 // 48000)
+    frame[:4] = header
+    frame[4] = main_data_begin >> 1
+    frame[5] = (main_data_begin & 1) << 7
+    frame[4 + 17:4 + 17 + len(payload)] = payload
+    return bytes(frame)
+
+
+def run_mp3_index_tests():
+    """
+    Проверяет Mp3FrameIndex и probe_mp3_duration_ms на синтетических MP3 (CBR с тегами ID3, VBR с тегом
+    Xing/LAME и VBR без тегов). Возвращает число ошибок.
+    """
+    errors = 0
+    id3v2 = b"ID3\x04\x00\x00\x00\x00\x01\x00" + bytes(128)
+    id3v1 = b"TAG" + bytes(125)
+    # CBR крупнее блока чтения MP3_SCAN_BLOCK_BYTES, чтобы кадры переходили через границу блоков
+    cbr_frames = MP3_SCAN_BLOCK_BYTES // 384 + 500
+    cbr = [_test_mp3_frame(9, main_data_begin=300 if i % 7 == 3 else 0) for i in range(cbr_frames)]
+    vbr = [_test_mp3_frame(9 if i % 3 else 10) for i in range(1000)]
+    delay, padding = 576, 1000
+    lame = b"LAME3.100" + bytes(12) + ((delay << 12) | padding).to_bytes(3, "big")
+    xing = _test_mp3_frame(9, payload=b"Xing" + (1).to_bytes(4, "big") + len(vbr).to_bytes(4, "big") + lame)
+    cases = [
+        # (название, байты файла, кадров, длительность по кадрам мс, ожидаемый probe мс)
+        ("CBR с ID3v2/ID3v1", id3v2 + b"".join(cbr) + id3v1, cbr_frames, cbr_frames * 24, cbr_frames * 24),
+        ("VBR с Xing/LAME", xing + b"".join(vbr), len(vbr),
+         round((len(vbr) * 1152 - delay - padding) / 48), round((len(vbr) * 1152 - delay - padding) / 48)),
+        ("VBR без тегов, с мусором", b"junk" + b"".join(vbr[:500]) + b"\xff\x00" + b"".join(vbr[500:]), len(vbr),
+         len(vbr) * 24, len(vbr) * 24),
+    ]
+    for name, data, frames_count, index_ms, probe_ms in cases:
+        with NamedTemporaryFile(suffix=".mp3", delete=False) as f:
+            f.write(data)
+        try:
+            frame_index = Mp3FrameIndex(f.name)
+            probed_ms = probe_mp3_duration_ms(f.name)
+        finally:
+            os.remove(f.name)
+        ok = len(frame_index) == frames_count and frame_index.duration_ms() == index_ms and probed_ms == probe_ms
+        if name.startswith("CBR"):
+            # Смещения кадров и main_data_begin, в том числе у кадров на границе блоков чтения
+            ok = ok and frame_index.offsets == [len(id3v2) + 384 * i for i in range(cbr_frames)]
+            ok = ok and frame_index.main_data_begin == [300 if i % 7 == 3 else 0 for i in range(cbr_frames)]
+        elif "Xing" in name:
+            ok = ok and frame_index.xing['frames'] == len(vbr) and frame_index.start_delay_samples == delay + _MP3_DECODER_DELAY
+        if not ok:
+            errors += 1
+        print(f"{'✅' if ok else '❌'} {name}: кадров {len(frame_index)} (ожидалось: {frames_count}), "
+              f"по кадрам {frame_index.duration_ms()} мс (ожидалось: {index_ms}), probe {probed_ms} мс (ожидалось: {probe_ms})")
+    return errors
+
+
 def plural_ru(n, form1, form2, form5):
     """Склоняет русское существительное по числу: 1, 2-4, 5+ (например, процент/процента/процентов)."""
     n = abs(n) % 100
@@ -664,8 +3846,62 @@ def plural_ru(n, form1, form2, form5):
         return form2
     return form5
 
+
+def process_file_task(task, split_kwargs, analysis_cache=None, capture_output=False, tts_cache=None, on_chunk_ready=None):
+    """
+    Обрабатывает один файл из списка заданий main: выводит подготовленные сообщения, при необходимости
+    генерирует TTS сообщение и вызывает split_mp3. Функция верхнего уровня, чтобы ее можно было
+    запускать в пуле процессов (--jobs).
+    При capture_output=True весь вывод собирается в строку, чтобы логи параллельных файлов не перемешивались.
+    on_chunk_ready передается в split_mp3 (только при обработке в текущем процессе).
+    Возвращает (лог, статистика или None, была ли критическая ошибка).
+    """
+    output = io.StringIO() if capture_output else None
+    with contextlib.redirect_stdout(output) if capture_output else contextlib.nullcontext():
+        for message in task['messages']:
+            print(message)
+        tts_wav = None
+        failed = False
+        file_stats = None
+        try:
+            if task['tts_text']:
+                print(f"  📢 Генерация TTS сообщения: \"{task['tts_text']}\"")
+                tts_wav = tts_cache.get_wav(task['tts_text']) if tts_cache else tts_to_wav(task['tts_text'])
+                print(f"  ✅ TTS сообщение готово, будет добавлено в первый кусок")
+            # TTS сообщение вставляется в первый кусок внутри split_mp3, до его единственного кодирования
+            file_stats = split_mp3(task['input_file'], task['output_dir'], analysis_cache=analysis_cache,
+                                   intro_file=tts_wav, content_hash=task.get('content_hash'),
+                                   on_chunk_ready=on_chunk_ready, **split_kwargs)
+            if file_stats and tts_wav:
+                print(f"  🎯 TTS сообщение добавлено в начало первого куска")
+        except Exception as e:
+            print(f"\n!!! КРИТИЧЕСКАЯ ОШИБКА при обработке файла {task['input_file']}: {e}")
+            print("    Продолжение со следующим файлом...\n")
+            failed = True
+        finally:
+            # Фразы из кэша TTS переиспользуются, удаляются только временные файлы
+            if tts_wav and not tts_cache and os.path.exists(tts_wav):
+                os.remove(tts_wav)
+    return (output.getvalue() if capture_output else ""), file_stats, failed
+
+
 if __name__ == "__main__":
     import sys
+    if '--test-volume-filter' in sys.argv:
+        print('Тесты для volume_filter:')
+        errors = run_volume_filter_tests()
+        print('Все тесты пройдены успешно!' if errors == 0 else f'Ошибок: {errors}')
+        sys.exit(1 if errors else 0)
+    if '--test-silence' in sys.argv:
+        print('Тесты для SilenceScanner и plan_split_points:')
+        errors = run_silence_tests()
+        print('Все тесты пройдены успешно!' if errors == 0 else f'Ошибок: {errors}')
+        sys.exit(1 if errors else 0)
+    if '--test-mp3-index' in sys.argv:
+        print('Тесты для Mp3FrameIndex и probe_mp3_duration_ms:')
+        errors = run_mp3_index_tests()
+        print('Все тесты пройдены успешно!' if errors == 0 else f'Ошибок: {errors}')
+        sys.exit(1 if errors else 0)
     if '--test-plural' in sys.argv:
         print('Тесты для plural_ru:')
         test_cases = [
@@ -705,12 +3941,18 @@ if __name__ == "__main__":
     # Добавляем группу для режимов работы
     mode_group = parser.add_argument_group('Режимы работы')
     mode_group.add_argument("--copy-only", action='store_true', help="Только скопировать файлы из папки --output-dir в --copy-to, затем переместить их в copied_mp3.")
+    mode_group.add_argument("--bench-verify", action='store_true', help="Измерить скорость каждого способа проверки --verify на синтетическом файле и выйти.")
 
     # Аргументы для путей
     path_group = parser.add_argument_group('Пути')
     path_group.add_argument("-i", "--input-dir", default="source_mp3", help="Папка с исходными MP3 (для обработки). По умолчанию: source_mp3.")
     path_group.add_argument("-o", "--output-dir", default="ready_mp3", help="Папка для сохранения/чтения результатов. По умолчанию: ready_mp3.")
-    path_group.add_argument("--copy-to", help="Папка назначения для копирования (напр., /Volumes/DRIVE). Обязателен для --copy-only.")
+    path_group.add_argument("--copy-to", help="Папка назначения для копирования (напр., /Volumes/DRIVE). Обязателен для --copy-only.\nГотовые куски копируются на устройство уже во время обработки.")
+    path_group.add_argument("--sync", action='store_true', help=f"Инкрементальная синхронизация с --copy-to: копировать только новые и измененные файлы.\nСписок скопированного (путь, размер, хеш) хранится на устройстве в {DEVICE_MANIFEST_NAME}.")
+    path_group.add_argument("--prune", action='store_true', help="С --sync: удалять с устройства ранее скопированные файлы, которых больше нет\nни в --output-dir, ни в copied_mp3. Файлы, записанные на устройство не этой программой, не удаляются.")
+    path_group.add_argument("--verify", choices=tuple(VERIFIERS), default=DEFAULT_VERIFY, help="Проверка копий: sha256, blake2b или crc32 — хеш копии, прочитанной обратно с устройства;\nsize — только размер; none — без проверки. Сравнить скорость: --bench-verify. По умолчанию: sha256.")
+    path_group.add_argument("--copy-jobs", type=int, default=DEFAULT_COPY_JOBS, help=f"На сколько файлов вперед читать и хешировать источники и сколько копий проверять параллельно\nпри копировании. На устройство файлы записываются по одному, строго в порядке имен. По умолчанию: {DEFAULT_COPY_JOBS}.")
+    path_group.add_argument("--no-copy-pipeline", action='store_true', help="Копировать на --copy-to только после обработки всех файлов, строго по порядку имен\n(а не по мере готовности кусков).")
 
     # Аргументы для обработки
     processing_group = parser.add_argument_group('Параметры обработки (игнорируются при --copy-only)')
@@ -718,19 +3960,54 @@ if __name__ == "__main__":
     processing_group.add_argument("-w", "--window", type=int, default=10, help="Окно поиска тишины в сек. (+/- window/2). По умолчанию: 10.")
     processing_group.add_argument("-t", "--threshold", type=int, default=-40, help="Порог тишины в dBFS. По умолчанию: -40.")
     processing_group.add_argument("-m", "--min-silence", type=int, default=500, help="Мин. длина тишины в мс. По умолчанию: 500.")
-    processing_group.add_argument("-s", "--speed", type=float, default=1.0, help="Коэффициент скорости (0.5-2.0). По умолчанию: 1.0.")
-    processing_group.add_argument("--skip-existing", action='store_true', help="Пропускать обработку, если 1-й кусок уже есть.")
+    processing_group.add_argument("-s", "--speed", type=float, default=1.0, help="Коэффициент скорости (0.5-10.0; больше 2.0 — цепочкой фильтров atempo). По умолчанию: 1.0.")
+    processing_group.add_argument("--skip-existing", action='store_true', help="Пропускать файлы, куски которых актуальны по манифесту выходной папки\n(тот же исходник, те же параметры, все куски на месте).")
     processing_group.add_argument("--tts-progress", action='store_true', help="Вставлять голосовое сообщение о прогрессе в первый кусок каждого файла")
     processing_group.add_argument("--tts-progress-grid", action='store_true', help="Сообщение о прогрессе не чаще чем каждые 5%%")
+    processing_group.add_argument("--tts-prerender", action='store_true', help="Синтезировать все сообщения о прогрессе заранее в фоне, пока идет нарезка.")
+    processing_group.add_argument("--tts-cache-max-mb", type=float, default=DEFAULT_TTS_CACHE_MAX_MB, help=f"Максимальный размер кэша синтезированных фраз (в папке --cache-dir) в МБ. По умолчанию: {DEFAULT_TTS_CACHE_MAX_MB}.")
     # Добавляем аргумент для уровня нормализации
     processing_group.add_argument("--norm-dbfs", type=float, default=-0.1, help="Целевой уровень нормализации в dBFS (если включена). По умолчанию: -0.1.")
     # Добавляем флаг для включения нормализации
     processing_group.add_argument("--enable-normalization", action='store_true', help="Включить нормализацию громкости.")
+    processing_group.add_argument("--normalize-mode", choices=NORMALIZE_MODES, default=DEFAULT_NORMALIZE_MODE, help="Режим нормализации: peak-chunk — пик каждого куска до --norm-dbfs,\npeak-book — одно усиление для всей книги (все файлы --input-dir) по ее пику,\nrms-book — одно усиление для всей книги до --norm-rms-dbfs (пик не выше --norm-dbfs).\nУровни книги берутся из того же анализа, что и поиск тишины. По умолчанию: peak-chunk.")
+    processing_group.add_argument("--norm-rms-dbfs", type=float, default=DEFAULT_NORM_RMS_DBFS, help=f"Целевой средний уровень (RMS) книги в dBFS для --normalize-mode rms-book. По умолчанию: {DEFAULT_NORM_RMS_DBFS}.")
+    processing_group.add_argument("--streaming", action='store_true', help="Потоковое декодирование для --export-mode chunks: в памяти держится только текущий кусок и окно поиска тишины.\nПотребление памяти не зависит от длины файла (для очень длинных книг).")
+    processing_group.add_argument("--export-mode", choices=EXPORT_MODES, default=DEFAULT_EXPORT_MODE, help="Способ экспорта: segment — все куски файла одним вызовом ffmpeg (быстро, без временных файлов),\nchunks — каждый кусок отдельно через pydub. Нормализация в обоих режимах — усиление при кодировании. По умолчанию: segment.")
+    processing_group.add_argument("--lossless-cut", action='store_true', help="Резать MP3 по границам кадров без перекодирования (быстро и без потери качества).\nРаботает только при --speed 1.0 без нормализации, иначе куски перекодируются.")
+    processing_group.add_argument("--cache-dir", default=DEFAULT_CACHE_DIR, help=f"Папка кэша анализа тишины (ключ: содержимое файла, --threshold, --min-silence). По умолчанию: {DEFAULT_CACHE_DIR}.")
+    processing_group.add_argument("--cache-max-mb", type=float, default=DEFAULT_CACHE_MAX_MB, help=f"Максимальный размер кэша анализа в МБ, старые записи удаляются (LRU). По умолчанию: {DEFAULT_CACHE_MAX_MB}.")
+    processing_group.add_argument("--no-cache", action='store_true', help="Не использовать кэш анализа тишины и индекс библиотеки.")
+    processing_group.add_argument("--library-index", help=f"Файл SQLite-индекса исходных файлов (размер, mtime, длительность, хеш, статистика тишины).\nПо умолчанию: {LIBRARY_INDEX_NAME} в папке --cache-dir.")
+    processing_group.add_argument("--watch", action='store_true', help="Не завершаться после обработки: следить за --input-dir и обрабатывать новые или измененные MP3\nс теми же параметрами, когда файл перестает меняться (докопирован). Ctrl+C для выхода.")
+    processing_group.add_argument("--watch-interval", type=float, default=DEFAULT_WATCH_INTERVAL_S, help=f"Интервал опроса папки в сек., если inotify недоступен. По умолчанию: {DEFAULT_WATCH_INTERVAL_S}.")
+    processing_group.add_argument("--watch-settle", type=float, default=DEFAULT_WATCH_SETTLE_S, help=f"Сколько сек. размер и время изменения файла должны не меняться, чтобы считать его докопированным. По умолчанию: {DEFAULT_WATCH_SETTLE_S}.")
+    processing_group.add_argument("-j", "--jobs", type=int, default=1, help="Сколько файлов обрабатывать параллельно (процессов). Логи файлов выводятся целиком и по порядку. По умолчанию: 1.")
+    processing_group.add_argument("--encode-workers", type=int, default=0, help=f"Сколько кусков одного файла кодировать параллельно. 0 — по числу ядер (с учетом --jobs),\nно не больше {DEFAULT_MAX_ENCODE_WORKERS}. По умолчанию: 0.")
+    processing_group.add_argument("--encode-buffer-mb", type=float, default=DEFAULT_ENCODE_BUFFER_MB, help=f"Сколько МБ PCM могут занимать куски, ожидающие кодирования (--export-mode chunks). По умолчанию: {DEFAULT_ENCODE_BUFFER_MB}.")
 
     args = parser.parse_args()
+    if args.jobs < 1:
+        parser.error("--jobs должен быть не меньше 1.")
+    if not (MIN_SPEED_FACTOR <= args.speed <= MAX_SPEED_FACTOR):
+        parser.error(f"--speed должен быть в диапазоне {MIN_SPEED_FACTOR}-{MAX_SPEED_FACTOR}.")
+    if args.encode_workers < 0:
+        parser.error("--encode-workers не может быть отрицательным.")
+    if args.watch_interval <= 0 or args.watch_settle < 0:
+        parser.error("--watch-interval должен быть больше 0, --watch-settle не может быть отрицательным.")
+    if args.copy_jobs < 1:
+        parser.error("--copy-jobs должен быть не меньше 1.")
+    if args.prune and not args.sync:
+        parser.error("--prune работает только вместе с --sync.")
+
+    if args.bench_verify:
+        bench_verifiers()
+        sys.exit(0)
 
     # Папка для перемещенных файлов
     MOVE_TARGET_DIR = "copied_mp3"
+    # Удаленным из библиотеки считается файл, которого нет ни в --output-dir, ни среди перемещенных
+    prune_roots = [MOVE_TARGET_DIR] if args.prune else None
 
     if args.copy_only:
         print("--- РЕЖИМ: Только копирование и перемещение ---")
@@ -738,7 +4015,9 @@ if __name__ == "__main__":
             parser.error("--copy-to требуется при использовании --copy-only.")
         
         # Выполняем копирование
-        copy_success = copy_with_verify(args.output_dir, args.copy_to)
+        device_manifest = DeviceManifest(args.copy_to) if args.sync and os.path.isdir(args.copy_to) else None
+        copy_success = copy_with_verify(args.output_dir, args.copy_to, device_manifest=device_manifest,
+                                        prune_roots=prune_roots, copy_jobs=args.copy_jobs, verify=args.verify)
         
         # Если копирование успешно, перемещаем
         if copy_success:
@@ -753,6 +4032,8 @@ if __name__ == "__main__":
         input_root_dir = args.input_dir
         output_root_dir = args.output_dir
 
+        install_sigterm_handler()
+
         # --- Проверка ffmpeg --- 
         try:
             print("Проверка наличия ffmpeg...")
@@ -766,6 +4047,13 @@ if __name__ == "__main__":
                 print("Windows: Скачайте с сайта и добавьте в PATH.")
                 sys.exit(1)
             print("ffmpeg найден.")
+            if args.speed != 1.0:
+                # Ошибка фильтра скорости видна сразу, а не на каждом куске каждого файла
+                tempo_error = validate_tempo_filter(args.speed)
+                if tempo_error:
+                    print(f"\n!!! ОШИБКА: ffmpeg не принимает фильтр скорости {build_audio_filter(args.speed)}: {tempo_error}")
+                    sys.exit(1)
+                print(f"Фильтр скорости {args.speed}x: {build_audio_filter(args.speed)}")
         except Exception as e:
              print(f"\nНе удалось проверить ffmpeg: {e}")
              sys.exit(1)
@@ -780,200 +4068,326 @@ if __name__ == "__main__":
              print(f"Создание директории назначения: {output_root_dir}")
              os.makedirs(output_root_dir)
 
-        print("\nНачало сканирования и обработки...")
-        found_files = 0
-        processed_files = 0
-        error_files = 0
+        # Без явного --encode-workers ядра делятся между параллельно обрабатываемыми файлами
+        encode_workers = args.encode_workers or max(1, min(DEFAULT_MAX_ENCODE_WORKERS, (os.cpu_count() or 1) // args.jobs))
+        split_kwargs = dict(
+            target_chunk_duration_s=args.duration,
+            search_window_s=args.window,
+            silence_thresh_db=args.threshold,
+            min_silence_len_ms=args.min_silence,
+            speed_factor=args.speed,
+            target_normalization_dbfs=args.norm_dbfs,
+            enable_normalization=args.enable_normalization,
+            streaming=args.streaming,
+            export_mode=args.export_mode,
+            lossless_cut=args.lossless_cut,
+            encode_workers=encode_workers,
+            encode_buffer_mb=args.encode_buffer_mb
+        )
+
+        # Параметры, от которых зависит содержимое кусков (для манифеста выходной папки)
+        manifest_params = {
+            'duration': args.duration,
+            'window': args.window,
+            'threshold': args.threshold,
+            'min_silence': args.min_silence,
+            'speed': args.speed,
+            'normalization': args.norm_dbfs if args.enable_normalization else None,
+            'normalize_mode': args.normalize_mode if args.enable_normalization else None,
+            'lossless_cut': args.lossless_cut and args.speed == 1.0 and not args.enable_normalization,
+        }
+
+        # Кэш анализа, индекс библиотеки и пул процессов создаются один раз: в режиме --watch
+        # они остаются «теплыми» между проходами
+        analysis_cache = None if args.no_cache else AnalysisCache(args.cache_dir, args.cache_max_mb)
+        # Индекс библиотеки хранится рядом с кэшем анализа; с --no-cache — только в памяти на время запуска
+        library_index_path = ":memory:" if args.no_cache else (args.library_index or os.path.join(args.cache_dir, LIBRARY_INDEX_NAME))
+        try:
+            library_index = LibraryIndex(library_index_path)
+        except (OSError, sqlite3.Error) as e:
+            print(f"Предупреждение: Индекс библиотеки {library_index_path} недоступен ({e}), используется временный.")
+            library_index = LibraryIndex(":memory:")
+        # Фразы о прогрессе повторяются между файлами и запусками, поэтому синтезируются один раз
+        tts_cache = TtsCache(args.cache_dir, args.tts_cache_max_mb) if args.tts_progress and not args.no_cache else None
+        watcher = FolderWatcher(input_root_dir, args.watch_interval, args.watch_settle) if args.watch else None
+        executor = None
+        prefetch_executor = None
+        copier = None
 
+        print("\nНачало сканирования и обработки...")
         # --- Сканирование MP3 файлов ---
         print("Сканирование MP3 файлов в директории...")
-        import glob
-        all_mp3 = []
-        for root, dirs, files in os.walk(input_root_dir):
-            files.sort()
-            for f in files:
-                if f.lower().endswith('.mp3'):
-                    all_mp3.append(os.path.join(root, f))
-        all_mp3.sort()  # сортировка по имени
-        print(f"Найдено {len(all_mp3)} MP3 файлов для обработки")
-        
-        # --- Вычисляем длительности для TTS progress (если включен) ---
-        if args.tts_progress:
-            total_dur, cumulative_durs = get_total_and_cumulative_durations(all_mp3)
-        else:
-            total_dur, cumulative_durs = 0, [0] * len(all_mp3)
-        
-        # Переменная для отслеживания последнего процента с TTS сообщением (для режима grid)
-        last_tts_progress_grid = -1
+        scanned_mp3 = scan_mp3_files(input_root_dir)
+        watch_ready = None  # None — обрабатываются все файлы библиотеки
+        try:
+            while True:
+                found_files = 0
+                processed_files = 0
+                error_files = 0
+
+                all_mp3 = [path for path, _, _ in scanned_mp3]  # сортировка по имени
+                # Порядок файлов в библиотеке: по нему считается процент прослушанного для TTS
+                file_positions = {path: position for position, path in enumerate(all_mp3)}
+                print(f"Найдено {len(all_mp3)} MP3 файлов для обработки")
+
+                changed_count, removed_count = library_index.refresh(input_root_dir, scanned_mp3)
+                if changed_count or removed_count:
+                    print(f"Индекс библиотеки обновлен: новых или измененных файлов {changed_count}, удалено {removed_count}")
         
-        # Инициализация общей статистики
-        import time
-        total_start_time = time.time()
-        all_stats = []
-        total_original_duration = 0
-        total_target_duration = 0
-        total_chunks = 0
-        total_output_size = 0
-
-        # --- Рекурсивный обход и обработка ---
-        print(f"\nНачало обработки файлов...") 
-        for idx, (root, dirs, files) in enumerate(os.walk(input_root_dir)):
-            files.sort()
-            mp3_files = [f for f in files if f.lower().endswith('.mp3')]
-            if not mp3_files:
-                continue
-            relative_path = os.path.relpath(root, input_root_dir)
-            current_output_dir = os.path.join(output_root_dir, relative_path)
-            if not os.path.isdir(current_output_dir):
-                try:
-                    os.makedirs(current_output_dir)
-                except OSError as e:
-                    print(f"Ошибка создания поддиректории {current_output_dir}: {e}. Пропуск файлов в этой папке.")
-                    error_files += len(mp3_files)
-                    continue
-            for file_idx, filename in enumerate(mp3_files):
-                found_files += 1
-                input_file_path = os.path.join(root, filename)
-                base_output_name = os.path.splitext(filename)[0]
-                potential_first_chunk = os.path.join(current_output_dir, f"{base_output_name}_001.mp3")
-                if args.skip_existing and os.path.exists(potential_first_chunk):
-                    print(f"--- Пропуск файла (найден существующий кусок): {input_file_path} ---")
-                    continue
+                if args.enable_normalization and args.normalize_mode != 'peak-chunk':
+                    # Одно усиление на всю книгу: громкость не скачет между кусками и файлами
+                    book_rms, book_peak = combine_levels(list(collect_book_levels(
+                        all_mp3, library_index, analysis_cache, args.threshold, args.min_silence, args.jobs).values()))
+                    if args.normalize_mode == 'peak-book':
+                        book_gain = peak_normalization_gain(book_peak, args.norm_dbfs)
+                    else:
+                        book_gain = rms_normalization_gain(book_rms, book_peak, args.norm_rms_dbfs, args.norm_dbfs)
+                    print(f"Громкость книги: RMS {book_rms:.2f} dBFS, пик {book_peak:.2f} dBFS. "
+                          f"Усиление для всех кусков ({args.normalize_mode}): {book_gain:+.2f} dB")
+                    split_kwargs['book_gain_db'] = book_gain
+                    manifest_params['book_gain_db'] = round(book_gain, 1)
+
+                # --- Вычисляем длительности для TTS progress (если включен) ---
                 if args.tts_progress:
-                    # --- вычисляем процент и генерируем TTS ---
-                    try:
-                        file_idx_in_all = all_mp3.index(input_file_path)
-                    except ValueError:
-                        file_idx_in_all = 0
-                    percent = int(round(100 * cumulative_durs[file_idx_in_all] / total_dur)) if total_dur > 0 else 0
-                    
-                    # Проверяем, нужно ли вставлять TTS сообщение
-                    should_insert_tts = True
-                    if args.tts_progress_grid:
-                        # Режим grid: вставляем только если прогресс >= 5% и не было сообщения в текущем 5% диапазоне
-                        if percent < 5:
-                            should_insert_tts = False
-                        else:
-                            current_grid_position = (percent // 5) * 5  # 5, 10, 15, 20, ...
-                            if current_grid_position <= last_tts_progress_grid:
+                    total_dur, cumulative_durs = get_total_and_cumulative_durations(all_mp3, library_index)
+                else:
+                    total_dur, cumulative_durs = 0, [0] * len(all_mp3)
+
+                # Переменная для отслеживания последнего процента с TTS сообщением (для режима grid)
+                last_tts_progress_grid = -1
+        
+                # Инициализация общей статистики
+                total_start_time = time.time()
+                all_stats = []
+                total_original_duration = 0
+                total_target_duration = 0
+                total_chunks = 0
+                total_output_size = 0
+
+                # --- Рекурсивный обход и обработка ---
+                # Сначала в порядке обхода составляется список заданий: процент для TTS и режим grid зависят
+                # только от порядка файлов, поэтому остаются верными при любом порядке завершения в пуле
+                print(f"\nНачало обработки файлов...") 
+                manifest = ProcessingManifest(output_root_dir)
+                tasks = []
+                failed_output_dirs = set()
+                for input_file_path in all_mp3:
+                    relative_path = os.path.relpath(os.path.dirname(input_file_path), input_root_dir)
+                    current_output_dir = os.path.join(output_root_dir, relative_path)
+                    found_files += 1
+                    if current_output_dir in failed_output_dirs:
+                        error_files += 1
+                        continue
+                    if not os.path.isdir(current_output_dir):
+                        try:
+                            os.makedirs(current_output_dir)
+                        except OSError as e:
+                            print(f"Ошибка создания поддиректории {current_output_dir}: {e}. Пропуск файлов в этой папке.")
+                            failed_output_dirs.add(current_output_dir)
+                            error_files += 1
+                            continue
+                    messages = []
+                    tts_text = None
+                    if args.tts_progress:
+                        # --- вычисляем процент и текст TTS ---
+                        file_idx_in_all = file_positions.get(input_file_path, 0)
+                        percent = int(round(100 * cumulative_durs[file_idx_in_all] / total_dur)) if total_dur > 0 else 0
+                
+                        # Проверяем, нужно ли вставлять TTS сообщение
+                        should_insert_tts = True
+                        if args.tts_progress_grid:
+                            # Режим grid: вставляем только если прогресс >= 5% и не было сообщения в текущем 5% диапазоне
+                            if percent < 5:
                                 should_insert_tts = False
                             else:
-                                last_tts_progress_grid = current_grid_position
-                    
-                    if should_insert_tts:
-                        h, m = format_time(total_dur)
-                        percent_word = plural_ru(percent, 'процент', 'процента', 'процентов')
-                        hour_word = plural_ru(h, 'час', 'часа', 'часов')
-                        minute_word = plural_ru(m, 'минута', 'минуты', 'минут')
-                        tts_text = f"вы прослушали {percent} {percent_word} книги длительностью {h} {hour_word} {m} {minute_word}"
-                        print(f"  📢 Генерация TTS сообщения: \"{tts_text}\"")
-                        tts_wav = tts_to_wav(tts_text)
-                        print(f"  ✅ TTS сообщение готово, будет добавлено в первый кусок")
-                    else:
-                        tts_wav = None
-                        if args.tts_progress_grid:
-                            print(f"  ⏭️  TTS сообщение пропущено для {percent}% (режим grid: не чаще каждых 5%)")
+                                current_grid_position = (percent // 5) * 5  # 5, 10, 15, 20, ...
+                                if current_grid_position <= last_tts_progress_grid:
+                                    should_insert_tts = False
+                                else:
+                                    last_tts_progress_grid = current_grid_position
+                
+                        if should_insert_tts:
+                            h, m = format_time(total_dur)
+                            percent_word = plural_ru(percent, 'процент', 'процента', 'процентов')
+                            hour_word = plural_ru(h, 'час', 'часа', 'часов')
+                            minute_word = plural_ru(m, 'минута', 'минуты', 'минут')
+                            tts_text = f"вы прослушали {percent} {percent_word} книги длительностью {h} {hour_word} {m} {minute_word}"
+                        elif args.tts_progress_grid:
+                            messages.append(f"  ⏭️  TTS сообщение пропущено для {percent}% (режим grid: не чаще каждых 5%)")
                         else:
-                            print(f"  ⏭️  TTS сообщение пропущено для {percent}%")
-                    # --- нарезка ---
-                    def split_mp3_with_tts(input_file, output_dir, *args_, **kwargs_):
-                        from pydub import AudioSegment
-                        chunks = []
-                        audio = AudioSegment.from_mp3(input_file)
-                        file_stats = split_mp3(input_file, output_dir, *args_, **kwargs_)
-                        first_chunk = os.path.join(output_dir, f"{base_output_name}_001.mp3")
-                        if os.path.exists(first_chunk) and tts_wav:
-                            print(f"  🔊 Добавление TTS сообщения в начало первого куска: {os.path.basename(first_chunk)}")
-                            seg1 = AudioSegment.from_wav(tts_wav)
-                            seg2 = AudioSegment.from_mp3(first_chunk)
-                            combined = seg1 + seg2
-                            combined.export(first_chunk, format="mp3")
-                            os.remove(tts_wav)
-                            print(f"  🎯 TTS сообщение успешно добавлено в файл")
-                        return file_stats
-                    try:
-                        file_stats = split_mp3_with_tts(
-                            input_file_path,
-                            current_output_dir,
-                            target_chunk_duration_s=args.duration,
-                            search_window_s=args.window,
-                            silence_thresh_db=args.threshold,
-                            min_silence_len_ms=args.min_silence,
-                            speed_factor=args.speed,
-                            target_normalization_dbfs=args.norm_dbfs,
-                            enable_normalization=args.enable_normalization
-                        )
-                        if file_stats:
-                            all_stats.append(file_stats)
-                            total_original_duration += file_stats['original_duration_ms']
-                            total_target_duration += file_stats['target_duration_ms']
-                            total_chunks += file_stats['chunks_count']
-                            total_output_size += file_stats['total_output_size_bytes']
-                        processed_files += 1
-                    except Exception as e:
-                        print(f"\n!!! КРИТИЧЕСКАЯ ОШИБКА при обработке файла {input_file_path}: {e}")
-                        print("    Продолжение со следующим файлом...\n")
-                        error_files += 1
+                            messages.append(f"  ⏭️  TTS сообщение пропущено для {percent}%")
+                    # В режиме наблюдения обрабатываются только докопированные новые или измененные файлы;
+                    # остальные файлы библиотеки нужны выше только для расчета процента прослушанного
+                    if watch_ready is not None and input_file_path not in watch_ready:
+                        continue
+                    # Файл актуален, если манифест подтверждает тот же исходник, те же параметры и все куски на месте
+                    manifest_key = os.path.relpath(input_file_path, input_root_dir).replace(os.sep, "/")
+                    file_params = dict(manifest_params, tts=tts_text)
+                    if args.skip_existing and manifest.is_up_to_date(manifest_key, input_file_path, file_params):
+                        print(f"--- Пропуск файла (куски актуальны по манифесту): {input_file_path} ---")
+                        continue
+                    tasks.append({
+                        'input_file': input_file_path,
+                        'output_dir': current_output_dir,
+                        'messages': messages,
+                        'tts_text': tts_text,
+                        'manifest_key': manifest_key,
+                        'params': file_params,
+                        # Запись удаляется до обработки: прерванный запуск не оставит файл «актуальным»
+                        'old_chunks': manifest.forget(manifest_key),
+                        # Хеш из индекса библиотеки избавляет от повторного чтения файла для ключа кэша анализа
+                        'content_hash': None if args.no_cache else library_index.get(input_file_path, 'content_hash'),
+                    })
+                if tasks:
+                    manifest.save()
+                if tts_cache and args.tts_prerender:
+                    # Фразы синтезируются в фоне, пока нарезаются первые файлы
+                    tts_cache.prerender([task['tts_text'] for task in tasks if task['tts_text']])
+
+                # --- нарезка ---
+                if args.jobs > 1 and len(tasks) > 1:
+                    if executor is None:
+                        # В режиме наблюдения пул процессов живет между проходами
+                        executor_workers = args.jobs if watcher else min(args.jobs, len(tasks))
+                        executor = ProcessPoolExecutor(max_workers=executor_workers, initializer=install_sigterm_handler)
+                        print(f"Параллельная обработка: {executor_workers} процессов")
+                    futures = [executor.submit(process_file_task, task, split_kwargs, analysis_cache, True, tts_cache) for task in tasks]
                 else:
-                    try:
-                        file_stats = split_mp3(
-                            input_file_path,
-                            current_output_dir,
-                            target_chunk_duration_s=args.duration,
-                            search_window_s=args.window,
-                            silence_thresh_db=args.threshold,
-                            min_silence_len_ms=args.min_silence,
-                            speed_factor=args.speed,
-                            target_normalization_dbfs=args.norm_dbfs,
-                            enable_normalization=args.enable_normalization
-                        )
-                        if file_stats:
-                            all_stats.append(file_stats)
-                            total_original_duration += file_stats['original_duration_ms']
-                            total_target_duration += file_stats['target_duration_ms']
-                            total_chunks += file_stats['chunks_count']
-                            total_output_size += file_stats['total_output_size_bytes']
-                        processed_files += 1
-                    except Exception as e:
-                        print(f"\n!!! КРИТИЧЕСКАЯ ОШИБКА при обработке файла {input_file_path}: {e}")
-                        print("    Продолжение со следующим файлом...\n")
+                    futures = None
+                # Манифест устройства читается заново на каждом проходе: устройство могли переподключить
+                device_manifest = DeviceManifest(args.copy_to) if args.copy_to and args.sync and os.path.isdir(args.copy_to) else None
+                # Конвейер: готовые куски копируются на устройство, пока кодируются следующие
+                if args.copy_to and not args.no_copy_pipeline and tasks and os.path.isdir(args.copy_to):
+                    copier = DeviceCopier(output_root_dir, args.copy_to, device_manifest=device_manifest,
+                                          verify=args.verify)
+                    print(f"Готовые куски копируются в '{os.path.abspath(args.copy_to)}' во время обработки.")
+                # Следующий файл декодируется и анализируется (в кэш анализа), пока кодируется текущий
+                if futures is None and analysis_cache and len(tasks) > 1 and prefetch_executor is None:
+                    prefetch_executor = ThreadPoolExecutor(max_workers=1)
+                prefetched = None
+
+                for task_index, task in enumerate(tasks):
+                    if futures is None:
+                        if prefetched is not None:
+                            try:
+                                _, task['content_hash'] = prefetched.result()
+                            except Exception:
+                                pass  # split_mp3 повторит анализ сам и сообщит об ошибке
+                        prefetched = None
+                        if prefetch_executor and task_index + 1 < len(tasks):
+                            next_task = tasks[task_index + 1]
+                            prefetched = prefetch_executor.submit(
+                                load_or_analyze_file, next_task['input_file'], analysis_cache,
+                                args.threshold, args.min_silence, next_task['content_hash'])
+                        log_text, file_stats, failed = process_file_task(
+                            task, split_kwargs, analysis_cache, tts_cache=tts_cache,
+                            on_chunk_ready=copier.submit if copier else None)
+                    else:
+                        # Логи выводятся целиком и в порядке файлов, даже если файлы завершаются в другом порядке
+                        try:
+                            log_text, file_stats, failed = futures[task_index].result()
+                        except Exception as e:
+                            log_text, file_stats, failed = "", None, True
+                            print(f"\n!!! КРИТИЧЕСКАЯ ОШИБКА при обработке файла {task['input_file']}: {e}")
+                            print("    Продолжение со следующим файлом...\n")
+                        builtins.print(log_text, end="", flush=True)
+                    if failed:
                         error_files += 1
+                        continue
+                    if file_stats:
+                        library_index.record_processing(task['input_file'], file_stats, args.threshold, args.min_silence)
+                        manifest.record(task['manifest_key'], task['input_file'], task['params'], file_stats['output_files'])
+                        removed = manifest.remove_orphaned_chunks(
+                            task['output_dir'], os.path.splitext(os.path.basename(task['input_file']))[0],
+                            task['old_chunks'], file_stats['output_files'])
+                        if removed:
+                            print(f"  Удалено устаревших кусков: {removed}")
+                        manifest.save()
+                        if copier and futures is not None:
+                            # Куски файла из пула процессов копируются, пока кодируются следующие файлы
+                            for output_file in file_stats['output_files']:
+                                copier.submit(output_file)
+                        all_stats.append(file_stats)
+                        total_original_duration += file_stats['original_duration_ms']
+                        total_target_duration += file_stats['target_duration_ms']
+                        total_chunks += file_stats['chunks_count']
+                        total_output_size += file_stats['total_output_size_bytes']
+                    processed_files += 1
 
-        # --- Вывод подробной статистики обработки --- 
-        total_processing_time = time.time() - total_start_time
+                already_copied = set()
+                if copier:
+                    already_copied = copier.close()
+                    copier = None
+                # --- Вывод подробной статистики обработки --- 
+                total_processing_time = time.time() - total_start_time
         
-        print("\n======================================")
-        print("Обработка завершена.")
-        print(f"Найдено MP3 файлов: {found_files}")
-        print(f"Обработано файлов: {processed_files}")
-        if error_files > 0:
-            print(f"Файлов с ошибками/пропущено при обработке: {error_files}")
-        print(f"Результаты сохранены в: {os.path.abspath(output_root_dir)}")
-        print("======================================")
+                print("\n======================================")
+                print("Обработка завершена.")
+                print(f"Найдено MP3 файлов: {found_files}")
+                print(f"Обработано файлов: {processed_files}")
+                if error_files > 0:
+                    print(f"Файлов с ошибками/пропущено при обработке: {error_files}")
+                print(f"Результаты сохранены в: {os.path.abspath(output_root_dir)}")
+                print("======================================")
         
-        # Выводим подробную статистику если есть обработанные файлы
-        if processed_files > 0 and all_stats:
-            print_processing_statistics(
-                all_stats, 
-                total_original_duration, 
-                total_target_duration,
-                total_chunks, 
-                total_output_size, 
-                total_processing_time,
-                processed_files, 
-                args.speed, 
-                args.enable_normalization
-            )
+                # Выводим подробную статистику если есть обработанные файлы
+                if processed_files > 0 and all_stats:
+                    print_processing_statistics(
+                        all_stats, 
+                        total_original_duration, 
+                        total_target_duration,
+                        total_chunks, 
+                        total_output_size, 
+                        total_processing_time,
+                        processed_files, 
+                        args.speed, 
+                        args.enable_normalization
+                    )
 
-        # --- Копирование и Перемещение после обработки --- 
-        if args.copy_to:
-            copy_success = copy_with_verify(output_root_dir, args.copy_to)
-            # Если копирование успешно, перемещаем
-            if copy_success:
-                move_files_structure(output_root_dir, MOVE_TARGET_DIR)
-                # Здесь не выходим из скрипта, просто сообщаем результат перемещения
-            else:
-                print("Копирование не удалось. Перемещение не будет выполнено.")
-        else:
-            print("\nКопирование на внешний диск не запрашивалось (опция --copy-to не указана), перемещение не выполняется.") 
-            print("\nКопирование на внешний диск не запрашивалось (опция --copy-to не указана), перемещение не выполняется.") 
\ No newline at end of file
+                # --- Копирование и Перемещение после обработки --- 
+                if args.copy_to and watcher and not processed_files:
+                    print("\nНовых файлов для копирования на внешний диск нет.")
+                elif args.copy_to:
+                    # Куски, уже скопированные конвейером, повторно не копируются
+                    copy_success = copy_with_verify(output_root_dir, args.copy_to, already_copied, device_manifest,
+                                                    prune_roots, copy_jobs=args.copy_jobs, verify=args.verify)
+                    # Если копирование успешно, перемещаем
+                    if copy_success:
+                        move_files_structure(output_root_dir, MOVE_TARGET_DIR)
+                        # Здесь не выходим из скрипта, просто сообщаем результат перемещения
+                    else:
+                        print("Копирование не удалось. Перемещение не будет выполнено.")
+                elif watch_ready is None:
+                    # В режиме наблюдения сообщаем один раз, после первого прохода
+                    print("\nКопирование на внешний диск не запрашивалось (опция --copy-to не указана), перемещение не выполняется.")
+
+                if watcher is None:
+                    break
+                # Все файлы первого прохода (и готовые файлы следующих) считаются учтенными до их следующего изменения
+                watcher.mark_processed(scanned_mp3 if watch_ready is None else
+                                       [entry for entry in scanned_mp3 if entry[0] in watch_ready])
+                mode = "inotify" if watcher.uses_inotify else f"опрос каждые {watcher.interval_s} с"
+                print(f"\n👀 Ожидание новых файлов в {os.path.abspath(input_root_dir)} ({mode}, Ctrl+C для выхода)...")
+                scanned_mp3, watch_ready = watcher.wait_for_changes()
+                print(f"\n--- Обнаружено новых или измененных файлов: {len(watch_ready)} ---")
+        except KeyboardInterrupt:
+            if watcher is None:
+                raise
+            print("\nНаблюдение за папкой остановлено.")
+        finally:
+            # При остановке (SIGTERM, Ctrl+C) ffmpeg не должен пережить скрипт и дописывать куски в фоне
+            terminate_child_processes()
+            if executor:
+                if _terminating:
+                    terminate_process_pool(executor)
+                executor.shutdown(cancel_futures=True)
+            if prefetch_executor:
+                prefetch_executor.shutdown(cancel_futures=True)
+            if copier:
+                copier.close(cancel=True)
+            library_index.close()
+            if tts_cache:
+                tts_cache.close()
+            if watcher:
+                watcher.close()
+            terminate_child_processes()